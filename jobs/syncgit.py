@@ -5,11 +5,30 @@ import time
 import os
 import os.path
 import dulwich.repo
+import dulwich.client
 import jenkinscli
 import xml.etree.ElementTree as ET
 import sys
 import argparse
 import textwrap
+import threading
+import Queue
+import hashlib
+import httplib
+import urllib
+import urlparse
+import base64
+import socket
+import errno
+import subprocess
+import sre_parse
+import sre_constants
+import mmap
+import struct
+import binascii
+import StringIO
+import xml.parsers.expat
+import fcntl
 
 # This script will create jobs for each remote branch found in the repository
 # in the current directory. It will also remove the jobs if the branches are
@@ -23,7 +42,8 @@ import textwrap
 # Requirements:
 # - Python 2.6 (2.7 should work too)
 # - dulwich (install it using # pip install dulwich)
-# - py-jenkins-cli (https://github.com/tholewebgods/py-jenkins-cli)
+# - py-jenkins-cli (https://github.com/tholewebgods/py-jenkins-cli), not
+#   needed when using the HTTP backend (--backend http)
 #
 
 BINARY_NAME="syncgit"
@@ -32,176 +52,2959 @@ VERSION="0.1"
 # Default for max. commit age of a branch
 DEFAULT_MAX_COMMIT_AGE=30
 
+# Default for the number of parallel job config reads
+DEFAULT_DISCOVERY_WORKERS=1
+
+# Backends to talk to Jenkins
+BACKEND_CLI="cli"
+BACKEND_HTTP="http"
+
+# Default for the number of sync targets of a config file synced in parallel
+DEFAULT_TARGET_WORKERS=4
+
+# Default for the number of parallel job creations/removals
+DEFAULT_MUTATION_WORKERS=1
+
+# Default remote the refs of --ref-updates are mapped to
+DEFAULT_REF_UPDATES_REMOTE="origin"
+
+# Defaults for the watch mode, in seconds
+DEFAULT_WATCH_INTERVAL=2
+DEFAULT_WATCH_DEBOUNCE=5
+DEFAULT_FULL_SYNC_INTERVAL=3600
+
+# Seconds after which a failed sync is tried again in watch mode
+WATCH_RETRY_INTERVAL=60
+
+# Default for the hours after which the cached job configs are read again
+DEFAULT_FULL_REFRESH_INTERVAL=24
+
+# Seconds a connection to the Jenkins remote API may block
+DEFAULT_HTTP_TIMEOUT=60
+
+# Name of the job cache file in the state directory
+JOB_CACHE_FILE="jobs.json"
+
+# Version of the config hashes in the job cache, cached hashes of another
+# version are dropped and determined again when needed
+CONFIG_HASH_VERSION=2
+
+# Name of the ref cache file in the state directory
+REF_CACHE_FILE="refs.json"
+
+# Name of the file with the operations left by a run over its time budget
+PENDING_FILE="pending.json"
+
+# Name of the file with the jobs disabled instead of removed in the state
+# directory
+TOMBSTONE_FILE="tombstones.json"
+
+# Name of the lock file in the state directory of a shard
+LOCK_FILE="sync.lock"
+
+# Seconds between two checks of the build queue length by the throttle
+QUEUE_CHECK_INTERVAL=5
+
+# Format version of the plan files written by --plan
+PLAN_VERSION=1
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS=[0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+# Load JSON state from a file. Returns None if the file does not exist or
+# can not be read, the state is rebuilt then.
+def _load_state(path):
+	if not os.path.exists(path):
+		return None
+
+	try:
+		with open(path) as f:
+			return json.load(f)
+	except ValueError as e:
+		print "Ignoring malformed state file '%s': %s" % (path, str(e))
+		return None
+
+# Write JSON state to a file, the file is replaced atomically
+def _save_state(path, data):
+	tmp_path = path + ".tmp"
+
+	with open(tmp_path, "w") as f:
+		json.dump(data, f)
+
+	os.rename(tmp_path, path)
+
+
+# Call fn for each item using up to "workers" threads.
+# Returns a list of (item, result, exception) tupels in the order of "items",
+# a failing call does not stop the remaining calls.
+def _parallel_map(fn, items, workers):
+	results = [None] * len(items)
+	queue = Queue.Queue()
+
+	for index, item in enumerate(items):
+		queue.put((index, item))
+
+	def worker():
+		while True:
+			try:
+				index, item = queue.get_nowait()
+			except Queue.Empty:
+				return
+
+			try:
+				results[index] = (item, fn(item), None)
+			except Exception as e:
+				results[index] = (item, None, e)
+
+	threads = [threading.Thread(target=worker) for i in range(max(1, min(workers, len(items))))]
+
+	for thread in threads:
+		thread.start()
+
+	for thread in threads:
+		thread.join()
+
+	return results
+
+
+# Raised if a Jenkins remote API request fails
+class JenkinsHttpException(Exception):
+
+	def __init__(self, msg):
+		super(JenkinsHttpException, self).__init__(msg)
+
+
+# Raised if a job is not created since its config could not be read
+class SkippedJobException(Exception):
+
+	def __init__(self, msg):
+		super(SkippedJobException, self).__init__(msg)
+
+
+# Whether sending a request failed because the server closed the connection
+# before responding: nothing of a response was received, and not a timeout
+def _is_closed_connection(error):
+	if isinstance(error, httplib.BadStatusLine):
+		# no status line at all, older versions report the empty line
+		return error.line in ("", "''") or error.line.startswith("No status line received")
+
+	if isinstance(error, socket.timeout) or not isinstance(error, socket.error):
+		return False
+
+	return error.errno in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
+"""
+	Jenkins remote API client, provides the same methods as
+	jenkinscli.JenkinsCli. Keep-alive connections are pooled and shared by
+	all threads, POST requests carry the CSRF crumb if Jenkins issues one.
+
+	- host -- URL to Jenkins in form <protocol>://<host>[:port][<path>]/
+	- user -- user name for basic authentication, none if None
+	- api_token -- API token (or password) of the user
+	- timeout -- seconds a connection may block
+"""
+class JenkinsHttpApi(object):
+
+	def __init__(self, host, user=None, api_token=None, timeout=DEFAULT_HTTP_TIMEOUT):
+		url = urlparse.urlparse(host)
+
+		self._timeout = timeout
+
+		self._scheme = url.scheme
+		self._netloc = url.netloc
+		self._path = url.path.rstrip("/")
+
+		self._headers = {}
+
+		if user is not None:
+			self._headers["Authorization"] = "Basic " + base64.b64encode("%s:%s" % (user, api_token or ""))
+
+		# idle connections, a thread takes one out for each request
+		self._idle_connections = []
+		self._pool_lock = threading.Lock()
+
+		# (header name, value) of the crumb, False if Jenkins does not issue one
+		self._crumb = None
+		self._crumb_lock = threading.Lock()
+
+	# Open a new connection
+	def _connect(self):
+		if self._scheme == "https":
+			return httplib.HTTPSConnection(self._netloc, timeout=self._timeout)
+		else:
+			return httplib.HTTPConnection(self._netloc, timeout=self._timeout)
+
+	# Get an idle connection or open a new one. Returns (connection, True if
+	# it is an idle one)
+	def _acquire_connection(self):
+		with self._pool_lock:
+			if len(self._idle_connections) > 0:
+				return (self._idle_connections.pop(), True)
+
+		return (self._connect(), False)
+
+	# Put a connection back to the pool
+	def _release_connection(self, connection):
+		with self._pool_lock:
+			self._idle_connections.append(connection)
+
+	# Send a request. Returns (status, response, body). An idle kept-alive
+	# connection that has been closed by Jenkins is replaced once, other
+	# failures are not retried since Jenkins may have processed the request.
+	def _request(self, method, path, body=None, headers=None):
+		request_headers = dict(self._headers)
+
+		if headers is not None:
+			request_headers.update(headers)
+
+		for attempt in (1, 2):
+			connection, idle = self._acquire_connection()
+
+			try:
+				connection.request(method, self._path + path, body, request_headers)
+				response = connection.getresponse()
+			except (httplib.HTTPException, socket.error) as e:
+				connection.close()
+
+				if idle and attempt == 1 and _is_closed_connection(e):
+					continue
+
+				raise
+
+			try:
+				# read the whole body, the connection can not be reused otherwise
+				data = response.read()
+			except (httplib.HTTPException, socket.error):
+				connection.close()
+				raise
+
+			if response.will_close:
+				connection.close()
+			else:
+				self._release_connection(connection)
+
+			return (response.status, response, data)
+
+	# Get the crumb header, None if Jenkins does not issue crumbs
+	def _get_crumb(self, refresh=False):
+		with self._crumb_lock:
+			if self._crumb is None or refresh:
+				status, response, data = self._request("GET", "/crumbIssuer/api/json")
+
+				if status == 404:
+					# CSRF protection is disabled
+					self._crumb = False
+				elif status == 200:
+					crumb = json.loads(data)
+					self._crumb = (crumb["crumbRequestField"], crumb["crumb"])
+
+					# the crumb is bound to the session
+					cookie = response.getheader("set-cookie")
+					if cookie is not None:
+						self._headers["Cookie"] = cookie.split(";")[0]
+				else:
+					raise JenkinsHttpException("Failed to get crumb: HTTP %d" % status)
+
+			return self._crumb or None
+
+	# GET a path, returns the response body
+	def _get(self, path):
+		status, response, data = self._request("GET", path)
+
+		if status != 200:
+			raise JenkinsHttpException("GET %s failed: HTTP %d" % (path, status))
+
+		return data
+
+	# POST to a path with the crumb, a rejected crumb is fetched again once
+	def _post(self, path, body=None):
+		for attempt in (1, 2):
+			headers = {"Content-Type": "application/xml"}
+
+			crumb = self._get_crumb(refresh=(attempt == 2))
+			if crumb is not None:
+				headers[crumb[0]] = crumb[1]
+
+			status, response, data = self._request("POST", path, body or "", headers)
+
+			if status == 403 and crumb is not None and attempt == 1:
+				continue
+
+			# Jenkins redirects after enable/delete
+			if status >= 400:
+				raise JenkinsHttpException("POST %s failed: HTTP %d" % (path, status))
+
+			return data
+
+	# Path of a job, jobs in folders are given as "folder/job"
+	def _job_path(self, job_name):
+		return "".join(["/job/" + urllib.quote(x, safe="") for x in job_name.split("/")])
+
+	# the job list can be restricted to a folder
+	lists_folders = True
+
+	# Path of the folder with the jobs to list, "" for the top level
+	def _folder_path(self, folder):
+		return self._job_path(folder) if folder is not None else ""
+
+	def get_joblist(self, folder=None):
+		data = json.loads(self._get(self._folder_path(folder) + "/api/json?tree=" + urllib.quote("jobs[name]")))
+
+		return [job["name"] for job in data["jobs"]]
+
+	"""
+	Get the job list and the Git branch specs of all jobs in one request.
+	Returns a list of (job name, branch names) tupels in job list order. The
+	branch names are None if Jenkins does not expose the SCM of a job (like
+	for pipeline jobs) and an empty list if the SCM has no branch specs.
+	Only the jobs in "folder" are listed if given.
+	"""
+	def get_job_branches(self, folder=None):
+		data = json.loads(self._get(self._folder_path(folder) + "/api/json?tree=" + urllib.quote("jobs[name,scm[branches[name]]]")))
+
+		job_branches = []
+
+		for job in data["jobs"]:
+			if job.get("scm") is None:
+				job_branches.append((job["name"], None))
+			else:
+				job_branches.append((job["name"], [branch["name"] for branch in job["scm"].get("branches", [])]))
+
+		return job_branches
+
+	def get_job(self, job_name):
+		return self._get(self._job_path(job_name) + "/config.xml")
+
+	def create_job(self, job_name, config):
+		folder, name = job_name.rsplit("/", 1) if "/" in job_name else (None, job_name)
+
+		self._post(self._folder_path(folder) + "/createItem?" + urllib.urlencode({"name": name}), config)
+
+	def update_job(self, job_name, config):
+		self._post(self._job_path(job_name) + "/config.xml", config)
+
+	def enable_job(self, job_name):
+		self._post(self._job_path(job_name) + "/enable")
+
+	def disable_job(self, job_name):
+		self._post(self._job_path(job_name) + "/disable")
+
+	def delete_job(self, job_name):
+		self._post(self._job_path(job_name) + "/doDelete")
+
+	# Number of items in the build queue
+	def get_queue_length(self):
+		data = json.loads(self._get("/queue/api/json?tree=" + urllib.quote("items[id]")))
+
+		return len(data["items"])
+
+
+# Create the object to talk to Jenkins with
+def _create_backend(backend, host, cli_jar, ssh_key, http_user=None, http_token=None):
+	if backend == BACKEND_HTTP:
+		return JenkinsHttpApi(host, http_user, http_token)
+	else:
+		return jenkinscli.JenkinsCli(host, cli_jar, ssh_key)
+
+
+# Get the shard (0 to count - 1) of a job name, the same in every process
+# and on every host
+def _get_shard(job_name, count):
+	if isinstance(job_name, unicode):
+		job_name = job_name.encode("utf-8")
+
+	return int(hashlib.sha1(job_name).hexdigest()[:8], 16) % count
+
+# Parse a shard given as "I/N" (I from 1 to N), returns (index, count) with
+# the index from 0 to count - 1
+def _parse_shard(value):
+	match = re.match("^([0-9]+)/([0-9]+)$", value)
+
+	if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+		raise argparse.ArgumentTypeError("Expected a shard like 1/4, got '%s'" % value)
+
+	return (int(match.group(1)) - 1, int(match.group(2)))
+
+# Get the directory for the state of a shard below "state_dir", it is created
+# if it does not exist. Returns "state_dir" itself if there is no shard.
+def _get_shard_state_dir(state_dir, shard):
+	if shard is None:
+		return state_dir
+
+	path = os.path.join(state_dir, "shard-%d-of-%d" % (shard[0] + 1, shard[1]))
+
+	if not os.path.isdir(path):
+		os.mkdir(path)
+
+	return path
+
+
+class LockException(Exception):
+
+	def __init__(self, msg):
+		super(LockException, self).__init__(msg)
+
+"""
+	Lock held by one process at a time, taken with flock() on a file. The
+	lock ends with the process holding it, a crashed run does not keep it.
+	The file names the holder. main() takes another lock factory, any object
+	with acquire() and release() can be used instead, like a lease from a
+	lock service for hosts without a shared file system that supports flock().
+"""
+class FileLock(object):
+
+	def __init__(self, path):
+		self._path = path
+		self._file = None
+
+	# Take the lock, raises a LockException if it is held
+	def acquire(self):
+		f = open(self._path, "a+")
+
+		try:
+			fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError:
+			f.seek(0)
+			holder = f.read().strip()
+			f.close()
+
+			raise LockException("Lock %s is held by %s" % (self._path, holder or "another process"))
+
+		f.seek(0)
+		f.truncate()
+		f.write("%s pid %d since %s\n" % (socket.gethostname(), os.getpid(), time.strftime("%Y-%m-%d %H:%M:%S")))
+		f.flush()
+
+		self._file = f
+
+	def release(self):
+		if self._file is None:
+			return
+
+		self._file.truncate(0)
+		fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+		self._file.close()
+		self._file = None
+
+
+"""
+	Wraps a backend (JenkinsCli, JenkinsHttpApi) to be shared by the Jenkins
+	instances of several sync targets. The job list is requested once for
+	all of them, all other calls are passed through.
+"""
+class SharedJenkinsBackend(object):
+
+	def __init__(self, backend):
+		self._backend = backend
+
+		# method name -> result of the listing calls
+		self._listings = {}
+		self._lock = threading.Lock()
+
+	# Call a listing method once per arguments (folder), the other threads
+	# wait for the result
+	def _get_listing(self, name, *args):
+		with self._lock:
+			if (name, args) not in self._listings:
+				self._listings[(name, args)] = getattr(self._backend, name)(*args)
+
+			return self._listings[(name, args)]
+
+	def get_joblist(self, *args):
+		return self._get_listing("get_joblist", *args)
+
+	def __getattr__(self, name):
+		# only provided if the backend provides it
+		if name == "get_job_branches" and hasattr(self._backend, name):
+			return lambda *args: self._get_listing(name, *args)
+
+		return getattr(self._backend, name)
+
+
+"""
+	Collects the run time of the sync phases, the calls to the Jenkins backend
+	with the bytes sent and received, and latency histograms of backend calls
+	and job operations. Thread-safe, one instance can be shared by syncs.
+"""
+class Metrics(object):
+
+	def __init__(self):
+		self._lock = threading.Lock()
+
+		# phase -> [runs, seconds]
+		self._phases = {}
+		# backend method -> [calls, errors]
+		self._calls = {}
+		self._bytes = {"sent": 0, "received": 0}
+		# (kind, name) -> [bucket counts, count, sum of seconds]
+		self._histograms = {}
+
+	# Get a context manager measuring the wall time of a phase
+	def span(self, phase):
+		return _MetricsSpan(self, phase)
+
+	def add_phase(self, phase, seconds):
+		with self._lock:
+			entry = self._phases.setdefault(phase, [0, 0.0])
+			entry[0] += 1
+			entry[1] += seconds
+
+	def add_call(self, method, seconds, error, sent, received):
+		with self._lock:
+			entry = self._calls.setdefault(method, [0, 0])
+			entry[0] += 1
+			entry[1] += 1 if error else 0
+			self._bytes["sent"] += sent
+			self._bytes["received"] += received
+
+		self.observe("backend", method, seconds)
+
+	# Add a latency to the histogram of a backend call or job operation
+	def observe(self, kind, name, seconds):
+		with self._lock:
+			entry = self._histograms.setdefault((kind, name), [[0] * len(LATENCY_BUCKETS), 0, 0.0])
+
+			for i, bound in enumerate(LATENCY_BUCKETS):
+				if seconds <= bound:
+					entry[0][i] += 1
+
+			entry[1] += 1
+			entry[2] += seconds
+
+	# Get all metrics as a dict that can be dumped as JSON
+	def get_report(self):
+		with self._lock:
+			return {
+				"time": time.time(),
+				"phases": dict([(phase, {"runs": x[0], "seconds": x[1]}) for phase, x in self._phases.iteritems()]),
+				"backend_calls": dict([(method, {"calls": x[0], "errors": x[1]}) for method, x in self._calls.iteritems()]),
+				"backend_bytes": dict(self._bytes),
+				"latencies": dict([("%s.%s" % key, {
+					"buckets": [[bound, count] for bound, count in zip(LATENCY_BUCKETS, x[0])],
+					"count": x[1],
+					"sum": x[2]
+				}) for key, x in self._histograms.iteritems()])
+			}
+
+	# Get all metrics in the Prometheus text format
+	def get_prometheus_text(self):
+		with self._lock:
+			lines = [
+				"# TYPE syncgit_last_run_timestamp_seconds gauge",
+				"syncgit_last_run_timestamp_seconds %f" % time.time(),
+				"# TYPE syncgit_phase_seconds_total counter",
+				"# TYPE syncgit_phase_runs_total counter"
+			]
+
+			for phase in sorted(self._phases.keys()):
+				lines.append('syncgit_phase_seconds_total{phase="%s"} %f' % (phase, self._phases[phase][1]))
+				lines.append('syncgit_phase_runs_total{phase="%s"} %d' % (phase, self._phases[phase][0]))
+
+			lines += ["# TYPE syncgit_backend_calls_total counter", "# TYPE syncgit_backend_errors_total counter"]
+
+			for method in sorted(self._calls.keys()):
+				lines.append('syncgit_backend_calls_total{method="%s"} %d' % (method, self._calls[method][0]))
+				lines.append('syncgit_backend_errors_total{method="%s"} %d' % (method, self._calls[method][1]))
+
+			lines.append("# TYPE syncgit_backend_bytes_total counter")
+
+			for direction in sorted(self._bytes.keys()):
+				lines.append('syncgit_backend_bytes_total{direction="%s"} %d' % (direction, self._bytes[direction]))
+
+			for kind, label in [("backend", "method"), ("operation", "operation")]:
+				metric = "syncgit_%s_duration_seconds" % kind
+				lines.append("# TYPE %s histogram" % metric)
+
+				for (entry_kind, name), (buckets, count, total) in sorted(self._histograms.items()):
+					if entry_kind != kind:
+						continue
+
+					for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+						lines.append('%s_bucket{%s="%s",le="%s"} %d' % (metric, label, name, bound, bucket_count))
+
+					lines.append('%s_bucket{%s="%s",le="+Inf"} %d' % (metric, label, name, count))
+					lines.append('%s_sum{%s="%s"} %f' % (metric, label, name, total))
+					lines.append('%s_count{%s="%s"} %d' % (metric, label, name, count))
+
+			return "\n".join(lines) + "\n"
+
+	"""
+	Write the metrics to "path", as JSON if it ends with ".json", in the
+	Prometheus text format (for the textfile collector) otherwise. The file is
+	replaced atomically.
+	"""
+	def write(self, path):
+		if path.endswith(".json"):
+			_save_state(path, self.get_report())
+			return
+
+		with open(path + ".tmp", "w") as f:
+			f.write(self.get_prometheus_text())
+
+		os.rename(path + ".tmp", path)
+
+
+# Measures the wall time of a phase, see Metrics.span()
+class _MetricsSpan(object):
+
+	def __init__(self, metrics, phase):
+		self._metrics = metrics
+		self._phase = phase
+
+	def __enter__(self):
+		self._start = time.time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._metrics.add_phase(self._phase, time.time() - self._start)
+		return False
+
+
+# Size of the strings in a backend call argument or result
+def _payload_size(value):
+	if isinstance(value, basestring):
+		return len(value)
+	elif isinstance(value, (list, tuple)):
+		return sum([_payload_size(x) for x in value])
+
+	return 0
+
+
+"""
+	Wraps a Jenkins backend and records its calls in a Metrics instance.
+	Provides only what the backend provides.
+"""
+class InstrumentedJenkinsBackend(object):
+
+	def __init__(self, backend, metrics):
+		self._backend = backend
+		self._metrics = metrics
+
+	def __getattr__(self, name):
+		method = getattr(self._backend, name)
+
+		# like lists_folders
+		if not callable(method):
+			return method
+
+		def instrumented(*args):
+			start = time.time()
+			error = True
+
+			try:
+				result = method(*args)
+				error = False
+			finally:
+				self._metrics.add_call(name, time.time() - start, error, _payload_size(args), 0 if error else _payload_size(result))
+
+			return result
+
+		return instrumented
+
+
+"""
+	Limits the number of concurrent job operations, adapting the limit to
+	the load of Jenkins (AIMD): the limit is raised by one after "limit"
+	operations in a row took less than "target_latency" seconds, it is
+	halved on a failed or slower operation or if the build queue is longer
+	than "max_queue_length". The limit stays within min_workers and
+	max_workers. "queue_length" is called for the queue length (at most
+	every QUEUE_CHECK_INTERVAL seconds), None if it can not be told.
+"""
+class AdaptiveThrottle(object):
+
+	def __init__(self, min_workers, max_workers, target_latency, max_queue_length=None, queue_length=None):
+		self._min_workers = min_workers
+		self._max_workers = max_workers
+		self._target_latency = target_latency
+		self._max_queue_length = max_queue_length
+		self._queue_length = queue_length
+
+		self._limit = min_workers
+		self._active = 0
+		self._condition = threading.Condition()
+
+		# operations in a row within the target latency
+		self._succeeded = 0
+		# increased on each decrease, operations started before do not
+		# lower the limit again
+		self._generation = 0
+		self._queue_checked = None
+		self._queue_too_long = False
+
+		# for the report of the effective rate
+		self._started = None
+		self._operations = 0
+		self._busy = 0.0
+		self._lowest = self._highest = min_workers
+
+	# Wait for a free slot, call before each operation. Returns a token to
+	# pass to release().
+	def acquire(self):
+		with self._condition:
+			while self._active >= self._limit:
+				self._condition.wait()
+
+			if self._started is None:
+				self._started = time.time()
+
+			self._active += 1
+
+			return self._generation
+
+	# Release the slot of an operation and adapt the limit to how it went
+	def release(self, token, seconds, error):
+		overloaded = error or seconds > self._target_latency or self._check_queue()
+
+		with self._condition:
+			self._active -= 1
+			self._operations += 1
+			self._busy += seconds
+
+			if overloaded:
+				self._succeeded = 0
+
+				if token == self._generation:
+					self._generation += 1
+					self._set_limit(max(self._min_workers, self._limit / 2))
+			else:
+				self._succeeded += 1
+
+				if self._succeeded >= self._limit and self._limit < self._max_workers:
+					self._succeeded = 0
+					self._set_limit(self._limit + 1)
+
+			self._condition.notify_all()
+
+	def _set_limit(self, limit):
+		self._limit = limit
+		self._lowest = min(self._lowest, limit)
+		self._highest = max(self._highest, limit)
+
+	# Return True if the build queue is too long, asks at most every
+	# QUEUE_CHECK_INTERVAL seconds
+	def _check_queue(self):
+		if self._max_queue_length is None or self._queue_length is None:
+			return False
+
+		with self._condition:
+			if self._queue_checked is not None and time.time() - self._queue_checked < QUEUE_CHECK_INTERVAL:
+				return self._queue_too_long
+
+			self._queue_checked = time.time()
+
+		try:
+			length = self._queue_length()
+		except Exception as e:
+			print "Failed to get the build queue length: %s" % str(e)
+			length = None
+
+		self._queue_too_long = length is not None and length > self._max_queue_length
+
+		return self._queue_too_long
+
+	# Get the current concurrency limit
+	def get_limit(self):
+		return self._limit
+
+	# Describe the effective rate of the operations so far
+	def get_report(self):
+		if self._operations == 0:
+			return "No job operations throttled"
+
+		seconds = max(time.time() - self._started, 0.001)
+
+		return "%d job operation(s) in %.2fs, %.2f/s, %.1f concurrent on average, limit %d-%d (now %d)" % (
+			self._operations, seconds, self._operations / seconds, self._busy / seconds,
+			self._lowest, self._highest, self._limit
+		)
+
+
+# Characters per string literal of the batch script, Groovy rejects string
+# constants longer than 65535 bytes
+BATCH_LITERAL_SIZE=32768
+
+# Characters of the configs passed to one batch script, more jobs are
+# created with further scripts
+BATCH_SCRIPT_SIZE=1048576
+
+# Groovy script run by the jenkins-cli "groovy" command to remove and create
+# jobs in one go. Names and configs are passed base64 encoded, split into
+# lists of literals, one result line per job is printed: SYNCGIT <tab>
+# OK|FAILED <tab> operation <tab> job name <tab> milliseconds [<tab> error].
+BATCH_SCRIPT = """
+import jenkins.model.Jenkins
+
+def decode = { new String(it.join("").decodeBase64(), "UTF-8") }
+
+def run = { operation, name, closure ->
+	def start = System.currentTimeMillis()
+
+	try {
+		closure()
+		println "SYNCGIT\\tOK\\t${operation}\\t${name}\\t${System.currentTimeMillis() - start}"
+	} catch (e) {
+		println "SYNCGIT\\tFAILED\\t${operation}\\t${name}\\t${System.currentTimeMillis() - start}\\t${e.toString().replaceAll(/\\s+/, ' ')}"
+	}
+}
+
+// the folder of the jobs, the top level if not in a folder
+def parent = %(parent)s
+
+for (name in [%(remove)s].collect(decode)) {
+	run("remove", name) {
+		def job = parent?.getItem(name)
+
+		if (job == null) {
+			throw new IllegalArgumentException("No such job: " + name)
+		}
+
+		job.delete()
+	}
+}
+
+for (job in [%(create)s].collect { [decode(it[0]), decode(it[1])] }) {
+	run("create", job[0]) {
+		if (parent == null) {
+			throw new IllegalArgumentException("No such folder")
+		}
+
+		def created = parent.createProjectFromXML(job[0], new ByteArrayInputStream(job[1].getBytes("UTF-8")))
+		created.makeDisabled(false)
+	}
+}
+"""
+
+
+# Groovy list of string literals of at most BATCH_LITERAL_SIZE characters
+# for a base64 value, joined by the batch script
+def _groovy_literals(value):
+	chunks = [value[i:i + BATCH_LITERAL_SIZE] for i in range(0, len(value), BATCH_LITERAL_SIZE)]
+
+	return "[%s]" % ", ".join(["'%s'" % x for x in chunks or [""]])
+
+
+# Groovy script listing the items of a folder, one "SYNCGIT <tab> name" line
+# per item. The folder name is passed base64 encoded.
+FOLDER_LIST_SCRIPT = """
+import jenkins.model.Jenkins
+
+def folder = Jenkins.instance.getItemByFullName(new String("%(folder)s".decodeBase64(), "UTF-8"))
+
+if (folder == null) {
+	throw new IllegalArgumentException("No such folder")
+}
+
+for (item in folder.items) {
+	println "SYNCGIT\t" + item.name
+}
+"""
+
+
+# Groovy script disabling a job, for backends that can not disable jobs. The
+# job name is passed base64 encoded.
+DISABLE_SCRIPT = """
+import jenkins.model.Jenkins
+
+def job = Jenkins.instance.getItemByFullName(new String("%(job)s".decodeBase64(), "UTF-8"))
+
+if (job == null) {
+	throw new IllegalArgumentException("No such job")
+}
+
+job.disable()
+"""
+
+
+# Groovy script replacing the config of a job, for backends that can not
+# update jobs. Job name and config are passed like to BATCH_SCRIPT.
+UPDATE_SCRIPT = """
+import jenkins.model.Jenkins
+import javax.xml.transform.stream.StreamSource
+
+def job = Jenkins.instance.getItemByFullName(new String(%(job)s.join("").decodeBase64(), "UTF-8"))
+
+if (job == null) {
+	throw new IllegalArgumentException("No such job")
+}
+
+job.updateByXml(new StreamSource(new ByteArrayInputStream(%(config)s.join("").decodeBase64())))
+"""
+
+
+# Elements whose "branches" hold the Git branch specs: the SCM of freestyle
+# and pipeline jobs and the Git SCMs inside a multiple SCMs block
+BRANCH_SPEC_SCM_TAGS = ("scm", "hudson.plugins.git.GitSCM")
+
+
+# Check if the path of tag names from the root is the one of a branch spec name
+def _is_branch_spec_name(path):
+	return (len(path) > 4
+		and path[-3:] == ["branches", "hudson.plugins.git.BranchSpec", "name"]
+		and path[-4] in BRANCH_SPEC_SCM_TAGS)
+
+
+# Serialize a job config in a form that does not change with formatting.
+# Whitespace between elements, the XML declaration and the attribute order
+# are dropped. So is "disabled": the template is usually disabled, the jobs
+# created from it are enabled.
+def _normalize_config(config):
+	root = ET.fromstring(config)
+
+	for element in root.findall("disabled"):
+		root.remove(element)
+
+	for element in root.iter() if hasattr(root, "iter") else root.getiterator():
+		if element.text is not None and element.text.strip() == "":
+			element.text = None
+		if element.tail is not None and element.tail.strip() == "":
+			element.tail = None
+
+	return ET.tostring(root)
+
+
+# Hash of a job config that does not change with formatting
+def _config_hash(config):
+	return hashlib.sha1(_normalize_config(config)).hexdigest()
+
+
+# Get the text of the "disabled" element of a job config ("true" or
+# "false"), None if there is none. Parsed only up to that element.
+def _get_disabled(config):
+	if isinstance(config, unicode):
+		config = config.encode("utf-8")
+
+	depth = 0
+
+	for event, element in ET.iterparse(StringIO.StringIO(config), events=("start", "end")):
+		if event == "start":
+			depth += 1
+			continue
+
+		if depth == 2 and element.tag == "disabled":
+			return (element.text or "").strip()
+
+		depth -= 1
+		element.clear()
+
+	return None
+
+
+# Matches a start tag, attribute values may contain ">"
+START_TAG_RE = re.compile(r'''<[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>''')
+
+
+# Escape a value for the text of an element. Non ASCII characters are written
+# as character references, like ET.tostring does, so values can be spliced
+# into configs of any encoding.
+def _escape_text(value):
+	if not isinstance(value, unicode):
+		value = value.decode("utf-8")
+
+	value = value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+	return value.encode("ascii", "xmlcharrefreplace")
+
+
+"""
+	A job config template compiled for rendering. The positions of the
+	replaceable element texts are located once, rendering splices the escaped
+	values into the original config. Everything else of the template is kept
+	byte by byte, rendering does not parse or serialize XML.
+
+	Fields:
+	  branch          -- name of the first Git branch spec (required)
+	  disabled        -- "true" if the job is disabled
+	  displayName     -- display name of the job
+	  description     -- description of the job
+	  parameter:NAME  -- default value of the build parameter NAME
+
+	config -- the template config (str)
+"""
+class ConfigTemplate(object):
+
+	def __init__(self, config):
+		if isinstance(config, unicode):
+			config = config.encode("utf-8")
+
+		self._config = config
+
+		# field -> (start, end, tag) of the text, or of the whole element if
+		# it is an empty element tag (end is negative then)
+		self._spans = {}
+
+		path = []
+		starts = []
+		parameter = {}
+
+		def start_element(name, attributes):
+			path.append(name)
+			starts.append(parser.CurrentByteIndex)
+
+			if len(path) > 2 and path[-3] == "parameterDefinitions" and name in ("name", "defaultValue"):
+				parameter[name] = ""
+
+		def character_data(data):
+			if len(path) > 2 and path[-3] == "parameterDefinitions" and path[-1] == "name":
+				parameter["name"] += data
+
+		def end_element(name):
+			start = starts.pop()
+			field = None
+
+			if _is_branch_spec_name(path):
+				field = "branch"
+			elif len(path) == 2 and name in ("disabled", "displayName", "description"):
+				field = name
+			elif len(path) > 2 and path[-3] == "parameterDefinitions" and name == "defaultValue":
+				parameter["span"] = self._get_span(start, parser.CurrentByteIndex, name)
+			elif len(path) > 1 and path[-2] == "parameterDefinitions":
+				if "name" in parameter and "span" in parameter:
+					self._spans.setdefault("parameter:" + parameter["name"], parameter["span"])
+
+				parameter.clear()
+
+			if field is not None and field not in self._spans:
+				self._spans[field] = self._get_span(start, parser.CurrentByteIndex, name)
+
+			path.pop()
+
+		parser = xml.parsers.expat.ParserCreate()
+		parser.StartElementHandler = start_element
+		parser.EndElementHandler = end_element
+		parser.CharacterDataHandler = character_data
+		parser.Parse(config, True)
+
+		if "branch" not in self._spans:
+			raise Exception("Missing Git branch spec config in config template (%s)" % " or ".join(["%s/branches/hudson.plugins.git.BranchSpec/name" % tag for tag in BRANCH_SPEC_SCM_TAGS]))
+
+		self._ordered = sorted([(span, field) for field, span in self._spans.iteritems()])
+
+	# Get the span of an element's text from the byte offsets of its start
+	# and end tag
+	def _get_span(self, start, end, tag):
+		start_tag = START_TAG_RE.match(self._config, start)
+
+		if start_tag.group(0).endswith("/>"):
+			return (start, -start_tag.end(), tag)
+
+		return (start_tag.end(), end, tag)
+
+	# Get the names of the fields found in the template
+	def get_fields(self):
+		return sorted(self._spans.keys())
+
+	# Render a config, values is a dict of field -> value. Fields without a
+	# value keep the text of the template.
+	def render(self, values):
+		parts = []
+		position = 0
+
+		for (start, end, tag), field in self._ordered:
+			if field not in values:
+				continue
+
+			parts.append(self._config[position:start])
+
+			if end < 0:
+				# empty element tag, like <description/>
+				parts.append("<%s>%s</%s>" % (tag, _escape_text(values[field]), tag))
+				position = -end
+			else:
+				parts.append(_escape_text(values[field]))
+				position = end
+
+		parts.append(self._config[position:])
+
+		return "".join(parts)
+
+
+# Replace the characters not allowed in job names (and file names) by "-"
+def _sanitize_name(name):
+	# Python 2.6 does not support flags=..., using (?i)
+	return re.sub("(?i)[^a-z0-9_-]+", "-", name)
+
+
+"""
+	Maps Git ref names to job names and back. The job name template is
+	compiled once; job names are memoized. Refs indexed with index() can be
+	looked up by their job name, refs whose names sanitize to the same job
+	name (like "dev/a.b" and "dev/a+b") are reported as collisions and are
+	not mapped.
+
+	job_name_tpl -- job name template with one "%s"
+"""
+class JobNameIndex(object):
+
+	def __init__(self, job_name_tpl):
+		self._job_name_tpl = job_name_tpl
+
+		prefix, suffix = (job_name_tpl % "\0").split("\0")
+
+		# only names built by get_job_name(), the template text is literal
+		self._matcher = re.compile("^%s[a-zA-Z0-9_-]+%s$" % (re.escape(prefix), re.escape(suffix)))
+
+		# ref name -> job name
+		self._job_names = {}
+		# job name -> ref (refs/remotes/...) of the last index()
+		self._refs = {}
+		# job name -> refs, for job names shared by more than one ref
+		self._collisions = {}
+
+	# Build the job name for a Git ref name (without "refs/remotes/")
+	def get_job_name(self, ref_name):
+		if ref_name not in self._job_names:
+			# replace slashes in ref name to  get clean job name and build job name
+			filtered_ref_name = _sanitize_name(ref_name.replace("origin/", ""))
+			self._job_names[ref_name] = self._job_name_tpl % filtered_ref_name
+
+		return self._job_names[ref_name]
+
+	# Check if a job name could have been built from the template
+	def matches(self, job_name):
+		return self._matcher.match(job_name) is not None
+
+	"""
+	Index refs (refs/remotes/...) by their job names, replacing the refs of
+	the last call. Returns the collisions, a dict of job name -> sorted refs.
+	"""
+	def index(self, refs):
+		refs_by_job = {}
+
+		for ref in refs:
+			refs_by_job.setdefault(self.get_job_name(ref.replace("refs/remotes/", "")), []).append(ref)
+
+		self._refs = dict([(job, job_refs[0]) for job, job_refs in refs_by_job.iteritems() if len(job_refs) == 1])
+		self._collisions = dict([(job, sorted(job_refs)) for job, job_refs in refs_by_job.iteritems() if len(job_refs) > 1])
+
+		return self._collisions
+
+	# Get the indexed ref of a job name, None if there is none or more than one
+	def get_ref(self, job_name):
+		return self._refs.get(job_name)
+
 
 class Jenkins(object):
 
-	"""
-		Jenkins job management.
+	"""
+		Jenkins job management.
+
+		- job_tpl -- the exact job name used as a template (this job might/should be disabled)
+		- job_name_tpl -- the resulting job name, has to contain one "%s" placeholder that will be replaced with the sanitized branch name
+		- discovery_workers -- number of job configs read in parallel
+		- cache_file -- path of the job cache, no cache is used if None
+		- full_refresh_interval -- hours after which all cached job configs are read again
+		- backend -- BACKEND_CLI to use the jenkins-cli, BACKEND_HTTP to use the remote API
+		- http_user, http_token -- credentials for the remote API
+		- connection -- existing backend object to use instead of creating one, like a SharedJenkinsBackend
+		- shard -- (index, count) to sync only the jobs of one shard, see _get_shard()
+		- hash_configs -- hash the configs read during discovery, for update_drifted_jobs()
+	"""
+	def __init__(self, host, cli_jar, ssh_key, job_tpl, job_name_tpl, discovery_workers=DEFAULT_DISCOVERY_WORKERS,
+			cache_file=None, full_refresh_interval=DEFAULT_FULL_REFRESH_INTERVAL,
+			backend=BACKEND_CLI, http_user=None, http_token=None, connection=None, metrics=None, job_folder=None, shard=None,
+			hash_configs=False):
+		if connection is not None:
+			self._jenkins = connection
+		else:
+			self._jenkins = _create_backend(backend, host, cli_jar, ssh_key, http_user, http_token)
+
+		if metrics is not None:
+			self._jenkins = InstrumentedJenkinsBackend(self._jenkins, metrics)
+
+		self._metrics = metrics if metrics is not None else Metrics()
+
+		# needed to run the jenkins-cli directly for batch scripts
+		self._host = host
+		self._cli_jar = cli_jar
+		self._ssh_key = ssh_key
+
+		self._job_template = job_tpl
+		self._job_name_tpl = job_name_tpl
+		# full name of the folder the branch jobs are in, None for the top level
+		self._job_folder = job_folder
+		self._job_names = JobNameIndex(job_name_tpl)
+		# (index, count) of the shard whose jobs are synced, None for all jobs
+		self._shard = shard
+		self._discovery_workers = discovery_workers
+		self._hash_configs = hash_configs
+		self._cache_file = cache_file
+		self._full_refresh_interval = full_refresh_interval
+
+		# time of the last discovery that read all job configs
+		self._last_full_refresh = None
+
+		# job names whose config could not be read during discovery
+		self._discovery_failures = set()
+
+		# job name -> (branch name as configured, config hash) of the last
+		# discovery, the hash is None until determined by update_drifted_jobs()
+		# unless configs are hashed during discovery
+		self._configured_jobs = {}
+
+		# parsed template config, loaded once per sync
+		self._template = None
+		self._hash_template = None
+		# jobs are created by several threads
+		self._template_lock = threading.Lock()
+
+		# True if the job mapping contains all jobs (after a discovery)
+		self._mapping_complete = False
+		# True if the job mapping has been loaded from the job cache
+		self._mapping_loaded = False
+
+	# Get the full name of a branch job, the job names of the mapping are the
+	# names within the job folder
+	def _full_name(self, job_name):
+		if self._job_folder is None:
+			return job_name
+
+		return self._job_folder + "/" + job_name
+
+	# Get the job mapping entry of a config read during discovery. It is hashed
+	# only if drifted jobs are updated, that parses the whole config; reading
+	# it again for that would take another call.
+	def _mapping_entry(self, branch_name, config):
+		return (branch_name, _config_hash(config) if self._hash_configs else None)
+
+	# Read the config of a branch job
+	def _get_job(self, job_name):
+		return self._jenkins.get_job(self._full_name(job_name))
+
+	# List the names of the jobs in the job folder, with the jenkins-cli if the
+	# backend can not list folders
+	def _get_joblist(self):
+		if self._job_folder is None:
+			return self._jenkins.get_joblist()
+
+		if getattr(self._jenkins, "lists_folders", False):
+			return self._jenkins.get_joblist(self._job_folder)
+
+		output = self._run_groovy(FOLDER_LIST_SCRIPT % {"folder": base64.b64encode(self._job_folder)})
+
+		return [line.split("\t", 1)[1] for line in output.splitlines() if line.startswith("SYNCGIT\t")]
+
+	"""
+	Index refs (refs/remotes/...) by job name, returns the refs that share
+	their job name with another ref. Jobs of those are neither created nor
+	found by their name during discovery.
+	"""
+	def index_job_names(self, refs):
+		collisions = self._job_names.index(refs)
+
+		for job in sorted(collisions.keys()):
+			print "Branches %s map to the same job '%s', skipping them" % (", ".join(collisions[job]), job)
+
+		return set([ref for job_refs in collisions.values() for ref in job_refs])
+
+
+	"""
+	Forget the loaded template config, it will be fetched again on next use.
+	Called at the beginning of each sync.
+	"""
+	def reset_template(self):
+		self._template = None
+		self._hash_template = None
+
+	# Get the compiled template config, fetch it only once
+	def _get_template(self):
+		with self._template_lock:
+			if self._template is None:
+				with self._metrics.span("template"):
+					config = self._jenkins.get_job(self._job_template)
+
+					# renders the normalized form of the configs, for their hash
+					self._hash_template = ConfigTemplate(_normalize_config(config))
+					self._template = ConfigTemplate(config)
+
+			return self._template
+
+	# Render the job config for a Git ref name from the template
+	def _render_config(self, ref_name):
+		return self._get_template().render({"branch": ref_name})
+
+	# Get the hash of the job config for a Git ref name, like _config_hash()
+	# of the rendered config but without parsing it
+	def _render_config_hash(self, ref_name):
+		self._get_template()
+
+		return hashlib.sha1(self._hash_template.render({"branch": ref_name})).hexdigest()
+
+	"""
+	Create Job for Git ref name. Raises SkippedJobException if the job might
+	exist, its config just could not be read.
+	"""
+	def create_job(self, ref_name):
+		job_name = self._job_names.get_job_name(ref_name)
+
+		if job_name in self._discovery_failures:
+			raise SkippedJobException("Skipped job '%s', its config could not be read" % job_name)
+
+		# load template and replace placeholder in config
+		config = self._render_config(ref_name)
+
+		print "Creating and enabling job '%s' for branch %s" % (job_name, ref_name)
+		self._jenkins.create_job(self._full_name(job_name), config)
+		self._jenkins.enable_job(self._full_name(job_name))
+
+		self._configured_jobs[job_name] = (ref_name, self._render_config_hash(ref_name))
+
+	"""
+	Update the config of all jobs from the last discovery whose config differs
+	from the rendered template. Only jobs configured for one of "branches"
+	(refs/remotes/...) are considered. Comparison is done on a hash of the
+	normalized config, unchanged jobs are not touched. Whether a job is
+	disabled is not compared, an updated job keeps its state.
+	"""
+	def update_drifted_jobs(self, branches):
+		for job in sorted(self._configured_jobs.keys()):
+			branch_name, config_hash = self._configured_jobs[job]
+
+			if self._normalize_branch(branch_name) not in branches:
+				continue
+
+			config = None
+
+			# not determined during discovery
+			if config_hash is None:
+				config = self._get_job(job)
+				config_hash = _config_hash(config)
+				self._configured_jobs[job] = (branch_name, config_hash)
+
+			# keep the branch name exactly as configured in the job
+			if self._render_config_hash(branch_name) == config_hash:
+				continue
+
+			# the job's state is needed to keep it
+			if config is None:
+				config = self._get_job(job)
+
+			disabled = _get_disabled(config) == "true"
+			values = {"branch": branch_name}
+
+			if "disabled" in self._get_template().get_fields():
+				values["disabled"] = "true" if disabled else "false"
+
+			print "Updating job '%s' for branch %s, its config differs from the template" % (job, branch_name)
+			self._update_job(job, self._get_template().render(values))
+
+			# without the element in the template the job ends up enabled
+			if disabled and "disabled" not in values:
+				self._disable_job(job)
+
+			self._configured_jobs[job] = (branch_name, self._render_config_hash(branch_name))
+
+	"""
+	Remove Job by Git ref name
+	"""
+	def remove_job(self, ref_name):
+		job_name = self._job_names.get_job_name(ref_name)
+
+		print "Removing job '%s' for branch '%s'" % (job_name, ref_name)
+		self._jenkins.delete_job(self._full_name(job_name))
+
+		self._configured_jobs.pop(job_name, None)
+
+	"""
+	Disable the job of a Git ref name instead of removing it, it is kept
+	with its builds to be enabled again by reuse_job().
+	"""
+	def disable_job(self, ref_name):
+		job_name = self._job_names.get_job_name(ref_name)
+
+		print "Disabling job '%s' for branch '%s'" % (job_name, ref_name)
+		self._disable_job(job_name)
+
+	# Replace the config of a branch job, with a Groovy script if the backend
+	# can not
+	def _update_job(self, job_name, config):
+		if hasattr(self._jenkins, "update_job"):
+			self._jenkins.update_job(self._full_name(job_name), config)
+		else:
+			self._run_groovy(UPDATE_SCRIPT % {
+				"job": _groovy_literals(base64.b64encode(self._full_name(job_name))),
+				"config": _groovy_literals(base64.b64encode(config))
+			})
+
+	# Disable a branch job, with a Groovy script if the backend can not
+	def _disable_job(self, job_name):
+		if hasattr(self._jenkins, "disable_job"):
+			self._jenkins.disable_job(self._full_name(job_name))
+		else:
+			self._run_groovy(DISABLE_SCRIPT % {"job": base64.b64encode(self._full_name(job_name))})
+
+	"""
+	Enable the job of a Git ref name disabled by disable_job() again
+	"""
+	def reuse_job(self, ref_name):
+		job_name = self._job_names.get_job_name(ref_name)
+
+		print "Enabling job '%s' again for branch %s" % (job_name, ref_name)
+		self._jenkins.enable_job(self._full_name(job_name))
+
+	"""
+	Take over the job of a stale branch whose job name is the one of a Git
+	ref name: the config is replaced for the ref and the job is enabled.
+	"""
+	def reclaim_job(self, ref_name):
+		job_name = self._job_names.get_job_name(ref_name)
+
+		print "Reclaiming job '%s' of a stale branch for branch %s" % (job_name, ref_name)
+		self._update_job(job_name, self._render_config(ref_name))
+		self._jenkins.enable_job(self._full_name(job_name))
+
+		self._configured_jobs[job_name] = (ref_name, self._render_config_hash(ref_name))
+
+	# Run a Groovy script with the jenkins-cli, returns its output
+	def _run_groovy(self, script):
+		process = subprocess.Popen(
+			["java", "-jar", self._cli_jar, "-s", self._host, "-i", self._ssh_key, "groovy", "="],
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+		)
+
+		output, error_output = process.communicate(script)
+
+		if process.returncode != 0:
+			raise Exception("Groovy script failed with exit code %d: %s" % (process.returncode, error_output.strip()))
+
+		return output
+
+	"""
+	Remove and create the jobs for the given Git ref names with one
+	jenkins-cli call. The jobs are removed first, each job is created and
+	enabled. Returns a list of (operation name, ref name, exception, seconds)
+	tupels like GitJenkinsSync.sync().
+	"""
+	def run_batch(self, to_remove, to_create):
+		remove_jobs = []
+		create_jobs = []
+		refs = {}
+
+		for ref_name in to_remove:
+			job_name = self._job_names.get_job_name(ref_name)
+			print "Removing job '%s' for branch '%s'" % (job_name, ref_name)
+
+			remove_jobs.append(job_name)
+			refs[("remove", job_name)] = ref_name
+
+		configs = {}
+		reported = {}
+
+		for ref_name in to_create:
+			job_name = self._job_names.get_job_name(ref_name)
+			refs[("create", job_name)] = ref_name
+			create_jobs.append(job_name)
+
+			# the job might exist, its config just could not be read
+			if job_name in self._discovery_failures:
+				reported[("create", job_name)] = (SkippedJobException("Skipped job '%s', its config could not be read" % job_name), 0.0)
+				continue
+
+			print "Creating and enabling job '%s' for branch %s" % (job_name, ref_name)
+
+			configs[job_name] = base64.b64encode(self._render_config(ref_name))
+
+		if len(refs) == 0:
+			return []
+
+		if self._job_folder is None:
+			parent = "Jenkins.instance"
+		else:
+			parent = "Jenkins.instance.getItemByFullName(decode(%s))" % _groovy_literals(base64.b64encode(self._job_folder))
+
+		# the removals go with the first script, the creations are split by size
+		batches = [(remove_jobs, [])]
+
+		for job_name in [x for x in create_jobs if x in configs]:
+			if len(batches[-1][1]) > 0 and sum([len(configs[x]) for x in batches[-1][1]]) + len(configs[job_name]) > BATCH_SCRIPT_SIZE:
+				batches.append(([], []))
+
+			batches[-1][1].append(job_name)
+
+		for batch_remove, batch_create in batches:
+			if len(batch_remove) == 0 and len(batch_create) == 0:
+				continue
+
+			script = BATCH_SCRIPT % {
+				"parent": parent,
+				"remove": ", ".join([_groovy_literals(base64.b64encode(x)) for x in batch_remove]),
+				"create": ", ".join(["[%s, %s]" % (_groovy_literals(base64.b64encode(x)), _groovy_literals(configs[x])) for x in batch_create])
+			}
+
+			try:
+				output = self._run_groovy(script)
+			except Exception as e:
+				# none of the jobs is known to be done
+				for key in [("remove", x) for x in batch_remove] + [("create", x) for x in batch_create]:
+					reported[key] = (e, 0.0)
+
+				continue
+
+			for line in output.splitlines():
+				fields = line.split("\t")
+
+				if len(fields) < 5 or fields[0] != "SYNCGIT":
+					continue
+
+				key = (fields[2], fields[3])
+				error = None if fields[1] == "OK" else Exception(fields[5] if len(fields) > 5 else "unknown error")
+				reported[key] = (error, int(fields[4]) / 1000.0)
+
+				if error is None and key[0] == "create":
+					self._configured_jobs[key[1]] = (refs[key], self._render_config_hash(refs[key]))
+				elif error is None and key[0] == "remove":
+					self._configured_jobs.pop(key[1], None)
+
+		results = []
+
+		for key in [("remove", x) for x in remove_jobs] + [("create", x) for x in create_jobs]:
+			error, seconds = reported.get(key, (Exception("No result reported by the script"), 0.0))
+			results.append((key[0], refs[key], error, seconds))
+
+		return results
+
+	# Load the job mapping from the job cache once if there has been no
+	# discovery
+	def _load_job_cache(self):
+		if not self._mapping_complete and not self._mapping_loaded:
+			refreshed, self._configured_jobs = self._read_cache()
+			# an outdated cache stays outdated
+			self._last_full_refresh = refreshed
+			self._mapping_loaded = True
+
+	"""
+	Get the set of branches among "refs" (refs/remotes/...) that are
+	configured by jobs, without listing all jobs. The job mapping of the last
+	discovery is used, without one the job cache is used and the jobs not
+	found there are looked up by their name.
+	"""
+	def get_configured_branches_for(self, refs):
+		self._load_job_cache()
+
+		branches = set()
+		to_read = []
+
+		for ref in refs:
+			job = self._job_names.get_job_name(ref.replace("refs/remotes/", ""))
+
+			if job in self._configured_jobs:
+				if self._normalize_branch(self._configured_jobs[job][0]) == ref:
+					branches.add(ref)
+			elif not self._mapping_complete:
+				to_read.append(job)
+
+		for job, config, error in _parallel_map(self._get_job, to_read, self._discovery_workers):
+			# the job does not exist
+			if error is not None:
+				continue
+
+			branch_name = self._get_branch_from_config(config)
+
+			if branch_name is None:
+				continue
+
+			self._configured_jobs[job] = self._mapping_entry(branch_name, config)
+
+			if self._normalize_branch(branch_name) in refs:
+				branches.add(self._normalize_branch(branch_name))
+
+		return branches
+
+	"""
+	Look up the jobs named after the given refs (refs/remotes/...) without
+	listing all jobs, for checking a few jobs cheaply. Returns a dict of ref
+	-> branch (refs/remotes/...) the job is configured for, None if its
+	config has no Git branch spec. Refs without a job are left out.
+	"""
+	def get_jobs_of(self, refs):
+		self._load_job_cache()
+
+		jobs = dict([(self._job_names.get_job_name(ref.replace("refs/remotes/", "")), ref) for ref in refs])
+		found = {}
+
+		for job, config, error in _parallel_map(self._get_job, sorted(jobs.keys()), self._discovery_workers):
+			# the job does not exist
+			if error is not None:
+				self._configured_jobs.pop(job, None)
+				continue
+
+			branch_name = self._get_branch_from_config(config)
+
+			if branch_name is None:
+				found[jobs[job]] = None
+				continue
+
+			self._configured_jobs[job] = self._mapping_entry(branch_name, config)
+			found[jobs[job]] = self._normalize_branch(branch_name)
+
+		return found
+
+	# Return True if the config of the job could not be read by the last
+	# discovery
+	def is_discovery_failure(self, job_name):
+		return job_name in self._discovery_failures
+
+	# Get the job name -> branch name (as configured) of the job mapping
+	def get_job_mapping(self):
+		return dict([(job, entry[0]) for job, entry in self._configured_jobs.iteritems()])
+
+	# Get the length of the build queue, None if the backend can not tell
+	def get_queue_length(self):
+		if not hasattr(self._jenkins, "get_queue_length"):
+			return None
+
+		return self._jenkins.get_queue_length()
+
+	# Return True if the job belongs to the shard being synced
+	def in_shard(self, job_name):
+		return self._shard is None or _get_shard(job_name, self._shard[1]) == self._shard[0]
+
+	# Get the name of the job for a ref (refs/remotes/...)
+	def get_job_name(self, ref):
+		return self._job_names.get_job_name(ref.replace("refs/remotes/", ""))
+
+	# Get the job name template
+	def get_job_name_tpl(self):
+		return self._job_name_tpl
+
+	# Get the full name of the job folder, None for the top level
+	def get_job_folder(self):
+		return self._job_folder
+
+	# Get full ref name for a branch name as configured in a job
+	def _normalize_branch(self, branch_name):
+		if not re.match("^refs/remotes/", branch_name):
+			branch_name = "refs/remotes/" + branch_name
+
+		return branch_name
+
+	# Get the branch of the first branch spec from one Job's config, None if
+	# there is none. The config is parsed only up to the branch spec, elements
+	# already parsed are cleared to not keep large inline scripts around.
+	def _get_branch_from_config(self, config):
+		if isinstance(config, unicode):
+			config = config.encode("utf-8")
+
+		path = []
+
+		for event, element in ET.iterparse(StringIO.StringIO(config), events=("start", "end")):
+			if event == "start":
+				path.append(element.tag)
+				continue
+
+			if _is_branch_spec_name(path):
+				return element.text
+
+			path.pop()
+			element.clear()
+
+		return None
+
+	# Read the job cache. Returns the time of its last full refresh and the
+	# job name -> (branch name, config hash) mapping, (None, {}) if there is
+	# no usable cache.
+	def _read_cache(self):
+		if self._cache_file is None:
+			return (None, {})
+
+		cache = _load_state(self._cache_file)
+
+		if cache is None or cache.get("job_name_tpl") != self._job_name_tpl or cache.get("job_folder") != self._job_folder:
+			return (None, {})
+
+		jobs = dict([(job, tuple(entry)) for job, entry in cache["jobs"].iteritems()])
+
+		# the cached hashes would all differ, the branches are still right
+		if cache.get("config_hash_version") != CONFIG_HASH_VERSION:
+			jobs = dict([(job, (entry[0], None)) for job, entry in jobs.iteritems()])
+
+		return (cache["refreshed"], jobs)
+
+	# Get the cached job name -> (branch name, config hash) mapping. Returns an
+	# empty mapping if there is no cache or a full refresh is due.
+	def _load_cache(self):
+		now = time.time()
+
+		if self._cache_file is None:
+			self._last_full_refresh = now
+			return {}
+
+		refreshed, jobs = self._read_cache()
+
+		if refreshed is None:
+			print "No usable job cache, reading all job configs"
+			self._last_full_refresh = now
+			return {}
+
+		if now - refreshed > self._full_refresh_interval * 60 * 60:
+			print "Job cache is older than %d hours, reading all job configs" % self._full_refresh_interval
+			self._last_full_refresh = now
+			return {}
+
+		self._last_full_refresh = refreshed
+
+		return jobs
+
+	"""
+	Write the job mapping of the last discovery including the jobs created
+	and removed since then to the job cache.
+	"""
+	def save_cache(self):
+		if self._cache_file is None or self._last_full_refresh is None:
+			return
+
+		_save_state(self._cache_file, {
+			"job_name_tpl": self._job_name_tpl,
+			"job_folder": self._job_folder,
+			"config_hash_version": CONFIG_HASH_VERSION,
+			"refreshed": self._last_full_refresh,
+			"jobs": dict([(job, list(entry)) for job, entry in self._configured_jobs.iteritems()])
+		})
+
+	"""
+	Get all branches that are configured by Jobs.
+	Examines each Job in the list for their branch names, the configs are
+	read by up to "discovery_workers" parallel calls. Jobs found in the job
+	cache are not read again until the next full refresh.
+	If the backend can list the branch specs of all jobs at once (remote
+	API), only the configs of jobs whose SCM is not exposed that way are read.
+	If "by_name" is True, jobs named like a ref of the last index_job_names()
+	are taken to be configured for that ref without reading their config.
+	With a shard only the jobs of the shard are looked at.
+	"""
+	def get_currently_configured_branches(self, by_name=False):
+		if hasattr(self._jenkins, "get_job_branches"):
+			bulk_branches = self._jenkins.get_job_branches(self._job_folder) if self._job_folder is not None else self._jenkins.get_job_branches()
+			bulk_branches = [x for x in bulk_branches if self._job_names.matches(x[0]) and self.in_shard(x[0])]
+			jobs = [x[0] for x in bulk_branches]
+			bulk_branches = dict(bulk_branches)
+		else:
+			bulk_branches = {}
+			jobs = [job for job in self._get_joblist() if self._job_names.matches(job) and self.in_shard(job)]
+
+		cached = self._load_cache()
+
+		self._discovery_failures = set()
+		self._configured_jobs = {}
+
+		# jobs no longer in the job list are dropped from the cache
+		to_read = []
+		for job in jobs:
+			if job in cached:
+				self._configured_jobs[job] = cached[job]
+			elif by_name and self._job_names.get_ref(job) is not None:
+				# the config hash is determined when needed
+				self._configured_jobs[job] = (self._job_names.get_ref(job).replace("refs/remotes/", ""), None)
+			elif not bulk_branches.get(job):
+				# SCM not exposed or without branches (like multiple SCMs)
+				to_read.append(job)
+			else:
+				# the config hash is determined when needed
+				self._configured_jobs[job] = (bulk_branches[job][0], None)
+
+		if self._cache_file is not None:
+			print "Reading %d of %d job configs" % (len(to_read), len(jobs))
+
+		for job, config, error in _parallel_map(self._get_job, to_read, self._discovery_workers):
+			if error is not None:
+				print "Failed to read config of job '%s': %s" % (job, str(error))
+				self._discovery_failures.add(job)
+				continue
+
+			branch_name = self._get_branch_from_config(config)
+
+			if branch_name is None:
+				print "No Git branch spec found in config of job '%s'" % job
+				continue
+
+			self._configured_jobs[job] = self._mapping_entry(branch_name, config)
+
+		if len(self._discovery_failures) > 0:
+			print "Could not read the config of %d job(s):\n  %s" % (len(self._discovery_failures), "\n  ".join(sorted(self._discovery_failures)))
+
+		self._mapping_complete = True
+
+		# results are in job list order, regardless of the completion order
+		return [self._normalize_branch(self._configured_jobs[job][0]) for job in jobs if job in self._configured_jobs]
+
+# Get the literal text every match of the regular expression starts with,
+# like "refs/remotes/origin/" for "^refs/remotes/origin/(dev|int)/.*".
+# Returns "" if there is none (alternation at the top, case insensitive, ...).
+def _get_literal_prefix(regex):
+	parsed = sre_parse.parse(regex)
+
+	if parsed.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE:
+		return ""
+
+	prefix = []
+
+	for op, value in parsed:
+		if op == sre_constants.AT and value in (sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING):
+			continue
+
+		if op != sre_constants.LITERAL:
+			break
+
+		prefix.append(unichr(value) if value > 127 else chr(value))
+
+	return "".join(prefix)
+
+
+"""
+	Reads commit times from a Git commit-graph file (objects/info/commit-graph)
+	without inflating commit objects. The file is memory mapped, commits are
+	found by binary search over the sorted object IDs. Only single file
+	commit-graphs with SHA1 IDs are supported, not split commit-graph chains.
+
+	path -- path of the commit-graph file
+"""
+class CommitGraph(object):
+
+	def __init__(self, path):
+		with open(path, "rb") as f:
+			self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+		signature, version, hash_version, chunk_count = struct.unpack(">4sBBB", self._data[0:7])
+
+		if signature != "CGPH" or version != 1 or hash_version != 1:
+			self.close()
+			raise ValueError("Unsupported commit-graph file: " + path)
+
+		chunks = {}
+
+		# chunk lookup table after the 8 byte header, 12 bytes per chunk
+		for i in range(chunk_count):
+			chunk_id, offset = struct.unpack(">4sQ", self._data[8 + i * 12:8 + (i + 1) * 12])
+			chunks[chunk_id] = offset
+
+		for chunk_id in ["OIDF", "OIDL", "CDAT"]:
+			if chunk_id not in chunks:
+				self.close()
+				raise ValueError("Missing chunk %s in commit-graph file: %s" % (chunk_id, path))
+
+		self._fanout = struct.unpack(">256I", self._data[chunks["OIDF"]:chunks["OIDF"] + 256 * 4])
+		self._oid_lookup = chunks["OIDL"]
+		self._commit_data = chunks["CDAT"]
+
+	def close(self):
+		self._data.close()
+
+	# Get the commit time of a commit by its hex SHA1, None if it is not in the graph
+	def get_commit_time(self, sha1):
+		oid = binascii.unhexlify(sha1)
+		first_byte = ord(oid[0])
+
+		low = self._fanout[first_byte - 1] if first_byte > 0 else 0
+		high = self._fanout[first_byte]
+
+		while low < high:
+			middle = (low + high) // 2
+			position = self._oid_lookup + middle * 20
+			current = self._data[position:position + 20]
+
+			if current < oid:
+				low = middle + 1
+			elif current > oid:
+				high = middle
+			else:
+				# tree ID and two parent positions, then generation and commit time
+				position = self._commit_data + middle * 36 + 28
+				upper, lower = struct.unpack(">II", self._data[position:position + 8])
+
+				# the lowest two bits of the first word are bits 33 and 34 of the time
+				return ((upper & 0x3) << 32) | lower
+
+		return None
+
+
+"""
+Represents branches in Git
+"""
+class GitBranches(object):
+
+	"""
+		Git branch management.
+
+		repo -- Repository location (relative or absolute paths)
+		ref_matcher -- A regular expression that matches branch names to create jobs for
+		max_commit_age -- Max days the last commit was made to a branch
+		cache_file -- path of the ref cache, no cache is used if None
+		ref_filter -- function returning False for matching refs to leave out, like the refs of other shards
+	"""
+	def __init__(self, repo, ref_matcher, max_commit_age, cache_file=None, ref_filter=None):
+		self._repo_path = repo
+		self._repo = dulwich.repo.Repo(repo)
+		self._ref_matcher = re.compile(ref_matcher)
+		# only refs below this prefix are read
+		self._ref_prefix = _get_literal_prefix(ref_matcher)
+		self._max_commit_age = max_commit_age
+		self._cache_file = cache_file
+		self._ref_filter = ref_filter
+
+		# opened on first use, False if there is none
+		self._commit_graph = None
+
+		# ref -> (SHA1, commit time) of the refs read by get_branches()
+		self._commits = {}
+
+	"""
+	Open the repository again, dulwich keeps the packed refs and the pack
+	list once read. Needed when running for longer than one sync.
+	"""
+	def reload(self):
+		self._repo = dulwich.repo.Repo(self._repo_path)
+
+		if self._commit_graph:
+			self._commit_graph.close()
+
+		self._commit_graph = None
+
+	# Get the commit time of a commit, from the commit-graph if possible
+	def _get_commit_time(self, sha1):
+		if self._commit_graph is None:
+			path = os.path.join(self._repo.commondir(), "objects", "info", "commit-graph")
+
+			try:
+				self._commit_graph = CommitGraph(path) if os.path.exists(path) else False
+			except ValueError as e:
+				print "Not using commit-graph: %s" % str(e)
+				self._commit_graph = False
+
+		if self._commit_graph:
+			commit_time = self._commit_graph.get_commit_time(sha1)
+
+			if commit_time is not None:
+				return commit_time
+
+		# not in the graph (yet), inflate the commit
+		return self._repo.get_object(sha1).commit_time
+
+	# Path of the Git directory (".git" or the bare repository)
+	def get_control_dir(self):
+		return self._repo.controldir()
+
+	"""
+	Read the refs starting with "prefix" and their SHA1 from packed-refs and
+	the loose refs, other refs (like tags) are not read at all.
+	"""
+	def _read_refs(self, prefix):
+		refs = {}
+
+		control_dir = self._repo.commondir()
+		packed_refs = os.path.join(control_dir, "packed-refs")
+
+		if os.path.exists(packed_refs):
+			with open(packed_refs) as f:
+				is_sorted = False
+
+				for line in f:
+					if line.startswith("#"):
+						is_sorted = " sorted" in line
+						continue
+
+					# peeled tag
+					if line.startswith("^"):
+						continue
+
+					sha1, ref = line.rstrip("\n").split(" ", 1)
+
+					if ref.startswith(prefix):
+						refs[ref] = sha1
+					elif is_sorted and ref > prefix:
+						# all refs below the prefix have been read
+						break
+
+		# loose refs take precedence, only the directory of the prefix is walked
+		base = prefix[:prefix.rfind("/") + 1]
+
+		if base == "":
+			# like "ref", not the whole control dir (objects, logs, ...)
+			base = "refs/"
+
+		for path, dirs, files in os.walk(os.path.join(control_dir, *base.split("/"))):
+			for name in files:
+				ref = os.path.relpath(os.path.join(path, name), control_dir).replace(os.sep, "/")
+
+				if not ref.startswith(prefix) or name.endswith(".lock"):
+					continue
+
+				try:
+					with open(os.path.join(path, name)) as f:
+						content = f.read().strip()
+				except IOError:
+					# deleted while walking
+					continue
+
+				if content.startswith("ref: "):
+					# symbolic ref like refs/remotes/origin/HEAD
+					try:
+						refs[ref] = self._repo.refs[ref]
+					except KeyError:
+						pass
+				else:
+					refs[ref] = content
+
+		return refs
+
+	"""
+	Return True if the ref matches and is not filtered out
+	"""
+	def matches(self, ref):
+		return self._ref_matcher.match(ref) is not None and (self._ref_filter is None or self._ref_filter(ref))
+
+	# Get the matching refs and their SHA1, no objects are read
+	def get_refs(self):
+		if self._ref_prefix != "":
+			refs = self._read_refs(self._ref_prefix)
+		else:
+			refs = self._repo.get_refs()
+
+		return dict([(ref, sha1) for ref, sha1 in refs.iteritems() if self.matches(ref)])
+
+	# Get the cached ref -> (SHA1, commit time) mapping
+	def _load_cache(self):
+		if self._cache_file is None:
+			return {}
+
+		cache = _load_state(self._cache_file)
+
+		if cache is None:
+			return {}
+
+		return dict([(ref, tuple(entry)) for ref, entry in cache["refs"].iteritems()])
+
+	"""
+	Get the set of matching refs whose last commit is within the max. commit age.
+	If "only" is given, only these refs are looked up instead of all refs.
+	"only" can also be a dict of ref -> SHA1 (None for deleted refs) to use
+	instead of the refs of the repository.
+	"""
+	def get_branches(self, only=None):
+		_refs = []
+
+		cached = self._load_cache()
+		resolved = 0
+
+		if only is None:
+			candidates = self.get_refs().iteritems()
+		elif isinstance(only, dict):
+			candidates = [(ref, sha1) for ref, sha1 in only.iteritems() if sha1 is not None]
+		else:
+			candidates = []
+			for ref in only:
+				try:
+					candidates.append((ref, self._repo.refs[ref]))
+				except KeyError:
+					# the ref has been deleted
+					pass
+
+		# iterate over branches (refs) and their SHA1
+		for ref, sha1 in candidates:
+			# ref matches the configured matcher
+			if self.matches(ref):
+				# only read the commit if the ref has been moved since the last run
+				if ref in cached and cached[ref][0] == sha1:
+					commit_time = cached[ref][1]
+				else:
+					try:
+						commit_time = self._get_commit_time(sha1)
+					except KeyError:
+						raise Exception("Commit %s of %s is not in the repository, fetch it first" % (sha1, ref))
+
+					resolved += 1
+
+				_refs.append([ref, sha1, commit_time])
+
+		if self._cache_file is not None:
+			print "Read %d of %d commits" % (resolved, len(_refs))
+
+			if only is None:
+				cache = {}
+			else:
+				# keep all other refs
+				cache = dict([(ref, list(entry)) for ref, entry in cached.iteritems() if ref not in only])
+
+			# the cache holds all matching refs, the age is checked on each run
+			cache.update(dict([(x[0], [x[1], x[2]]) for x in _refs]))
+
+			_save_state(self._cache_file, {"refs": cache})
+
+		self._commits.update(dict([(x[0], (x[1], x[2])) for x in _refs]))
+
+		# filter (ref, SHA1, commit time) tupel for outdated branches
+		refs = filter(lambda x: self._within_days(x[2], self._max_commit_age), _refs)
+
+		# extract ref
+		refs = set([x[0] for x in refs])
+
+		return refs
+
+	"""
+	Refresh the refs from a remote repository instead of relying on a fully
+	fetched checkout. The refs of the remote are listed first, then only the
+	tip commits of the branches matching the ref matcher that are not in the
+	repository yet are fetched, with depth 1 where the transport supports it
+	(not for local repositories). Branches (refs/heads/...) are stored as the
+	remote tracking refs of "remote", tracking refs of deleted branches are
+	removed. Returns a dict of the changed refs -> SHA1, None for removed ones.
+	"""
+	def refresh(self, remote_url, remote=DEFAULT_REF_UPDATES_REMOTE):
+		client, path = dulwich.client.get_transport_and_path(remote_url)
+		prefix = "refs/remotes/%s/" % remote
+
+		remote_refs = {}
+
+		for ref, sha1 in client.get_refs(path).iteritems():
+			if not ref.startswith("refs/heads/"):
+				continue
+
+			tracking_ref = prefix + ref[len("refs/heads/"):]
+
+			if self.matches(tracking_ref):
+				remote_refs[tracking_ref] = sha1
+
+		wants = sorted(set([sha1 for sha1 in remote_refs.values() if sha1 not in self._repo.object_store]))
+
+		if len(wants) > 0:
+			print "Fetching %d of %d commits from %s" % (len(wants), len(remote_refs), remote_url)
+
+			try:
+				client.fetch(path, self._repo, determine_wants=lambda refs: wants, depth=1)
+			except NotImplementedError:
+				client.fetch(path, self._repo, determine_wants=lambda refs: wants)
+
+		local_refs = self.get_refs()
+		changed = {}
+
+		for ref, sha1 in remote_refs.iteritems():
+			if local_refs.get(ref) != sha1:
+				self._repo.refs[ref] = sha1
+				changed[ref] = sha1
+
+		for ref in local_refs:
+			# like refs/remotes/origin/HEAD
+			if ref not in remote_refs and ref.startswith(prefix) and not self._repo.refs.read_ref(ref).startswith("ref: "):
+				del self._repo.refs[ref]
+				changed[ref] = None
+
+		print "Refreshed %d refs from %s, %d changed" % (len(remote_refs), remote_url, len(changed))
+
+		return changed
+
+	# Get the commit time of a ref read by get_branches(), None if not read
+	def get_commit_time(self, ref):
+		return self._commits.get(ref, (None, None))[1]
+
+	# Get the ref -> [SHA1, commit time] of all refs read by get_branches()
+	def get_snapshot(self):
+		return dict([(ref, list(commit)) for ref, commit in self._commits.iteritems()])
+
+	# Get the current SHA1 of each of the refs, None for refs that do not exist
+	def resolve_refs(self, refs):
+		resolved = {}
+
+		for ref in refs:
+			try:
+				resolved[ref] = self._repo.refs[ref]
+			except KeyError:
+				resolved[ref] = None
+
+		return resolved
+
+	# Return True if a commit of that time is within the max. commit age
+	def is_recent(self, commit_time):
+		return self._within_days(commit_time, self._max_commit_age)
+
+	# Return True if the Unix timestamp is within the timerange now - days
+	def _within_days(self, timestamp, days):
+		return datetime.datetime.fromtimestamp(timestamp) >= (datetime.datetime.now() + datetime.timedelta(days=-days))
+
+
+"""
+Read ref updates as written by a post-receive hook ("<old-sha> <new-sha>
+<ref>" per line). Branches (refs/heads/...) are mapped to the remote
+tracking refs of "remote". Returns a dict of ref -> new SHA1, None for
+deleted refs.
+"""
+def _read_ref_updates(f, remote):
+	updates = {}
+
+	for line in f:
+		fields = line.split()
+
+		if len(fields) != 3:
+			continue
+
+		old_sha1, new_sha1, ref = fields
+
+		if ref.startswith("refs/heads/"):
+			ref = "refs/remotes/%s/%s" % (remote, ref[len("refs/heads/"):])
+
+		updates[ref] = None if new_sha1 == "0" * 40 else new_sha1
+
+	return updates
+
+
+"""
+Polls the ref storage of a repository (loose refs below refs/remotes and
+packed-refs) for changes. Git and dulwich replace ref files by renaming, so
+watching the modification times of the directories is enough.
+"""
+class RefWatcher(object):
+
+	"""
+		control_dir -- Git directory of the repository
+		interval -- seconds between two polls
+		debounce -- seconds without further changes before a change is reported
+	"""
+	def __init__(self, control_dir, interval, debounce):
+		self._control_dir = control_dir
+		self._interval = interval
+		self._debounce = debounce
+
+		self._state = self._get_state()
+
+	# Modification times of packed-refs and all directories below refs/remotes
+	def _get_state(self):
+		state = {}
+
+		packed_refs = os.path.join(self._control_dir, "packed-refs")
+
+		try:
+			stat = os.stat(packed_refs)
+			state[packed_refs] = (stat.st_mtime, stat.st_ino, stat.st_size)
+		except OSError:
+			# there is none
+			pass
+
+		for path, dirs, files in os.walk(os.path.join(self._control_dir, "refs", "remotes")):
+			try:
+				state[path] = os.stat(path).st_mtime
+			except OSError:
+				# removed while walking, Git removes the empty directories of deleted branches
+				pass
+
+		return state
 
-		- job_tpl -- the exact job name used as a template (this job might/should be disabled)
-		- job_name_tpl -- the resulting job name, has to contain one "%s" placeholder that will be replaced with the sanitized branch name
 	"""
-	def __init__(self, host, cli_jar, ssh_key, job_tpl, job_name_tpl):
-		self._jenkins = jenkinscli.JenkinsCli(host, cli_jar, ssh_key)
+	Wait for a change of the refs, bursts of changes are reported once.
+	Returns True on change, False if there was none within "timeout" seconds.
+	"""
+	def wait_for_change(self, timeout):
+		deadline = time.time() + timeout
 
-		self._job_template = job_tpl
-		self._job_name_tpl = job_name_tpl
+		while time.time() < deadline:
+			time.sleep(self._interval)
+
+			state = self._get_state()
+
+			if state == self._state:
+				continue
+
+			# wait until the refs are not changed for a while
+			changed_at = time.time()
+
+			while time.time() - changed_at < self._debounce:
+				time.sleep(self._interval)
+
+				current = self._get_state()
+
+				if current != state:
+					state = current
+					changed_at = time.time()
+
+			self._state = state
+
+			return True
+
+		return False
+
+
+"""
+	Options of a GitJenkinsSync, the options not given keep their defaults.
+	Unknown options raise a TypeError. Options are equal if all of their
+	values are.
+
+	discovery_workers -- threads reading job configs
+	update_drifted -- update the jobs whose config differs from the template
+	state_dir -- directory of the caches, tombstones and pending operations
+	full_refresh_interval -- hours after which all job configs are read again
+	mutation_workers -- threads creating and removing jobs
+	backend, http_user, http_token -- how to connect to Jenkins
+	batch_mutations -- create and remove the jobs with one Groovy script
+	match_jobs_by_name -- take jobs named like a branch to be configured for it
+	metrics_out -- path to write the metrics to after each sync
+	time_budget -- seconds a sync may take
+	remote_url, remote -- remote to fetch the refs from and its name
+	job_folder -- folder of the branch jobs
+	throttle_latency, throttle_queue_length -- adapt the mutation concurrency
+	disable_stale -- disable the jobs of stale branches instead of removing them
+	shard -- (index, count) of the shard to sync
+"""
+class SyncOptions(object):
+
+	# option -> default
+	DEFAULTS = {
+		"discovery_workers": DEFAULT_DISCOVERY_WORKERS,
+		"update_drifted": False,
+		"state_dir": None,
+		"full_refresh_interval": DEFAULT_FULL_REFRESH_INTERVAL,
+		"mutation_workers": DEFAULT_MUTATION_WORKERS,
+		"backend": BACKEND_CLI,
+		"http_user": None,
+		"http_token": None,
+		"batch_mutations": False,
+		"match_jobs_by_name": False,
+		"metrics_out": None,
+		"time_budget": None,
+		"remote_url": None,
+		"remote": DEFAULT_REF_UPDATES_REMOTE,
+		"job_folder": None,
+		"throttle_latency": None,
+		"throttle_queue_length": None,
+		"disable_stale": False,
+		"shard": None
+	}
+
+	def __init__(self, **options):
+		unknown = sorted(set(options.keys()) - set(self.DEFAULTS.keys()))
+
+		if len(unknown) > 0:
+			raise TypeError("Unknown sync option(s): %s" % ", ".join(unknown))
+
+		for name, default in self.DEFAULTS.iteritems():
+			setattr(self, name, options.get(name, default))
+
+	def __eq__(self, other):
+		return isinstance(other, SyncOptions) and vars(self) == vars(other)
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return "SyncOptions(%s)" % ", ".join(["%s=%r" % x for x in sorted(vars(self).items())])
+
+
+"""
+	Syncs the jobs of a Jenkins with the branches of a Git repository.
+
+	options -- SyncOptions, the defaults if None
+	connection -- Jenkins backend shared with other syncs, see SharedJenkinsBackend
+	metrics -- Metrics shared with other syncs
+	throttle -- AdaptiveThrottle shared by the syncs against the same Jenkins
+"""
+class GitJenkinsSync(object):
+
+	def __init__(self, host, cli_jar, ssh_key, job_tpl, job_name_tpl, repo, ref_matcher, max_commit_age, options=None,
+			connection=None, metrics=None, throttle=None):
+		if options is None:
+			options = SyncOptions()
+
+		state_dir = options.state_dir
+
+		self._metrics = metrics if metrics is not None else Metrics()
+		self._metrics_out = options.metrics_out
+		self._pending_file = os.path.join(state_dir, PENDING_FILE) if state_dir is not None else None
+
+		# seconds a sync may take, its operations are not started after
+		self._time_budget = options.time_budget
+		self._deadline = None
+
+		self._jenkins = Jenkins(
+			host, cli_jar, ssh_key, job_tpl, job_name_tpl, discovery_workers=options.discovery_workers,
+			cache_file=(os.path.join(state_dir, JOB_CACHE_FILE) if state_dir is not None else None),
+			full_refresh_interval=options.full_refresh_interval,
+			backend=options.backend, http_user=options.http_user, http_token=options.http_token,
+			connection=connection, metrics=self._metrics, job_folder=options.job_folder, shard=options.shard,
+			hash_configs=options.update_drifted
+		)
+
+		# the repository only holds what is fetched from the remote
+		if options.remote_url is not None and not os.path.exists(repo):
+			print "Creating repository %s for %s" % (repo, options.remote_url)
+			dulwich.repo.Repo.init_bare(repo, mkdir=True)
+
+		self._remote_url = options.remote_url
+		self._remote = options.remote
+
+		self._git = GitBranches(
+			repo, ref_matcher, max_commit_age,
+			cache_file=(os.path.join(state_dir, REF_CACHE_FILE) if state_dir is not None else None),
+			ref_filter=(self._in_shard if options.shard is not None else None)
+		)
+		self._update_drifted = options.update_drifted
+		self._mutation_workers = options.mutation_workers
+		self._batch_mutations = options.batch_mutations
+		self._match_jobs_by_name = options.match_jobs_by_name
+
+		# seconds a job operation may take before the concurrency is lowered,
+		# the concurrency is not adapted if None
+		self._throttle_latency = options.throttle_latency
+		self._throttle_queue_length = options.throttle_queue_length
+		self._throttle = None
+		self._shared_throttle = throttle
+
+		# jobs of stale branches are disabled instead of removed if True, the
+		# tombstones are ref -> {"job": job name, "disabled": time}
+		self._disable_stale = options.disable_stale
+		self._tombstone_file = os.path.join(state_dir, TOMBSTONE_FILE) if state_dir is not None else None
+		self._tombstones = {}
+
+		if self._tombstone_file is not None:
+			self._tombstones = (_load_state(self._tombstone_file) or {}).get("tombstones", {})
+
+	# Return True if the job of the ref (refs/remotes/...) belongs to the shard
+	def _in_shard(self, ref):
+		return self._jenkins.in_shard(self._jenkins.get_job_name(ref))
+
+	# Run operation for each ref (refs/remotes/...) using up to "mutation_workers"
+	# threads. Returns a list of (operation name, ref, exception, seconds) tupels.
+	# With a "deadline" refs are taken in the given order, no operation is
+	# started that would likely end after it; those refs are left out.
+	# The operations are throttled by the throttle of the current _apply().
+	def _run_operations(self, name, operation, refs, deadline=None):
+		durations = []
+		lock = threading.Lock()
+
+		def timed_operation(ref):
+			if deadline is not None:
+				with lock:
+					expected = sum(durations) / len(durations) if len(durations) > 0 else 0
+
+				if time.time() + expected > deadline:
+					return None
+
+			if self._throttle is not None:
+				token = self._throttle.acquire()
+
+			start = time.time()
+
+			try:
+				operation(ref.replace("refs/remotes/", ""))
+				error = None
+			except Exception as e:
+				print "Failed to %s job for branch %s: %s" % (name, ref, str(e))
+				error = e
+
+			seconds = time.time() - start
+
+			if self._throttle is not None:
+				self._throttle.release(token, seconds, error is not None)
+
+			with lock:
+				durations.append(seconds)
+
+			return (error, seconds)
+
+		results = _parallel_map(timed_operation, refs if deadline is not None else sorted(refs), self._mutation_workers)
+
+		return [(name, ref, result[0], result[1]) for ref, result, error in results if result is not None]
+
+	# Remove and create jobs for refs (refs/remotes/...) with one batch script.
+	# Returns a list of (operation name, ref, exception, seconds) tupels.
+	def _run_batch(self, to_remove, to_create):
+		if len(to_remove) == 0 and len(to_create) == 0:
+			return []
+
+		refs = dict([(ref.replace("refs/remotes/", ""), ref) for ref in to_remove | to_create])
+
+		try:
+			results = self._jenkins.run_batch(
+				sorted([ref.replace("refs/remotes/", "") for ref in to_remove]),
+				sorted([ref.replace("refs/remotes/", "") for ref in to_create])
+			)
+		except Exception as e:
+			# none of the jobs is known to be done
+			results = [("remove", ref.replace("refs/remotes/", ""), e, 0.0) for ref in sorted(to_remove)]
+			results += [("create", ref.replace("refs/remotes/", ""), e, 0.0) for ref in sorted(to_create)]
+
+		for name, ref_name, error, duration in results:
+			if error is not None:
+				print "Failed to %s job for branch %s: %s" % (name, refs[ref_name], str(error))
+
+		return [(name, refs[ref_name], error, duration) for name, ref_name, error, duration in results]
+
+	# Print one line per operation and the totals
+	def _print_summary(self, results, seconds):
+		if len(results) == 0:
+			return
+
+		print "Summary:"
+
+		for name, ref, error, duration in results:
+			if error is None:
+				print "  OK      %-6s %s (%.2fs)" % (name, ref, duration)
+			else:
+				print "  FAILED  %-6s %s (%.2fs): %s" % (name, ref, duration, str(error))
+
+		failed = len([x for x in results if x[2] is not None])
+
+		print "%d operation(s), %d failed, took %.2fs" % (len(results), failed, seconds)
+
+	# Create and remove jobs for sets of refs (refs/remotes/...), prints what
+	# is done and a summary. Returns the operation results like sync().
+	# When disabling stale jobs, jobs of "to_remove" are disabled instead
+	# and the disabled jobs of "to_keep" are enabled again. A job of
+	# "to_remove" named like a job of "to_create" is live again, it is
+	# reclaimed for the new branch.
+	def _apply(self, to_create, to_remove, to_keep=frozenset()):
+		to_disable = set()
+		to_enable = set()
+		# ref to reclaim the job for -> ref of the stale job
+		to_reclaim = {}
+
+		if self._disable_stale:
+			claimed = dict([(self._jenkins.get_job_name(ref), ref) for ref in to_create])
+
+			for ref in to_remove:
+				if self._jenkins.get_job_name(ref) in claimed:
+					to_reclaim[claimed[self._jenkins.get_job_name(ref)]] = ref
 
+			to_create = set(to_create) - set(to_reclaim.keys())
+			to_disable = set([ref for ref in to_remove if ref not in self._tombstones and ref not in to_reclaim.values()])
+			to_enable = set([ref for ref in to_keep if ref in self._tombstones])
+			to_remove = set()
+
+			if len(to_disable) > 0:
+				print "Disable these:\n  %s" % "\n  ".join(to_disable)
+
+			if len(to_enable) > 0:
+				print "Enable these again:\n  %s" % "\n  ".join(to_enable)
+
+			if len(to_reclaim) > 0:
+				print "Reclaim the jobs of stale branches for these:\n  %s" % "\n  ".join(sorted(to_reclaim.keys()))
+
+		if len(to_remove) > 0:
+			print "Remove these:\n  %s" % "\n  ".join(to_remove)
+		else:
+			print "No branch jobs to remove."
+
+
+		if len(to_create) > 0:
+			print "Create these:\n  %s" % "\n  ".join(to_create)
+		else:
+			print "No branch jobs to create."
+
+		start = time.time()
+
+		if self._shared_throttle is not None:
+			self._throttle = self._shared_throttle
+		elif self._throttle_latency is not None:
+			# starts at one operation at a time for each run
+			self._throttle = AdaptiveThrottle(
+				1, self._mutation_workers, self._throttle_latency,
+				max_queue_length=self._throttle_queue_length, queue_length=self._jenkins.get_queue_length
+			)
+
+		with self._metrics.span("mutations"):
+			if self._batch_mutations:
+				results = self._run_batch(to_remove, to_create)
+			elif self._deadline is not None:
+				results = self._run_operations_within_budget(to_create, to_remove)
+			else:
+				# removed first, a job name might be taken by a job to create
+				results = self._run_operations("remove", self._jenkins.remove_job, to_remove)
+				results += self._run_operations("create", self._jenkins.create_job, to_create)
+
+			if self._disable_stale:
+				results += self._run_operations("disable", self._jenkins.disable_job, to_disable, self._deadline)
+				results += self._run_operations("enable", self._jenkins.reuse_job, to_enable, self._deadline)
+				results += self._run_operations("reclaim", self._jenkins.reclaim_job, to_reclaim.keys(), self._deadline)
+
+		for name, ref, error, duration in results:
+			self._metrics.observe("operation", name, duration)
+
+			if error is None and name == "disable":
+				self._tombstones[ref] = {"job": self._jenkins.get_job_name(ref), "disabled": time.time()}
+			elif error is None and name in ["enable", "remove"]:
+				self._tombstones.pop(ref, None)
+			elif error is None and name == "reclaim":
+				self._tombstones.pop(to_reclaim[ref], None)
+
+		if self._throttle is not None and self._shared_throttle is None:
+			print "Throttled: %s" % self._throttle.get_report()
+
+		self._throttle = None
+
+		self._print_summary(results, time.time() - start)
+
+		return results
 
 	"""
-	Create Job for Git ref name
+	Remove and create jobs until the deadline of the time budget. Operations
+	left by the last run come first, then jobs are created for the branches
+	with the newest commits first. Removals get half of the remaining time
+	if there are jobs to create. The operations not started are recorded in
+	the state directory for the next run.
 	"""
-	def create_job(self, ref_name):
-		# load template and replace placeholder in config
-		config_template = self._jenkins.get_job(self._job_template)
+	def _run_operations_within_budget(self, to_create, to_remove):
+		pending = (_load_state(self._pending_file) if self._pending_file is not None else None) or {}
+		pending_create = set(pending.get("create", []))
+		pending_remove = set(pending.get("remove", []))
 
-		# deserialize
-		root = ET.fromstring(config_template)
+		to_create = sorted(to_create, key=lambda ref: (ref not in pending_create, -(self._git.get_commit_time(ref) or 0), ref))
+		to_remove = sorted(to_remove, key=lambda ref: (ref not in pending_remove, ref))
 
-		xpath = ".//scm/branches/hudson.plugins.git.BranchSpec/name"
+		now = time.time()
+		remove_deadline = self._deadline if len(to_create) == 0 else now + max(0, self._deadline - now) / 2
 
-		# get branch name config node
-		name_element = root.findall(xpath)
+		# removed first, a job name might be taken by a job to create
+		results = self._run_operations("remove", self._jenkins.remove_job, to_remove, remove_deadline)
+		results += self._run_operations("create", self._jenkins.create_job, to_create, self._deadline)
 
-		# check if a "name" node has been selected
-		if len(name_element) > 0:
-			# set branch name config
-			name_element[0].text = ref_name
-		else:
-			raise Exception("Missing Git branch spec config in config template (xpath: %s)" % (xpath))
+		done = set([(x[0], x[1]) for x in results])
+		left = {
+			"create": [ref for ref in to_create if ("create", ref) not in done],
+			"remove": [ref for ref in to_remove if ("remove", ref) not in done]
+		}
 
-		# serialize DOM
-		config = ET.tostring(root)
+		if len(left["create"]) > 0 or len(left["remove"]) > 0:
+			print "Time budget of %ss used up, left for the next run:\n  %s" % (self._time_budget, "\n  ".join(
+				["create " + ref for ref in left["create"]] + ["remove " + ref for ref in left["remove"]]
+			))
 
-		# replace slashes in ref name to  get clean job name and build job name
-		filtered_ref_name = ref_name.replace("origin/", "")
-		# Python 2.6 does not support flags=..., using (?i)
-		filtered_ref_name = re.sub("(?i)[^a-z0-9_-]+", "-", filtered_ref_name)
-		job_name = self._job_name_tpl % filtered_ref_name
+		if self._pending_file is not None:
+			_save_state(self._pending_file, left)
 
-		print "Creating and enabling job '%s' for branch %s" % (job_name, ref_name)
-		self._jenkins.create_job(job_name, config)
-		self._jenkins.enable_job(job_name)
+		return results
+
+	# Write the tombstones of the disabled jobs to the state directory
+	def _save_tombstones(self):
+		if self._tombstone_file is not None and (self._disable_stale or os.path.exists(self._tombstone_file)):
+			_save_state(self._tombstone_file, {"tombstones": self._tombstones})
 
 	"""
-	Remove Job by Git ref name
+	Remove the jobs disabled by the disable-and-reuse mode more than
+	"retention_days" ago, with one batch script if batch mutations are
+	enabled. Only the jobs of these tombstones are checked: a job is kept
+	if its branch is back (it is enabled again by the next sync), a
+	tombstone is dropped if its job is configured for another branch. A
+	tombstone whose job could not be read is kept, a sync drops it if the
+	job is not listed. Returns the operation results like sync().
 	"""
-	def remove_job(self, ref_name):
-		# replace slashes in ref name to  get clean job name and build job name
-		filtered_ref_name = ref_name.replace("origin/", "")
-		# Python 2.6 does not support flags=..., using (?i)
-		filtered_ref_name = re.sub("(?i)[^a-z0-9_-]+", "-", filtered_ref_name)
-		job_name = self._job_name_tpl % filtered_ref_name
+	def gc(self, retention_days):
+		with self._metrics.span("gc"):
+			expired = set([ref for ref, tombstone in self._tombstones.iteritems() if time.time() - tombstone["disabled"] > retention_days * 24 * 60 * 60])
 
-		print "Removing job '%s' for branch '%s'" % (job_name, ref_name)
-		self._jenkins.delete_job(job_name)
+			print "%d of %d disabled job(s) are older than %d days" % (len(expired), len(self._tombstones), retention_days)
 
-	# get branch from one Job's config
-	def _get_branch_from_config(self, config):
-		root = ET.fromstring(config)
+			if len(expired) == 0:
+				return []
+
+			with self._metrics.span("git_scan"):
+				git_branches = self._git.get_branches(only=expired)
+
+			with self._metrics.span("discovery"):
+				jobs = self._jenkins.get_jobs_of(expired)
+
+			to_remove = set()
+
+			for ref in sorted(expired):
+				if ref in git_branches:
+					print "Keeping disabled job for branch %s, the branch is back" % ref
+				elif ref not in jobs:
+					# dropped by the next sync if the job is not listed
+					print "Keeping tombstone of branch %s, its job could not be read" % ref
+				elif jobs[ref] != ref:
+					print "Dropping tombstone of branch %s, its job is configured for another branch" % ref
+					self._tombstones.pop(ref)
+				else:
+					to_remove.add(ref)
+
+			if len(to_remove) > 0:
+				print "Remove these:\n  %s" % "\n  ".join(to_remove)
+
+			start = time.time()
+
+			with self._metrics.span("mutations"):
+				if self._batch_mutations:
+					results = self._run_batch(to_remove, set())
+				else:
+					results = self._run_operations("remove", self._jenkins.remove_job, to_remove)
+
+			for name, ref, error, duration in results:
+				self._metrics.observe("operation", name, duration)
+
+				if error is None:
+					self._tombstones.pop(ref, None)
+
+			self._print_summary(results, time.time() - start)
+
+			self._save_tombstones()
+			self._jenkins.save_cache()
+
+		self._write_metrics()
+
+		return results
+
+	# Get the metrics of the syncs run so far
+	def get_metrics(self):
+		return self._metrics
+
+	# Set the deadline of a sync starting now if there is a time budget
+	def _start_time_budget(self):
+		if self._time_budget is not None:
+			self._deadline = time.time() + self._time_budget
 
-		name_element = root.findall(".//scm/branches/hudson.plugins.git.BranchSpec/name")
+	# Write the metrics if asked to, a failure does not fail the sync
+	def _write_metrics(self):
+		if self._metrics_out is None:
+			return
 
-		if len(name_element) == 1:
-			return name_element[0].text
+		try:
+			self._metrics.write(self._metrics_out)
+		except (IOError, OSError) as e:
+			print "Failed to write metrics to %s: %s" % (self._metrics_out, str(e))
+
+	"""
+	Sync only the given refs (refs/remotes/...), for example the refs that
+	changed since the last sync. Jenkins is not asked for all its jobs, see
+	Jenkins.get_configured_branches_for(). "refs" can be a dict of ref ->
+	SHA1 (None for deleted refs) to use instead of the refs of the repository.
+	Returns the operation results like sync().
+	"""
+	def sync_refs(self, refs):
+		# other refs like tags have no job to look up, the jobs of other
+		# shards are neither looked up nor removed
+		if isinstance(refs, dict):
+			refs = dict([(ref, sha1) for ref, sha1 in refs.iteritems() if self._git.matches(ref)])
 		else:
-			return None
+			refs = set([ref for ref in refs if self._git.matches(ref)])
+
+		with self._metrics.span("sync_refs"):
+			self._start_time_budget()
+			self._jenkins.reset_template()
+
+			with self._metrics.span("git_scan"):
+				git_branches = self._git.get_branches(only=refs)
+
+			colliding = self._jenkins.index_job_names(git_branches)
+
+			with self._metrics.span("discovery"):
+				job_branches = self._jenkins.get_configured_branches_for(set(refs))
+
+			results = self._apply(git_branches - colliding - job_branches, job_branches - git_branches, git_branches & job_branches)
+
+			self._save_tombstones()
+			self._jenkins.save_cache()
+
+		self._write_metrics()
+
+		return results
 
 	"""
-	Get all branches that are configured by Jobs.
-	Examines each Job in the list for their branch names
+	Sync on each change of the refs until interrupted. Starts with a full
+	sync, then only the refs that changed are synced. A full sync is done
+	every "full_sync_interval" seconds to expire branches by age and to
+	pick up changes made in Jenkins. A failing sync does not end the watch,
+	it is tried again after WATCH_RETRY_INTERVAL seconds (or with the next
+	change), the refs of a failed incremental sync are synced again then.
 	"""
-	def get_currently_configured_branches(self):
-		jobs = self._jenkins.get_joblist()
+	def watch(self, interval, debounce, full_sync_interval):
+		watcher = RefWatcher(self._git.get_control_dir(), interval, debounce)
 
-		branches = []
+		while True:
+			# refs changed during the sync are synced again in the next cycle
+			try:
+				self._git.reload()
+				refs = self._git.get_refs()
+				self.sync()
+			except Exception as e:
+				print "Sync failed, trying again in %ss: %s" % (WATCH_RETRY_INTERVAL, str(e))
+				time.sleep(WATCH_RETRY_INTERVAL)
+				continue
 
-		for job in jobs:
-			if re.match("^" + (self._job_name_tpl % ""), job):
-	                        config = self._jenkins.get_job(job)
-	                        branch_name = self._get_branch_from_config(config)
+			next_full_sync = time.time() + full_sync_interval
 
-				if not re.match("^refs/remotes/", branch_name):
-					branch_name = "refs/remotes/" + branch_name
+			# refs of a failed incremental sync
+			failed = set()
 
-				branches.append(branch_name)
+			while time.time() < next_full_sync:
+				timeout = next_full_sync - time.time()
 
-		return branches
+				if len(failed) > 0:
+					timeout = min(timeout, WATCH_RETRY_INTERVAL)
 
-"""
-Represents branches in Git
-"""
-class GitBranches(object):
+				if not watcher.wait_for_change(timeout) and len(failed) == 0:
+					continue
+
+				changed = set(failed)
+
+				try:
+					self._git.reload()
+					current_refs = self._git.get_refs()
+
+					changed |= set([ref for ref in set(refs.keys()) | set(current_refs.keys()) if refs.get(ref) != current_refs.get(ref)])
+					refs = current_refs
+
+					if len(changed) > 0:
+						print "Refs changed:\n  %s" % "\n  ".join(sorted(changed))
+						self.sync_refs(changed)
+
+					failed = set()
+				except Exception as e:
+					print "Sync of the changed refs failed, trying again in %ss: %s" % (WATCH_RETRY_INTERVAL, str(e))
+					failed = changed
 
 	"""
-		Git branch management.
+	Refresh and scan the repository and discover the jobs. Returns the
+	branches of the repository, the branches configured in Jenkins and the
+	branches that share their job name with another one.
+	"""
+	def _discover(self):
+		if self._remote_url is not None:
+			with self._metrics.span("git_fetch"):
+				self._git.refresh(self._remote_url, self._remote)
+
+		with self._metrics.span("git_scan"):
+			git_branches = self._git.get_branches()
+
+		colliding = self._jenkins.index_job_names(git_branches)
+
+		with self._metrics.span("discovery"):
+			job_branches = set(self._jenkins.get_currently_configured_branches(by_name=self._match_jobs_by_name))
+
+		print "Found these branches in the repository:\n  %s" % "\n  ".join(git_branches)
+		print "Found these branches configured in Jenkins:\n  %s" % "\n  ".join(job_branches)
+
+		return (git_branches, job_branches, colliding)
 
-		repo -- Repository location (relative or absolute paths)
-		ref_matcher -- A regular expression that matches branch names to create jobs for
-		max_commit_age -- Max days the last commit was made to a branch
 	"""
-	def __init__(self, repo, ref_matcher, max_commit_age):
-		self._repo = dulwich.repo.Repo(repo)
-		self._ref_matcher = ref_matcher
-		self._max_commit_age = max_commit_age
+	Discover both sides like sync() but only write what would be done to a
+	plan file for apply(): the refs read (ref -> [SHA1, commit time]), the
+	job mapping and the refs to create and remove jobs for. Returns the plan.
+	"""
+	def plan(self, path):
+		with self._metrics.span("plan"):
+			self._jenkins.reset_template()
 
-	def get_branches(self):
-		_refs = []
+			git_branches, job_branches, colliding = self._discover()
 
-		# iterate over branches (refs) and their SHA1
-		for ref, sha1 in self._repo.get_refs().iteritems():
-			# ref matches the configured matcher
-			if re.match(self._ref_matcher, ref):
-				obj = self._repo.get_object(sha1)
-				_refs.append([ref, sha1, obj.commit_time])
+			plan = {
+				"version": PLAN_VERSION,
+				"created": time.time(),
+				"job_name_tpl": self._jenkins.get_job_name_tpl(),
+				"job_folder": self._jenkins.get_job_folder(),
+				"refs": self._git.get_snapshot(),
+				"jobs": self._jenkins.get_job_mapping(),
+				"create": sorted(git_branches - colliding - job_branches),
+				"remove": sorted(job_branches - git_branches)
+			}
 
-		# filter (ref, SHA1, commit time) tupel for outdated branches
-		refs = filter(lambda x: self._within_days(x[2], self._max_commit_age), _refs)
+			_save_state(path, plan)
+			self._jenkins.save_cache()
 
-		# extract ref
-		refs = set([x[0] for x in refs])
+		print "Planned to create %d and remove %d job(s), written to %s" % (len(plan["create"]), len(plan["remove"]), path)
 
-		return refs
+		self._write_metrics()
 
-	# Return True if the Unix timestamp is within the timerange now - days
-	def _within_days(self, timestamp, days):
-		return datetime.datetime.fromtimestamp(timestamp) >= (datetime.datetime.now() + datetime.timedelta(days=-days))
+		return plan
+
+	"""
+	Create and remove the jobs of a plan file written by plan(), without
+	discovering all refs and jobs again. Only the refs and jobs of the plan
+	are checked: a job is not created if its ref moved or is gone, its commit
+	is older than the max. commit age by now or the job exists. A job is not
+	removed if its ref is back or moved or the job is gone or configured for
+	another branch by now. Returns the operation results like sync().
+	"""
+	def apply(self, path):
+		plan = _load_state(path)
 
+		if plan is None or plan.get("version") != PLAN_VERSION:
+			raise Exception("Not a plan file of this version: %s" % path)
 
-class GitJenkinsSync(object):
+		if plan["job_name_tpl"] != self._jenkins.get_job_name_tpl() or plan["job_folder"] != self._jenkins.get_job_folder():
+			raise Exception("Plan %s was made for other jobs (%s in %s)" % (path, plan["job_name_tpl"], plan["job_folder"]))
+
+		print "Applying plan %s made %s" % (path, datetime.datetime.fromtimestamp(plan["created"]).strftime("%Y-%m-%d %H:%M:%S"))
+
+		with self._metrics.span("apply"):
+			self._start_time_budget()
+			self._jenkins.reset_template()
+
+			snapshot = dict([(ref, tuple(commit)) for ref, commit in plan["refs"].iteritems()])
+			to_create = set(plan["create"])
+			to_remove = set(plan["remove"])
+
+			with self._metrics.span("plan_check"):
+				current = self._git.resolve_refs(to_create | to_remove)
+				jobs = self._jenkins.get_jobs_of(to_create | to_remove)
+
+			stale = []
+
+			for ref in sorted(to_create):
+				if current[ref] != snapshot[ref][0]:
+					stale.append("create %s: the branch has moved or is gone" % ref)
+				elif not self._git.is_recent(snapshot[ref][1]):
+					stale.append("create %s: the last commit is older than the max. commit age by now" % ref)
+				elif ref in jobs:
+					stale.append("create %s: the job exists" % ref)
+				else:
+					continue
+
+				to_create.discard(ref)
+
+			for ref in sorted(to_remove):
+				if current[ref] != snapshot.get(ref, (None, None))[0]:
+					stale.append("remove %s: the branch has moved or is back" % ref)
+				elif jobs.get(ref) != ref:
+					stale.append("remove %s: the job is gone or configured for another branch" % ref)
+				else:
+					continue
+
+				to_remove.discard(ref)
+
+			if len(stale) > 0:
+				print "Skipping outdated operations of the plan:\n  %s" % "\n  ".join(stale)
 
-	def __init__(self, host, cli_jar, ssh_key, job_tpl, job_name_tpl, repo, ref_matcher, max_commit_age):
-		self._jenkins = Jenkins(host, cli_jar, ssh_key, job_tpl, job_name_tpl)
-		self._git = GitBranches(repo, ref_matcher, max_commit_age)
+			results = self._apply(to_create, to_remove)
 
-	"""Do the actual sync. Query both sides, do diff/intersection and create/remove jobs"""
+			self._save_tombstones()
+			self._jenkins.save_cache()
+
+		self._write_metrics()
+
+		return results
+
+	"""
+	Do the actual sync. Query both sides, do diff/intersection and create/remove jobs.
+	Jobs are removed before any job is created, a failing operation does not stop the others.
+	Returns a list of (operation name, ref, exception, seconds) tupels.
+	"""
 	def sync(self):
-		git_branches = self._git.get_branches()
-		job_branches = set(self._jenkins.get_currently_configured_branches())
+		with self._metrics.span("sync"):
+			self._start_time_budget()
 
-		print "Found these branches in the repository:\n  %s" % "\n  ".join(git_branches)
-		print "Found these branches configured in Jenkins:\n  %s" % "\n  ".join(job_branches)
+			# fetch the template at most once per run
+			self._jenkins.reset_template()
 
-		to_remove = job_branches - git_branches
+			git_branches, job_branches, colliding = self._discover()
 
-		if len(to_remove) > 0:
-			print "Remove these:\n  %s" % "\n  ".join(to_remove)
+			# the jobs of these have been removed by hand, a job whose config
+			# could not be read keeps its tombstone and the time it was disabled
+			for ref in set(self._tombstones.keys()) - job_branches:
+				if not self._jenkins.is_discovery_failure(self._tombstones[ref]["job"]):
+					self._tombstones.pop(ref)
 
-			for ref in to_remove:
-				self._jenkins.remove_job(ref.replace("refs/remotes/", ""))
-		else:
-			print "No branch jobs to remove."
+			results = self._apply(git_branches - colliding - job_branches, job_branches - git_branches, git_branches & job_branches)
 
+			if self._update_drifted and self._deadline is not None and time.time() >= self._deadline:
+				print "Not updating jobs whose config differs from the template, the time budget is used up."
+			elif self._update_drifted:
+				print "Updating jobs whose config differs from the template."
 
-		to_create = git_branches - job_branches
+				with self._metrics.span("update_drifted"):
+					self._jenkins.update_drifted_jobs(git_branches & job_branches)
 
-		if len(to_create) > 0:
-			print "Create these:\n  %s" % "\n  ".join(to_create)
+			self._save_tombstones()
+			self._jenkins.save_cache()
 
-			for ref in to_create:
-				self._jenkins.create_job(ref.replace("refs/remotes/", ""))
-		else:
-			print "No branch jobs to create."
+		self._write_metrics()
+
+		return results
 
 class CustomParser(argparse.ArgumentParser):
 
@@ -231,6 +3034,14 @@ class MaxAgeSwitchAction(argparse.Action):
 
 		setattr(namespace, self.dest, values)
 
+# Validating store action for --discovery-workers
+class WorkersSwitchAction(argparse.Action):
+	def __call__(self, parser, namespace, values, option_string=None):
+		if values > 64 or values < 1:
+			raise Exception("Number of workers %d exceeds 1 - 64" % values)
+
+		setattr(namespace, self.dest, values)
+
 # Internal exception
 class ArgumentValidationException(Exception):
 
@@ -238,25 +3049,237 @@ class ArgumentValidationException(Exception):
 		super(ArgumentValidationException, self).__init__(msg)
 
 def _validate_arguments(parsed):
-	if not os.path.exists(parsed.ssh_key):
-		raise ArgumentValidationException("SSH Key does not exist: " + parsed.ssh_key)
+	if parsed.backend == BACKEND_CLI:
+		if parsed.ssh_key is None or not os.path.exists(parsed.ssh_key):
+			raise ArgumentValidationException("SSH Key does not exist: " + str(parsed.ssh_key))
+
+		if parsed.jar is None or not os.path.exists(parsed.jar):
+			raise ArgumentValidationException("Jenkins CLI .jar does not exist: " + str(parsed.jar))
+
+	if parsed.batch_mutations and parsed.backend != BACKEND_CLI:
+		raise ArgumentValidationException("Batch mutations are only supported by the CLI backend.")
+
+	if parsed.throttle_latency is not None and parsed.throttle_latency <= 0:
+		raise ArgumentValidationException("Throttle latency must be positive: " + str(parsed.throttle_latency))
+
+	if parsed.throttle_latency is not None and parsed.batch_mutations:
+		raise ArgumentValidationException("Batch mutations can not be throttled, they are run by one script.")
+
+	if parsed.throttle_latency is not None and parsed.mutation_workers < 2:
+		raise ArgumentValidationException("Throttling needs more than one mutation worker (--mutation-workers).")
+
+	if parsed.throttle_queue_length is not None and parsed.throttle_latency is None:
+		raise ArgumentValidationException("The build queue length is only checked with --throttle-latency.")
+
+	if parsed.time_budget is not None and parsed.time_budget <= 0:
+		raise ArgumentValidationException("Time budget must be positive: " + str(parsed.time_budget))
+
+	if parsed.time_budget is not None and parsed.batch_mutations:
+		raise ArgumentValidationException("A time budget can not be used with batch mutations, the batch can not be stopped.")
+
+	if parsed.watch and parsed.ref_updates is not None:
+		raise ArgumentValidationException("Watch mode and ref updates can not be used together.")
+
+	if parsed.watch and parsed.remote_url is not None:
+		raise ArgumentValidationException("Watch mode can not be used with a remote URL, nothing would change the refs between the syncs.")
+
+	if parsed.plan is not None and parsed.apply is not None:
+		raise ArgumentValidationException("A plan can not be written and applied by the same run.")
 
-	if not os.path.exists(parsed.jar):
-		raise ArgumentValidationException("Jenkins CLI .jar does not exist: " + parsed.jar)
+	if (parsed.plan is not None or parsed.apply is not None) and (parsed.watch or parsed.ref_updates is not None or parsed.config is not None):
+		raise ArgumentValidationException("Plans can not be used with watch mode, ref updates or a config file.")
 
-	if parsed.jobname_tpl.count("%s") != 1:
+	if parsed.apply is not None and not os.path.exists(parsed.apply):
+		raise ArgumentValidationException("Plan file does not exist: " + parsed.apply)
+
+	if (parsed.disable_stale or parsed.gc_tombstones is not None) and parsed.state_dir is None:
+		raise ArgumentValidationException("The disabled jobs are recorded in the state directory, --state-dir is needed.")
+
+	if parsed.gc_tombstones is not None and parsed.gc_tombstones < 0:
+		raise ArgumentValidationException("Tombstone retention must not be negative: " + str(parsed.gc_tombstones))
+
+	if parsed.gc_tombstones is not None and (parsed.watch or parsed.ref_updates is not None or parsed.plan is not None or parsed.apply is not None):
+		raise ArgumentValidationException("Removing disabled jobs can not be combined with watch mode, ref updates or plans.")
+
+	if parsed.state_dir is not None and not os.path.isdir(parsed.state_dir):
+		raise ArgumentValidationException("State directory does not exist: " + parsed.state_dir)
+
+	if parsed.config is not None:
+		if parsed.watch or parsed.ref_updates is not None:
+			raise ArgumentValidationException("Watch mode and ref updates can not be used with a config file.")
+
+		if not os.path.exists(parsed.config):
+			raise ArgumentValidationException("Config file does not exist: " + parsed.config)
+
+		return
+
+	for name, value in [("--git-repo", parsed.git_repo_path), ("--tpl-job", parsed.tpl_job), ("--job-name-tpl", parsed.jobname_tpl), ("--ref-regex", parsed.ref_regex)]:
+		if value is None:
+			raise ArgumentValidationException("Missing argument %s (or --config)" % name)
+
+	_validate_target(parsed.jobname_tpl, parsed.git_repo_path, parsed.ref_regex, parsed.remote_url)
+
+# Validate the settings of one sync target
+def _validate_target(jobname_tpl, git_repo_path, ref_regex, remote_url=None):
+	if jobname_tpl.count("%s") != 1:
 		raise ArgumentValidationException("Expected one \"%s\" placeholder in the job name template.")
 
-	if not os.path.exists(parsed.git_repo_path):
-		raise ArgumentValidationException("Git directory does not exist: " + parsed.git_repo_path)
+	if remote_url is not None:
+		# created on the first refresh
+		if not os.path.isdir(os.path.dirname(os.path.abspath(git_repo_path))):
+			raise ArgumentValidationException("Parent directory of the Git directory does not exist: " + git_repo_path)
+	elif not os.path.exists(git_repo_path):
+		raise ArgumentValidationException("Git directory does not exist: " + git_repo_path)
 
 	try:
-		re.match(parsed.ref_regex, "")
+		re.match(ref_regex, "")
 	except Exception as e:
-		raise ArgumentValidationException("Malformed regular expression '" + parsed.ref_regex + "': " + str(e))
+		raise ArgumentValidationException("Malformed regular expression '" + ref_regex + "': " + str(e))
 
+"""
+Load the sync targets from a JSON or YAML (needs PyYAML) config file:
+
+	{"targets": [{
+		"name": "acme",
+		"tpl_job": "TEMPLATE Build ACME",
+		"job_name_tpl": "Build ACME %s",
+		"git_repo": "/tmp/acme",
+		"ref_regex": "^refs/remotes/origin/dev/",
+		"max_commit_age": 30
+	}, ...]}
+
+"name" is used for the state directory of the target (below --state-dir)
+and defaults to the job name template, "max_commit_age" defaults to
+--max-commit-age. Optional "remote_url" and "job_folder" are like
+--remote-url and --job-folder for the target. Returns a list of target dicts.
+"""
+def _load_sync_config(path, max_commit_age):
+	with open(path) as f:
+		if path.endswith(".yaml") or path.endswith(".yml"):
+			try:
+				import yaml
+			except ImportError:
+				raise ArgumentValidationException("PyYAML is needed to read YAML config files, use JSON instead")
+
+			config = yaml.safe_load(f)
+		else:
+			config = json.load(f)
+
+	targets = []
+
+	for target in config.get("targets", []):
+		for key in ["tpl_job", "job_name_tpl", "git_repo", "ref_regex"]:
+			if key not in target:
+				raise ArgumentValidationException("Missing \"%s\" in sync target %s" % (key, json.dumps(target)))
+
+		_validate_target(target["job_name_tpl"], target["git_repo"], target["ref_regex"], target.get("remote_url"))
+
+		target = dict(target)
+		target.setdefault("name", _sanitize_name(target["job_name_tpl"].replace("%s", "")).strip("-"))
+		target.setdefault("max_commit_age", max_commit_age)
 
-def main(args):
+		targets.append(target)
+
+	if len(targets) == 0:
+		raise ArgumentValidationException("No sync targets in config file: " + path)
+
+	return targets
+
+# Sync all targets of a config file with one shared backend
+# Get the SyncOptions of the parsed arguments, "options" override them
+def _get_sync_options(parsed, **options):
+	values = {
+		"discovery_workers": parsed.discovery_workers,
+		"update_drifted": parsed.update_drifted,
+		"state_dir": parsed.state_dir,
+		"full_refresh_interval": parsed.full_refresh_interval,
+		"mutation_workers": parsed.mutation_workers,
+		"backend": parsed.backend,
+		"http_user": parsed.http_user,
+		"http_token": parsed.http_token,
+		"batch_mutations": parsed.batch_mutations,
+		"match_jobs_by_name": parsed.match_jobs_by_name,
+		"metrics_out": parsed.metrics_out,
+		"time_budget": parsed.time_budget,
+		"remote_url": parsed.remote_url,
+		"remote": parsed.ref_updates_remote,
+		"job_folder": parsed.job_folder,
+		"throttle_latency": parsed.throttle_latency,
+		"throttle_queue_length": parsed.throttle_queue_length,
+		"disable_stale": parsed.disable_stale,
+		"shard": parsed.shard
+	}
+	values.update(options)
+
+	return SyncOptions(**values)
+
+
+def _sync_targets(parsed):
+	targets = _load_sync_config(parsed.config, parsed.max_commit_age or DEFAULT_MAX_COMMIT_AGE)
+
+	connection = SharedJenkinsBackend(_create_backend(
+		parsed.backend, parsed.jenkins_host, parsed.jar, parsed.ssh_key, parsed.http_user, parsed.http_token
+	))
+
+	# one report for all targets
+	metrics = Metrics()
+
+	# the operations of all targets go to the same Jenkins
+	throttle = None
+
+	if parsed.throttle_latency is not None:
+		throttle = AdaptiveThrottle(
+			1, parsed.mutation_workers, parsed.throttle_latency,
+			max_queue_length=parsed.throttle_queue_length,
+			queue_length=(connection.get_queue_length if hasattr(connection, "get_queue_length") else None)
+		)
+
+	syncs = []
+
+	for target in targets:
+		state_dir = None
+
+		if parsed.state_dir is not None:
+			state_dir = os.path.join(parsed.state_dir, target["name"])
+
+			if not os.path.isdir(state_dir):
+				os.mkdir(state_dir)
+
+			state_dir = _get_shard_state_dir(state_dir, parsed.shard)
+
+		# the metrics are written once for all targets
+		options = _get_sync_options(
+			parsed, state_dir=state_dir, metrics_out=None,
+			remote_url=target.get("remote_url"), job_folder=target.get("job_folder", parsed.job_folder)
+		)
+
+		syncs.append(GitJenkinsSync(
+			parsed.jenkins_host, parsed.jar, parsed.ssh_key,
+			target["tpl_job"], target["job_name_tpl"],
+			target["git_repo"], target["ref_regex"], target["max_commit_age"],
+			options=options, connection=connection, metrics=metrics, throttle=throttle
+		))
+
+	if parsed.gc_tombstones is not None:
+		results = _parallel_map(lambda sync: sync.gc(parsed.gc_tombstones), syncs, parsed.target_workers)
+	else:
+		# the first target to discover its jobs lists them for all targets
+		results = _parallel_map(lambda sync: sync.sync(), syncs, parsed.target_workers)
+
+	if parsed.metrics_out is not None:
+		metrics.write(parsed.metrics_out)
+
+	if throttle is not None:
+		print "Throttled: %s" % throttle.get_report()
+
+	for target, result in zip(targets, results):
+		if result[2] is not None:
+			print "Failed to sync target '%s': %s" % (target["name"], str(result[2]))
+
+
+# Run with the command line arguments "args", the lock of a run is taken by
+# lock_factory(path), FileLock by default
+def main(args, lock_factory=FileLock):
 		# add_help=False,
 	parser = CustomParser(
 		prog=BINARY_NAME,
@@ -270,45 +3293,215 @@ def main(args):
 		help="URL to Jenkins in form <protocol>://<host>[:port][<path>]/"
 	)
 	parser.add_argument(
-		'-S', '--key', dest="ssh_key", action='store', metavar="PATH", required=True,
-		help="Path to the SSH key used for authentication"
+		'-S', '--key', dest="ssh_key", action='store', metavar="PATH", required=False,
+		help="Path to the SSH key used for authentication (CLI backend)"
+	)
+	parser.add_argument(
+		'-j', '--jar', dest="jar", action='store', metavar="PATH", required=False,
+		help="Path to the Jenkins CLI .jar (CLI backend)"
+	)
+	parser.add_argument(
+		'--backend', dest="backend", action='store', choices=[BACKEND_CLI, BACKEND_HTTP], required=False,
+		default=BACKEND_CLI,
+		help="Talk to Jenkins using the jenkins-cli or the remote API over HTTP. Defaults to %s" % BACKEND_CLI
+	)
+	parser.add_argument(
+		'--http-user', dest="http_user", action='store', metavar="USER", required=False,
+		help="User name for the remote API (HTTP backend)"
 	)
 	parser.add_argument(
-		'-j', '--jar', dest="jar", action='store', metavar="PATH", required=True,
-		help="Path to the Jenkins CLI .jar"
+		'--http-token', dest="http_token", action='store', metavar="TOKEN", required=False,
+		help="API token of the user for the remote API (HTTP backend)"
 	)
 	parser.add_argument(
-		'-G', '--git-repo', dest="git_repo_path", action='store', metavar="PATH", required=True,
+		'-G', '--git-repo', dest="git_repo_path", action='store', metavar="PATH", required=False,
 		help="Path to the Git repository"
 	)
 	parser.add_argument(
-		'-T', '--tpl-job', dest="tpl_job", action='store', metavar="JOBNAME", required=True,
+		'-T', '--tpl-job', dest="tpl_job", action='store', metavar="JOBNAME", required=False,
 		help="Name of the job used as template"
 	)
 	parser.add_argument(
-		'-n', '--job-name-tpl', dest="jobname_tpl", action='store', metavar="NAME", required=True,
+		'-n', '--job-name-tpl', dest="jobname_tpl", action='store', metavar="NAME", required=False,
 		help="Name template for the jobs being created, should contain \"%%s\" as placeholder for the branch name"
 	)
 	parser.add_argument(
-		'-R', '--ref-regex', dest="ref_regex", action='store', metavar="REGEX", required=True,
+		'-R', '--ref-regex', dest="ref_regex", action='store', metavar="REGEX", required=False,
 		help="Regular expression matching the branch names to create jobs for"
 	)
+	parser.add_argument(
+		'-C', '--config', dest="config", action='store', metavar="PATH", required=False,
+		help="JSON or YAML file with several sync targets to sync instead of --git-repo, --tpl-job, --job-name-tpl and --ref-regex"
+	)
+	parser.add_argument(
+		'--target-workers', dest="target_workers", action=WorkersSwitchAction, type=int, metavar="N", required=False,
+		default=DEFAULT_TARGET_WORKERS,
+		help="Number of sync targets of --config synced in parallel. Defaults to %d" % DEFAULT_TARGET_WORKERS
+	)
 	parser.add_argument(
 		'-a', '--max-commit-age', dest="max_commit_age", action=MaxAgeSwitchAction, type=int, metavar="DAYS", required=False,
 		help="Max days the last commit was made on a branch. Defaults to %d" % DEFAULT_MAX_COMMIT_AGE
 	)
+	parser.add_argument(
+		'--discovery-workers', dest="discovery_workers", action=WorkersSwitchAction, type=int, metavar="N", required=False,
+		default=DEFAULT_DISCOVERY_WORKERS,
+		help="Number of job configs read in parallel during discovery. Defaults to %d" % DEFAULT_DISCOVERY_WORKERS
+	)
+	parser.add_argument(
+		'--mutation-workers', dest="mutation_workers", action=WorkersSwitchAction, type=int, metavar="N", required=False,
+		default=DEFAULT_MUTATION_WORKERS,
+		help="Number of jobs created or removed in parallel. Defaults to %d" % DEFAULT_MUTATION_WORKERS
+	)
+	parser.add_argument(
+		'--throttle-latency', dest="throttle_latency", action='store', type=float, metavar="SECONDS", required=False,
+		help="Adapt the number of jobs created or removed in parallel (up to --mutation-workers, at least 2, for all --config targets together) to the load of Jenkins: lowered when an operation takes longer than SECONDS or fails, raised otherwise"
+	)
+	parser.add_argument(
+		'--throttle-queue-length', dest="throttle_queue_length", action='store', type=int, metavar="N", required=False,
+		help="With --throttle-latency also lower the number of parallel operations while more than N builds are queued (HTTP backend)"
+	)
+	parser.add_argument(
+		'--batch-mutations', dest="batch_mutations", action='store_true', required=False,
+		help="Remove and create all jobs with one jenkins-cli Groovy script (CLI backend)"
+	)
+	parser.add_argument(
+		'--watch', dest="watch", action='store_true', required=False,
+		help="Keep running and sync the refs that changed whenever the refs of the repository change"
+	)
+	parser.add_argument(
+		'--watch-interval', dest="watch_interval", action='store', type=float, metavar="SECONDS", required=False,
+		default=DEFAULT_WATCH_INTERVAL,
+		help="Seconds between two checks for changed refs in watch mode. Defaults to %d" % DEFAULT_WATCH_INTERVAL
+	)
+	parser.add_argument(
+		'--watch-debounce', dest="watch_debounce", action='store', type=float, metavar="SECONDS", required=False,
+		default=DEFAULT_WATCH_DEBOUNCE,
+		help="Seconds without further ref changes before syncing in watch mode. Defaults to %d" % DEFAULT_WATCH_DEBOUNCE
+	)
+	parser.add_argument(
+		'--full-sync-interval', dest="full_sync_interval", action='store', type=int, metavar="SECONDS", required=False,
+		default=DEFAULT_FULL_SYNC_INTERVAL,
+		help="Seconds between two full syncs in watch mode. Defaults to %d" % DEFAULT_FULL_SYNC_INTERVAL
+	)
+	parser.add_argument(
+		'--ref-updates', dest="ref_updates", action='store', metavar="PATH", required=False,
+		help="Sync only the refs from a file (\"-\" for stdin) with \"<old-sha> <new-sha> <ref>\" lines as written by a post-receive hook"
+	)
+	parser.add_argument(
+		'--ref-updates-remote', dest="ref_updates_remote", action='store', metavar="NAME", required=False,
+		default=DEFAULT_REF_UPDATES_REMOTE,
+		help="Remote whose tracking refs the refs/heads/ refs of --ref-updates and --remote-url are. Defaults to %s" % DEFAULT_REF_UPDATES_REMOTE
+	)
+	parser.add_argument(
+		'--job-folder', dest="job_folder", action='store', metavar="PATH", required=False,
+		help="Full name of the Jenkins folder to create, list and remove the branch jobs in, like \"acme/branches\". The template job is given by its full name and can be outside of it"
+	)
+	parser.add_argument(
+		'--remote-url', dest="remote_url", action='store', metavar="URL", required=False,
+		help="Refresh the refs of --git-repo from this remote before each sync, fetching only the tip commits of new matching branches. The repository is created if it does not exist"
+	)
+	parser.add_argument(
+		'--plan', dest="plan", action='store', metavar="PATH", required=False,
+		help="Discover the branches and jobs and write the jobs to create and remove to a plan file instead of changing any job"
+	)
+	parser.add_argument(
+		'--apply', dest="apply", action='store', metavar="PATH", required=False,
+		help="Create and remove the jobs of a plan file written by --plan, checking only the branches and jobs of the plan for changes since"
+	)
+	parser.add_argument(
+		'--disable-stale', dest="disable_stale", action='store_true', required=False,
+		help="Disable the jobs of branches that are gone or too old instead of removing them, and enable them again if the branch comes back (needs --state-dir)"
+	)
+	parser.add_argument(
+		'--gc-tombstones', dest="gc_tombstones", action='store', type=int, metavar="DAYS", required=False,
+		help="Instead of a sync, remove the jobs disabled by --disable-stale more than DAYS days ago"
+	)
+	parser.add_argument(
+		'--update-drifted', dest="update_drifted", action='store_true', required=False,
+		help="Update existing branch jobs whose config differs from the template job"
+	)
+	parser.add_argument(
+		'--match-jobs-by-name', dest="match_jobs_by_name", action='store_true', required=False,
+		help="Take jobs named like a branch to be configured for it without reading their config"
+	)
+	parser.add_argument(
+		'--time-budget', dest="time_budget", action='store', type=int, metavar="SECONDS", required=False,
+		help="Seconds a sync may take, no job is created or removed after. Jobs for the newest branches are created first, what is left is done first by the next run (recorded in --state-dir)"
+	)
+	parser.add_argument(
+		'--metrics-out', dest="metrics_out", action='store', metavar="PATH", required=False,
+		help="Write the phase timings, backend calls and latencies after each sync, as JSON if PATH ends with .json, for the Prometheus textfile collector otherwise"
+	)
+	parser.add_argument(
+		'--shard', dest="shard", action='store', type=_parse_shard, metavar="I/N", required=False,
+		help="Sync only the branches and jobs of shard I of N (like 1/4), by a hash of the job name, to sync one set of jobs with N processes or hosts. The state of a shard is kept in a directory of its own below --state-dir"
+	)
+	parser.add_argument(
+		'--lock-file', dest="lock_file", action='store', metavar="PATH", required=False,
+		help="Take a lock on this file for the run, a run finding it held fails. Defaults to a file in the state directory of the shard with --shard and --state-dir"
+	)
+	parser.add_argument(
+		'--state-dir', dest="state_dir", action='store', metavar="PATH", required=False,
+		help="Directory to keep state between runs in, like the job and ref caches"
+	)
+	parser.add_argument(
+		'--full-refresh-interval', dest="full_refresh_interval", action='store', type=int, metavar="HOURS", required=False,
+		default=DEFAULT_FULL_REFRESH_INTERVAL,
+		help="Hours after which all job configs are read again instead of using the job cache. Defaults to %d" % DEFAULT_FULL_REFRESH_INTERVAL
+	)
 
 	parsed = parser.parse_args(args)
 
 	_validate_arguments(parsed)
 
+	lock_file = parsed.lock_file
+
+	if lock_file is None and parsed.shard is not None and parsed.state_dir is not None:
+		lock_file = os.path.join(_get_shard_state_dir(parsed.state_dir, parsed.shard), LOCK_FILE)
+
+	if lock_file is None:
+		_run(parsed)
+		return
+
+	lock = lock_factory(lock_file)
+	lock.acquire()
+
+	try:
+		_run(parsed)
+	finally:
+		lock.release()
+
+# Run the sync (or plan, apply, ...) of the parsed arguments
+def _run(parsed):
+	if parsed.config is not None:
+		_sync_targets(parsed)
+		return
+
 	sync = GitJenkinsSync(
 		parsed.jenkins_host, parsed.jar, parsed.ssh_key,
 		parsed.tpl_job, parsed.jobname_tpl,
-		parsed.git_repo_path, parsed.ref_regex, parsed.max_commit_age
+		parsed.git_repo_path, parsed.ref_regex, parsed.max_commit_age,
+		options=_get_sync_options(
+			parsed,
+			state_dir=(_get_shard_state_dir(parsed.state_dir, parsed.shard) if parsed.state_dir is not None else None)
+		)
 	)
 
-	sync.sync()
+	if parsed.gc_tombstones is not None:
+		sync.gc(parsed.gc_tombstones)
+	elif parsed.plan is not None:
+		sync.plan(parsed.plan)
+	elif parsed.apply is not None:
+		sync.apply(parsed.apply)
+	elif parsed.watch:
+		sync.watch(parsed.watch_interval, parsed.watch_debounce, parsed.full_sync_interval)
+	elif parsed.ref_updates == "-":
+		sync.sync_refs(_read_ref_updates(sys.stdin, parsed.ref_updates_remote))
+	elif parsed.ref_updates is not None:
+		with open(parsed.ref_updates) as f:
+			sync.sync_refs(_read_ref_updates(f, parsed.ref_updates_remote))
+	else:
+		sync.sync()
 
 if __name__ == "__main__":
 	try:
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+import argparse
+import copy
+import json
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+import dulwich.repo
+
+import syncgit
+import syncgit_fakes
+
+
+# Time a full ref resolution, returns the seconds taken
+def time_get_branches(path):
+	gitbranches = syncgit.GitBranches(path, "^refs/remotes/origin/dev/", 365)
+
+	start = time.time()
+	gitbranches.get_branches()
+
+	return time.time() - start
+
+
+def bench_commit_times(ref_count):
+	path = tempfile.mkdtemp()
+
+	try:
+		commits = syncgit_fakes.create_synthetic_repo(path, ref_count)
+
+		without_graph = time_get_branches(path)
+
+		syncgit_fakes.write_commit_graph(os.path.join(path, ".git", "objects", "info", "commit-graph"), commits)
+
+		with_graph = time_get_branches(path)
+	finally:
+		shutil.rmtree(path)
+
+	print "%7d refs, commit objects: %8.3fs (%6.1fus/ref), commit-graph: %8.3fs (%6.1fus/ref)" % (
+		ref_count,
+		without_graph, without_graph * 1000000 / ref_count,
+		with_graph, with_graph * 1000000 / ref_count
+	)
+
+
+# A pipeline job template with a large inline script
+def create_bench_template(script_lines):
+	return "".join([
+		"<?xml version='1.1' encoding='UTF-8'?>\n<flow-definition plugin=\"workflow-job@2.40\">",
+		"<description>Build of */master</description>",
+		"<definition class=\"org.jenkinsci.plugins.workflow.cps.CpsScmFlowDefinition\">",
+		"<scm class=\"hudson.plugins.git.GitSCM\"><branches><hudson.plugins.git.BranchSpec><name>*/master</name></hudson.plugins.git.BranchSpec></branches></scm>",
+		"</definition>",
+		"<script>", "echo 'step' &amp;&amp; sh 'make test'\n" * script_lines, "</script>",
+		"</flow-definition>"
+	])
+
+
+def bench_render(job_count):
+	config = create_bench_template(5000)
+	branches = ["origin/dev/ACME-%d" % i for i in range(job_count)]
+
+	# parse, copy, modify and serialize the tree for every job
+	start = time.time()
+	root = ET.fromstring(config)
+
+	for branch in branches:
+		job_root = copy.deepcopy(root)
+		job_root.find(".//scm/branches/hudson.plugins.git.BranchSpec/name").text = branch
+		ET.tostring(job_root)
+
+	tree_seconds = time.time() - start
+
+	start = time.time()
+	template = syncgit.ConfigTemplate(config)
+
+	for branch in branches:
+		template.render({"branch": branch})
+
+	splice_seconds = time.time() - start
+
+	print "%7d jobs (%dKB config), element tree: %8.3fs (%8.1fus/job), compiled template: %8.3fs (%8.1fus/job)" % (
+		job_count, len(config) / 1024,
+		tree_seconds, tree_seconds * 1000000 / job_count,
+		splice_seconds, splice_seconds * 1000000 / job_count
+	)
+
+
+"""
+	Time syncs of a synthetic repository with "ref_count" refs against a fake
+	Jenkins. The commit times are spread over the last "age_days" days, refs
+	older than "max_age" days are expired. Jobs of an "existing_jobs"
+	fraction of the refs exist before the first sync, plus 10% jobs of refs
+	that are gone. Runs:
+
+	  full        -- the first sync, discovering and creating/removing jobs
+	  unchanged   -- a second sync, using the job and ref caches
+	  incremental -- a sync of the 10 refs that changed since
+
+	Returns a list of result dicts.
+"""
+def bench_sync(ref_count, packed, latency, existing_jobs, workers, age_days=60, max_age=30):
+	path = tempfile.mkdtemp()
+	state_dir = os.path.join(path, "state")
+	os.mkdir(state_dir)
+
+	try:
+		repo_path = os.path.join(path, "repo")
+		os.mkdir(repo_path)
+
+		commits = syncgit_fakes.create_synthetic_repo(repo_path, ref_count, age_days=age_days, packed=packed)
+
+		jobs = {"TEMPLATE Build ACME": syncgit_fakes.JOB_TEMPLATE}
+
+		# spread over recent and expired refs
+		for i in range(ref_count):
+			if int((i + 1) * existing_jobs) > int(i * existing_jobs):
+				jobs["Build ACME dev-ACME-%d" % i] = syncgit_fakes.get_job_config("origin/dev/ACME-%d" % i)
+
+		for i in range(ref_count // 10):
+			jobs["Build ACME dev-GONE-%d" % i] = syncgit_fakes.get_job_config("origin/dev/GONE-%d" % i)
+
+		backend = syncgit_fakes.FakeJenkinsBackend(jobs, latency)
+
+		def create_sync():
+			return syncgit.GitJenkinsSync(
+				None, None, None, "TEMPLATE Build ACME", "Build ACME %s",
+				repo_path, "^refs/remotes/origin/dev/", max_age,
+				options=syncgit.SyncOptions(discovery_workers=workers, mutation_workers=workers, state_dir=state_dir),
+				connection=backend, metrics=syncgit.Metrics()
+			)
+
+		results = []
+
+		def run(name, sync, operation):
+			calls = backend.calls
+			start = time.time()
+
+			# the sync prints every branch and job
+			stdout = sys.stdout
+			sys.stdout = open(os.devnull, "w")
+
+			try:
+				operations = operation()
+			finally:
+				sys.stdout.close()
+				sys.stdout = stdout
+
+			seconds = time.time() - start
+			phases = sync.get_metrics().get_report()["phases"]
+
+			results.append({
+				"refs": ref_count,
+				"layout": "packed" if packed else "loose",
+				"latency": latency,
+				"age_days": age_days,
+				"max_age": max_age,
+				"run": name,
+				"seconds": seconds,
+				"backend_calls": backend.calls - calls,
+				"operations": len(operations),
+				"phases": dict([(phase, x["seconds"]) for phase, x in phases.iteritems()])
+			})
+
+			print "%7d refs %-6s %-11s %8.3fs, %6d backend calls, %6d operations" % (ref_count, results[-1]["layout"], name, seconds, results[-1]["backend_calls"], len(operations))
+
+		sync = create_sync()
+		run("full", sync, sync.sync)
+
+		# a new process, everything but the caches is read again
+		sync = create_sync()
+		run("unchanged", sync, sync.sync)
+
+		# move 10 refs to other recent commits
+		repo = dulwich.repo.Repo(repo_path)
+		changed = {}
+
+		for i in range(min(10, ref_count // 2)):
+			changed["refs/remotes/origin/dev/ACME-%d" % (ref_count - 1 - i)] = commits[i].id
+
+		for ref, sha1 in changed.iteritems():
+			repo.refs[ref] = sha1
+
+		sync = create_sync()
+		run("incremental", sync, lambda: sync.sync_refs(set(changed.keys())))
+	finally:
+		shutil.rmtree(path)
+
+	return results
+
+
+# Get the revision of the working tree, None if not in a Git checkout
+def get_revision():
+	try:
+		return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, "w")).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+# Print the run times of "results" relative to the ones of an earlier results file
+def compare_results(results, path):
+	with open(path) as f:
+		baseline = json.load(f)
+
+	print "Compared to %s (revision %s):" % (path, baseline.get("revision"))
+
+	before = dict([((x["refs"], x["layout"], x["latency"], x["run"]), x["seconds"]) for x in baseline["results"]])
+
+	for result in results:
+		key = (result["refs"], result["layout"], result["latency"], result["run"])
+
+		if key not in before:
+			continue
+
+		print "%7d refs %-6s %-11s %8.3fs -> %8.3fs (%+.1f%%)" % (
+			key[0], key[1], key[3], before[key], result["seconds"],
+			(result["seconds"] - before[key]) * 100 / before[key] if before[key] > 0 else 0
+		)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmarks of the Git Jenkins job synchronization")
+	parser.add_argument("--refs", type=int, nargs="+", default=[1000, 10000], help="Numbers of refs to benchmark with")
+	parser.add_argument("--jobs", type=int, nargs="+", default=[100, 500], help="Numbers of job configs to render")
+	parser.add_argument("--sync-refs", type=int, nargs="+", default=[1000, 10000], help="Numbers of refs to time syncs with, like 1000 10000 100000")
+	parser.add_argument("--layouts", nargs="+", choices=["packed", "loose"], default=["packed", "loose"], help="Ref storage to time syncs with")
+	parser.add_argument("--latency", type=float, default=0.0, help="Seconds each call to the fake Jenkins takes")
+	parser.add_argument("--existing-jobs", type=float, default=0.5, help="Fraction of the refs with a job before the first sync")
+	parser.add_argument("--workers", type=int, default=4, help="Discovery and mutation workers of the syncs")
+	parser.add_argument("--age-days", type=int, default=60, help="Days the commit times of the synced refs are spread over")
+	parser.add_argument("--max-age", type=int, default=30, help="Max. commit age in days of the syncs, older refs are expired")
+	parser.add_argument("--only", nargs="+", choices=["commit-times", "render", "sync"], default=["commit-times", "render", "sync"], help="Benchmarks to run")
+	parser.add_argument("--out", help="Write the sync results to this JSON file")
+	parser.add_argument("--compare", help="Compare the sync results to the ones of an earlier --out file")
+
+	parsed = parser.parse_args()
+
+	if "commit-times" in parsed.only:
+		for ref_count in parsed.refs:
+			bench_commit_times(ref_count)
+
+	if "render" in parsed.only:
+		for job_count in parsed.jobs:
+			bench_render(job_count)
+
+	if "sync" not in parsed.only:
+		return
+
+	results = []
+
+	for ref_count in parsed.sync_refs:
+		for layout in parsed.layouts:
+			results += bench_sync(ref_count, layout == "packed", parsed.latency, parsed.existing_jobs, parsed.workers, parsed.age_days, parsed.max_age)
+
+	if parsed.out is not None:
+		with open(parsed.out, "w") as f:
+			json.dump({
+				"revision": get_revision(),
+				"python": platform.python_version(),
+				"time": time.time(),
+				"results": results
+			}, f, indent=2, sort_keys=True)
+
+	if parsed.compare is not None:
+		compare_results(results, parsed.compare)
+
+
+if __name__ == "__main__":
+	main()
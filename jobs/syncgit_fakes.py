@@ -0,0 +1,205 @@
+# Fakes and fixtures shared by the tests and the benchmarks of syncgit
+
+import binascii
+import hashlib
+import os
+import os.path
+import struct
+import threading
+import time
+
+import dulwich.objects
+import dulwich.repo
+
+# Parent position for "no parent" in the commit data chunk
+GRAPH_PARENT_NONE = 0x70000000
+
+"""
+	Write a commit-graph file for the given commits, in the format Git writes
+	to objects/info/commit-graph. All parents of the commits must be part of
+	the list and commits must not have more than two parents.
+
+	path    -- path of the commit-graph file
+	commits -- list of dulwich Commit objects
+"""
+def write_commit_graph(path, commits):
+	commits = sorted(commits, key=lambda c: c.id)
+	positions = dict([(c.id, i) for i, c in enumerate(commits)])
+	by_id = dict([(c.id, c) for c in commits])
+	generations = {}
+
+	def get_generation(commit):
+		if commit.id not in generations:
+			generations[commit.id] = 1 + max([0] + [get_generation(by_id[p]) for p in commit.parents])
+
+		return generations[commit.id]
+
+	fanout = [0] * 256
+
+	for commit in commits:
+		fanout[ord(binascii.unhexlify(commit.id)[0])] += 1
+
+	for i in range(1, 256):
+		fanout[i] += fanout[i - 1]
+
+	oid_fanout = struct.pack(">256I", *fanout)
+	oid_lookup = "".join([binascii.unhexlify(c.id) for c in commits])
+	commit_data = []
+
+	for commit in commits:
+		if len(commit.parents) > 2:
+			raise ValueError("Octopus merges are not supported: " + commit.id)
+
+		parents = [positions[p] for p in commit.parents] + [GRAPH_PARENT_NONE] * (2 - len(commit.parents))
+		upper = (get_generation(commit) << 2) | (commit.commit_time >> 32)
+
+		commit_data.append(binascii.unhexlify(commit.tree) + struct.pack(">IIII", parents[0], parents[1], upper, commit.commit_time & 0xffffffff))
+
+	chunks = [("OIDF", oid_fanout), ("OIDL", oid_lookup), ("CDAT", "".join(commit_data))]
+
+	# header, chunk table with a terminating entry, then the chunks
+	data = struct.pack(">4sBBBB", "CGPH", 1, 1, len(chunks), 0)
+	offset = len(data) + (len(chunks) + 1) * 12
+
+	for chunk_id, chunk in chunks:
+		data += struct.pack(">4sQ", chunk_id, offset)
+		offset += len(chunk)
+
+	data += struct.pack(">4sQ", "\0\0\0\0", offset)
+	data += "".join([chunk for chunk_id, chunk in chunks])
+
+	with open(path, "wb") as f:
+		f.write(data + hashlib.sha1(data).digest())
+
+
+"""
+	Create a repository with one commit per ref below refs/remotes/origin/dev/,
+	all objects packed. The commit times are spread evenly over the last
+	"age_days" days.
+
+	packed -- write the refs to packed-refs instead of loose ref files
+"""
+def create_synthetic_repo(path, ref_count, age_days=0, packed=True):
+	repo = dulwich.repo.Repo.init(path)
+
+	tree = dulwich.objects.Tree()
+	repo.object_store.add_object(tree)
+
+	now = int(time.time())
+	commits = []
+
+	for i in range(ref_count):
+		commit = dulwich.objects.Commit()
+		commit.tree = tree.id
+		commit.author = commit.committer = "Sync Bench <sync@example.com>"
+		commit.author_time = commit.commit_time = now - i - (i * age_days * 24 * 60 * 60) // ref_count
+		commit.author_timezone = commit.commit_timezone = 0
+		commit.message = "ACME-%d" % i
+		commits.append(commit)
+
+	repo.object_store.add_objects([(c, None) for c in commits])
+
+	refs = sorted([("refs/remotes/origin/dev/ACME-%d" % i, c.id) for i, c in enumerate(commits)])
+
+	if packed:
+		with open(os.path.join(path, ".git", "packed-refs"), "w") as f:
+			f.write("# pack-refs with: peeled fully-peeled sorted \n")
+
+			for ref, sha1 in refs:
+				f.write("%s %s\n" % (sha1, ref))
+	else:
+		os.makedirs(os.path.join(path, ".git", "refs", "remotes", "origin", "dev"))
+
+		for ref, sha1 in refs:
+			with open(os.path.join(path, ".git", ref), "w") as f:
+				f.write(sha1 + "\n")
+
+	return commits
+
+
+"""
+	An in-process Jenkins backend keeping the jobs in memory. Each call takes
+	at least "latency" seconds, like the round trip to a Jenkins server.
+	Thread-safe.
+
+	jobs -- dict of job name -> config to start with
+"""
+class FakeJenkinsBackend(object):
+
+	# jobs in folders are named "folder/job"
+	lists_folders = True
+
+	def __init__(self, jobs, latency=0):
+		self._jobs = dict(jobs)
+		self._latency = latency
+		self._lock = threading.Lock()
+
+		self.calls = 0
+		self.disabled = set()
+
+	def _call(self):
+		with self._lock:
+			self.calls += 1
+
+		if self._latency > 0:
+			time.sleep(self._latency)
+
+	def get_joblist(self, folder=None):
+		self._call()
+
+		prefix = folder + "/" if folder is not None else ""
+
+		with self._lock:
+			return sorted([job[len(prefix):] for job in self._jobs.keys() if job.startswith(prefix) and "/" not in job[len(prefix):]])
+
+	def get_job(self, job_name):
+		self._call()
+
+		with self._lock:
+			if job_name not in self._jobs:
+				raise Exception("No such job: " + job_name)
+
+			return self._jobs[job_name]
+
+	def create_job(self, job_name, config):
+		self._call()
+
+		with self._lock:
+			if job_name in self._jobs:
+				raise Exception("Job exists: " + job_name)
+
+			self._jobs[job_name] = config
+
+	def update_job(self, job_name, config):
+		self._call()
+
+		with self._lock:
+			self._jobs[job_name] = config
+
+	def enable_job(self, job_name):
+		self._call()
+
+		with self._lock:
+			self.disabled.discard(job_name)
+
+	def disable_job(self, job_name):
+		self._call()
+
+		with self._lock:
+			self.disabled.add(job_name)
+
+	def delete_job(self, job_name):
+		self._call()
+
+		with self._lock:
+			del self._jobs[job_name]
+			self.disabled.discard(job_name)
+
+
+# Template of the synced jobs
+JOB_TEMPLATE = "<project><scm class=\"hudson.plugins.git.GitSCM\"><branches><hudson.plugins.git.BranchSpec><name>*/master</name></hudson.plugins.git.BranchSpec></branches></scm></project>"
+
+
+# Get a job config for a branch as created by the sync
+def get_job_config(branch):
+	return JOB_TEMPLATE.replace("*/master", branch)
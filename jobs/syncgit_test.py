@@ -1,13 +1,35 @@
 
 import unittest
 import fudge
+import fudge.inspector
 import mox
 import re
 
 import os.path
 import sys
+import tempfile
+import shutil
+import threading
+import json
+import urllib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import base64
+import httplib
+import socket
+import time
+import hashlib
+import argparse
+import dulwich.repo
+import dulwich.objects
+import dulwich.server
+
+arg = fudge.inspector.arg
 
 import syncgit
+import syncgit_bench
+import syncgit_fakes
 
 class JenkinsTest(unittest.TestCase):
 
@@ -33,6 +55,168 @@ class JenkinsTest(unittest.TestCase):
 
 		jenkins.create_job("origin/dev/ACME-123-branch")
 
+	@fudge.patch("jenkinscli.JenkinsCli")
+	def test_create_jobs_fetches_template_once(self, JenkinsCli_mock):
+		jenkinscli_inst = (JenkinsCli_mock.expects_call()
+							.returns_fake())
+
+		(jenkinscli_inst.expects("get_job")
+			.with_args("TEMPLATE Build X")
+			.times_called(1)
+			.returns('<project><scm><branches><hudson.plugins.git.BranchSpec><name>*/master</name></hudson.plugins.git.BranchSpec></branches></scm></project>'))
+
+		(jenkinscli_inst.expects("create_job")
+			.with_args("Build X dev-ACME-123-branch", '<project><scm><branches><hudson.plugins.git.BranchSpec><name>origin/dev/ACME-123-branch</name></hudson.plugins.git.BranchSpec></branches></scm></project>')
+			.next_call()
+			.with_args("Build X dev-ACME-987-branch", '<project><scm><branches><hudson.plugins.git.BranchSpec><name>origin/dev/ACME-987-branch</name></hudson.plugins.git.BranchSpec></branches></scm></project>'))
+
+		jenkinscli_inst.provides("enable_job")
+
+		jenkins = syncgit.Jenkins("hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s")
+
+		jenkins.create_job("origin/dev/ACME-123-branch")
+		jenkins.create_job("origin/dev/ACME-987-branch")
+
+	@fudge.patch("jenkinscli.JenkinsCli")
+	def test_update_drifted_jobs(self, JenkinsCli_mock):
+		jenkinscli_inst = (JenkinsCli_mock.expects_call()
+							.returns_fake())
+
+		template = '<project><description>v2</description><scm><branches><hudson.plugins.git.BranchSpec><name>*/master</name></hudson.plugins.git.BranchSpec></branches></scm></project>'
+
+		configs = {
+			"TEMPLATE Build X": template,
+			# same as the template, only formatted differently
+			"Build X dev-ACME-123-branch": "\n".join([
+				"<?xml version='1.0' encoding='UTF-8'?>",
+				"<project>",
+				"  <description>v2</description>",
+				"  <scm>",
+				"    <branches>",
+				"      <hudson.plugins.git.BranchSpec>",
+				"        <name>origin/dev/ACME-123-branch</name>",
+				"      </hudson.plugins.git.BranchSpec>",
+				"    </branches>",
+				"  </scm>",
+				"</project>"
+			]),
+			# created from an older template
+			"Build X dev-ACME-987-branch": '<project><description>v1</description><scm><branches><hudson.plugins.git.BranchSpec><name>origin/dev/ACME-987-branch</name></hudson.plugins.git.BranchSpec></branches></scm></project>',
+			# drifted too, but is going to be removed
+			"Build X dev-ACME-000-branch": '<project><description>v1</description><scm><branches><hudson.plugins.git.BranchSpec><name>origin/dev/ACME-000-branch</name></hudson.plugins.git.BranchSpec></branches></scm></project>'
+		}
+
+		jenkinscli_inst.expects("get_joblist").returns(sorted(configs.keys()))
+		jenkinscli_inst.provides("get_job").calls(lambda job_name: configs[job_name])
+
+		(jenkinscli_inst.expects("update_job")
+			.with_args("Build X dev-ACME-987-branch", template.replace("*/master", "origin/dev/ACME-987-branch"))
+			.times_called(1))
+
+		jenkins = syncgit.Jenkins("hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s")
+
+		jenkins.get_currently_configured_branches()
+
+		jenkins.update_drifted_jobs(set([
+			"refs/remotes/origin/dev/ACME-123-branch",
+			"refs/remotes/origin/dev/ACME-987-branch"
+		]))
+
+	def test_discovery_does_not_hash_configs(self):
+		backend = syncgit_fakes.FakeJenkinsBackend({
+			"TEMPLATE Build X": syncgit_fakes.JOB_TEMPLATE,
+			"Build X dev-ACME-123-branch": syncgit_fakes.get_job_config("origin/dev/ACME-123-branch")
+		})
+
+		jenkins = syncgit.Jenkins(None, None, None, "TEMPLATE Build X", "Build X %s", connection=backend)
+
+		config_hash = syncgit._config_hash
+
+		# parses the whole config
+		syncgit._config_hash = lambda config: self.fail("Config hashed during discovery")
+
+		try:
+			self.assertEquals(["refs/remotes/origin/dev/ACME-123-branch"], jenkins.get_currently_configured_branches())
+			self.assertEquals(set(["refs/remotes/origin/dev/ACME-123-branch"]), jenkins.get_configured_branches_for(set(["refs/remotes/origin/dev/ACME-123-branch"])))
+		finally:
+			syncgit._config_hash = config_hash
+
+		# determined when needed
+		jenkins.update_drifted_jobs(set(["refs/remotes/origin/dev/ACME-123-branch"]))
+		self.assertEquals(("origin/dev/ACME-123-branch", config_hash(syncgit_fakes.get_job_config("origin/dev/ACME-123-branch"))), jenkins._configured_jobs["Build X dev-ACME-123-branch"])
+
+	def test_discovery_hashes_configs_for_update(self):
+		jobs = dict([("Build X dev-ACME-%d-branch" % i, syncgit_fakes.get_job_config("origin/dev/ACME-%d-branch" % i)) for i in range(5)])
+		jobs["TEMPLATE Build X"] = syncgit_fakes.JOB_TEMPLATE
+
+		backend = syncgit_fakes.FakeJenkinsBackend(jobs)
+
+		jenkins = syncgit.Jenkins(None, None, None, "TEMPLATE Build X", "Build X %s", connection=backend, hash_configs=True)
+
+		branches = set(jenkins.get_currently_configured_branches())
+		self.assertEquals(6, backend.calls)
+
+		# the unchanged jobs are not read again, only the template
+		jenkins.update_drifted_jobs(branches)
+		self.assertEquals(7, backend.calls)
+
+	@fudge.patch("jenkinscli.JenkinsCli")
+	def test_update_drifted_jobs_groovy(self, JenkinsCli_mock):
+		jenkinscli_inst = JenkinsCli_mock.expects_call().returns_fake()
+
+		template = '<project><description>v2</description><scm><branches><hudson.plugins.git.BranchSpec><name>*/master</name></hudson.plugins.git.BranchSpec></branches></scm></project>'
+
+		configs = {
+			"TEMPLATE Build X": template,
+			"Build X dev-ACME-987-branch": template.replace("v2", "v1").replace("*/master", "origin/dev/ACME-987-branch")
+		}
+
+		# like the jenkins-cli, no update_job
+		jenkinscli_inst.expects("get_joblist").returns(sorted(configs.keys()))
+		jenkinscli_inst.provides("get_job").calls(lambda job_name: configs[job_name])
+
+		jenkins = syncgit.Jenkins("hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s")
+
+		scripts = []
+		jenkins._run_groovy = scripts.append
+
+		jenkins.update_drifted_jobs(set(jenkins.get_currently_configured_branches()))
+
+		self.assertEquals(1, len(scripts))
+		self.assertTrue(syncgit._groovy_literals(base64.b64encode("Build X dev-ACME-987-branch")) in scripts[0])
+		self.assertTrue(syncgit._groovy_literals(base64.b64encode(template.replace("*/master", "origin/dev/ACME-987-branch"))) in scripts[0])
+
+	def test_update_drifted_jobs_keeps_state(self):
+		template = '<project><disabled>true</disabled><description>v1</description><scm><branches><hudson.plugins.git.BranchSpec><name>*/master</name></hudson.plugins.git.BranchSpec></branches></scm></project>'
+
+		backend = ConfigStateBackend({"TEMPLATE Build X": template})
+
+		jenkins = syncgit.Jenkins(None, None, None, "TEMPLATE Build X", "Build X %s", connection=backend)
+
+		jenkins.create_job("origin/dev/ACME-123-branch")
+		jenkins.create_job("origin/dev/ACME-987-branch")
+		backend.disable_job("Build X dev-ACME-987-branch")
+
+		self.assertTrue("<disabled>false</disabled>" in backend._jobs["Build X dev-ACME-123-branch"])
+
+		branches = set(jenkins.get_currently_configured_branches())
+
+		# only enabled (or disabled) since created from the disabled template
+		jenkins.update_drifted_jobs(branches)
+		self.assertEquals([], backend.updated)
+
+		backend._jobs["TEMPLATE Build X"] = template.replace("v1", "v2")
+		jenkins.reset_template()
+
+		jenkins.update_drifted_jobs(branches)
+
+		self.assertEquals(["Build X dev-ACME-123-branch", "Build X dev-ACME-987-branch"], backend.updated)
+		self.assertEquals(
+			template.replace("v1", "v2").replace("*/master", "origin/dev/ACME-123-branch").replace("true", "false"),
+			backend._jobs["Build X dev-ACME-123-branch"]
+		)
+		self.assertTrue("<disabled>true</disabled>" in backend._jobs["Build X dev-ACME-987-branch"])
+
 	@fudge.patch("jenkinscli.JenkinsCli")
 	def test_remove_job(self, JenkinsCli_mock):
 		jenkinscli_inst = (JenkinsCli_mock.expects_call()
@@ -45,6 +229,200 @@ class JenkinsTest(unittest.TestCase):
 
 		jenkins.remove_job("origin/dev/ACME-123-branch")
 
+	@fudge.patch("jenkinscli.JenkinsCli", "subprocess.Popen")
+	def test_run_batch(self, JenkinsCli_mock, Popen_mock):
+		jenkinscli_inst = (JenkinsCli_mock.expects_call()
+							.returns_fake())
+
+		template = '<project><scm><branches><hudson.plugins.git.BranchSpec><name>*/master</name></hudson.plugins.git.BranchSpec></branches></scm></project>'
+
+		(jenkinscli_inst.expects("get_job")
+			.with_args("TEMPLATE Build X")
+			.returns(template))
+
+		scripts = []
+
+		def communicate_fake(script):
+			scripts.append(script)
+
+			return ("\n".join([
+				"SYNCGIT\tOK\tremove\tBuild X dev-ACME-000-branch\t120",
+				"SYNCGIT\tOK\tcreate\tBuild X dev-ACME-123-branch\t2500",
+				"SYNCGIT\tFAILED\tcreate\tBuild X dev-ACME-987-branch\t10\tjava.lang.IllegalArgumentException: Job exists",
+				"Result: null"
+			]), "")
+
+		process = (Popen_mock.expects_call()
+			.with_args(
+				["java", "-jar", "/tmp/cli.jar", "-s", "hostname", "-i", "/tmp/ssh-key", "groovy", "="],
+				stdin=arg.any(), stdout=arg.any(), stderr=arg.any()
+			)
+			.returns_fake()
+			.has_attr(returncode=0))
+		process.expects("communicate").calls(communicate_fake)
+
+		jenkins = syncgit.Jenkins("hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s")
+
+		results = jenkins.run_batch(
+			["origin/dev/ACME-000-branch"],
+			["origin/dev/ACME-123-branch", "origin/dev/ACME-987-branch", "origin/dev/ACME-555-branch"]
+		)
+
+		# all jobs and their configs are passed to the one script
+		self.assertTrue(base64.b64encode("Build X dev-ACME-000-branch") in scripts[0])
+		self.assertTrue(base64.b64encode(template.replace("*/master", "origin/dev/ACME-555-branch")) in scripts[0])
+
+		self.assertEquals(("remove", "origin/dev/ACME-000-branch", None, 0.12), results[0])
+		self.assertEquals(("create", "origin/dev/ACME-123-branch", None, 2.5), results[1])
+		self.assertEquals("java.lang.IllegalArgumentException: Job exists", str(results[2][2]))
+		# no result line for the job
+		self.assertEquals("No result reported by the script", str(results[3][2]))
+
+	@fudge.patch("jenkinscli.JenkinsCli")
+	def test_run_batch_large_configs(self, JenkinsCli_mock):
+		jenkinscli_inst = JenkinsCli_mock.expects_call().returns_fake()
+
+		# base64 encoded longer than Groovy string constants may be
+		template = '<project><description>%s</description><scm><branches><hudson.plugins.git.BranchSpec><name>*/master</name></hudson.plugins.git.BranchSpec></branches></scm></project>' % ("x" * 60000)
+
+		jenkinscli_inst.expects("get_job").with_args("TEMPLATE Build X").returns(template)
+
+		jenkins = syncgit.Jenkins("hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s")
+
+		job_names = ["Build X dev-ACME-%d-branch" % i for i in range(40)]
+		scripts = []
+
+		def run_groovy_fake(script):
+			scripts.append(script)
+
+			if len(scripts) == 2:
+				raise Exception("Groovy script failed with exit code 1: channel closed")
+
+			return "\n".join(["SYNCGIT\tOK\tcreate\t%s\t100" % x for x in job_names if "'%s'" % base64.b64encode(x) in script])
+
+		jenkins._run_groovy = run_groovy_fake
+
+		results = jenkins.run_batch([], ["origin/dev/ACME-%d-branch" % i for i in range(40)])
+
+		# split into several scripts, no literal is too long
+		self.assertTrue(len(scripts) > 2)
+
+		for script in scripts:
+			self.assertTrue(max([len(x) for x in re.findall("'([^']*)'", script)]) <= syncgit.BATCH_LITERAL_SIZE)
+
+		config = base64.b64encode(template.replace("*/master", "origin/dev/ACME-0-branch"))
+		self.assertTrue(syncgit._groovy_literals(config) in scripts[0])
+
+		# the jobs of the failed script are reported as failed
+		self.assertEquals(40, len(results))
+		failed = [x[1] for x in results if x[2] is not None]
+
+		self.assertTrue(len(failed) > 0)
+		self.assertEquals(sorted(failed), sorted([x.replace("Build X dev-", "origin/dev/") for x in job_names if "'%s'" % base64.b64encode(x) in scripts[1]]))
+		self.assertEquals("Groovy script failed with exit code 1: channel closed", str([x for x in results if x[2] is not None][0][2]))
+
+	@fudge.patch("jenkinscli.JenkinsCli", "subprocess.Popen")
+	def test_job_folder(self, JenkinsCli_mock, Popen_mock):
+		jenkinscli_inst = JenkinsCli_mock.expects_call().returns_fake()
+
+		# the jenkins-cli lists the folder with a Groovy script
+		scripts = []
+
+		def communicate_fake(script):
+			scripts.append(script)
+			return ("SYNCGIT\tBuild X dev-ACME-123-branch\nSYNCGIT\tother job\nResult: null\n", "")
+
+		process = Popen_mock.expects_call().returns_fake().has_attr(returncode=0)
+		process.expects("communicate").calls(communicate_fake)
+
+		(jenkinscli_inst.expects("get_job")
+			.with_args("acme/branches/Build X dev-ACME-123-branch")
+			.returns(self._build_br_cfg_fragment("origin/dev/ACME-123-branch"))
+			# the template is outside of the folder
+			.next_call()
+			.with_args("TEMPLATE Build X")
+			.returns('<project><scm><branches><hudson.plugins.git.BranchSpec><name>*/master</name></hudson.plugins.git.BranchSpec></branches></scm></project>'))
+
+		jenkins = syncgit.Jenkins("hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s", job_folder="acme/branches")
+
+		self.assertEquals(["refs/remotes/origin/dev/ACME-123-branch"], jenkins.get_currently_configured_branches())
+		self.assertTrue(base64.b64encode("acme/branches") in scripts[0])
+
+		jenkinscli_inst.expects("create_job").with_args("acme/branches/Build X dev-ACME-987-branch", arg.any())
+		jenkinscli_inst.expects("enable_job").with_args("acme/branches/Build X dev-ACME-987-branch")
+		jenkinscli_inst.expects("delete_job").with_args("acme/branches/Build X dev-ACME-123-branch")
+
+		jenkins.create_job("origin/dev/ACME-987-branch")
+		jenkins.remove_job("origin/dev/ACME-123-branch")
+
+	@fudge.patch("jenkinscli.JenkinsCli")
+	def test_get_configured_branches_for(self, JenkinsCli_mock):
+		cache_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, cache_dir)
+		cache_file = os.path.join(cache_dir, "jobs.json")
+
+		with open(cache_file, "w") as f:
+			json.dump({
+				"job_name_tpl": "Build X %s",
+				"refreshed": time.time(),
+				"jobs": {"Build X dev-ACME-123-branch": ["origin/dev/ACME-123-branch", "0123"]}
+			}, f)
+
+		def get_job_fake(job_name):
+			if job_name == "Build X dev-ACME-987-branch":
+				return self._build_br_cfg_fragment("origin/dev/ACME-987-branch")
+
+			raise Exception("No such job: " + job_name)
+
+		# no job list, only the jobs not in the cache are read
+		jenkinscli_inst = JenkinsCli_mock.expects_call().returns_fake()
+		jenkinscli_inst.expects("get_job").calls(get_job_fake).times_called(2)
+
+		jenkins = syncgit.Jenkins("hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s", cache_file=cache_file)
+
+		self.assertEquals(set([
+			"refs/remotes/origin/dev/ACME-123-branch",
+			"refs/remotes/origin/dev/ACME-987-branch"
+		]), jenkins.get_configured_branches_for(set([
+			"refs/remotes/origin/dev/ACME-123-branch",
+			"refs/remotes/origin/dev/ACME-987-branch",
+			"refs/remotes/origin/dev/ACME-555-branch"
+		])))
+
+	@fudge.patch("jenkinscli.JenkinsCli")
+	def test_get_branch_from_config(self, JenkinsCli_mock):
+		JenkinsCli_mock.expects_call().returns_fake()
+
+		jenkins = syncgit.Jenkins("hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s")
+
+		# first of more than one branch spec
+		self.assertEquals("origin/dev/ACME-123-branch", jenkins._get_branch_from_config(
+			'<project><scm><branches>'
+			'<hudson.plugins.git.BranchSpec><name>origin/dev/ACME-123-branch</name></hudson.plugins.git.BranchSpec>'
+			'<hudson.plugins.git.BranchSpec><name>origin/dev/ACME-987-branch</name></hudson.plugins.git.BranchSpec>'
+			'</branches></scm></project>'
+		))
+
+		# Git SCM in a multiple SCMs block
+		self.assertEquals("origin/dev/ACME-555-branch", jenkins._get_branch_from_config(
+			'<project><scm class="org.jenkinsci.plugins.multiplescms.MultiSCM"><scms><hudson.plugins.git.GitSCM><branches>'
+			'<hudson.plugins.git.BranchSpec><name>origin/dev/ACME-555-branch</name></hudson.plugins.git.BranchSpec>'
+			'</branches></hudson.plugins.git.GitSCM></scms></scm></project>'
+		))
+
+		# pipeline job, the large script after the branch spec is not parsed
+		self.assertEquals("origin/dev/ACME-444-branch", jenkins._get_branch_from_config(
+			'<flow-definition><definition class="org.jenkinsci.plugins.workflow.cps.CpsScmFlowDefinition"><scm><branches>'
+			'<hudson.plugins.git.BranchSpec><name>origin/dev/ACME-444-branch</name></hudson.plugins.git.BranchSpec>'
+			'</branches></scm></definition><script>' + ("echo 'x'\n" * 100000) + '<not-well-formed></flow-definition>'
+		))
+
+		# branches outside of an SCM do not count
+		self.assertEquals(None, jenkins._get_branch_from_config(
+			'<project><properties><branches><hudson.plugins.git.BranchSpec><name>origin/dev/ACME-123-branch</name></hudson.plugins.git.BranchSpec></branches></properties></project>'
+		))
+
+
 	# Get Jenkins/Git config fragment containing the Git (branches) config
 	def _build_br_cfg_fragment(self, name):
 		return "".join([
@@ -86,6 +464,700 @@ class JenkinsTest(unittest.TestCase):
 
 		jenkins.get_currently_configured_branches()
 
+	@fudge.patch("jenkinscli.JenkinsCli")
+	def test_get_currently_configured_branches_by_name(self, JenkinsCli_mock):
+		jenkinscli_inst = JenkinsCli_mock.expects_call().returns_fake()
+
+		jenkinscli_inst.expects("get_joblist").returns([
+			"Build X dev-ACME-123-branch",
+			"Build X dev-ACME-987-branch",
+			"Build X dev-ACME-a-b",
+			"Build X (copy) dev-ACME-000"
+		])
+
+		# only the job without a ref and the one of colliding refs are read
+		read = []
+
+		def get_job_fake(job_name):
+			read.append(job_name)
+			return self._build_br_cfg_fragment("origin/dev/ACME-a.b")
+
+		jenkinscli_inst.provides("get_job").calls(get_job_fake)
+
+		jenkins = syncgit.Jenkins("hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s")
+
+		self.assertEquals(set([
+			"refs/remotes/origin/dev/ACME-a.b",
+			"refs/remotes/origin/dev/ACME-a+b"
+		]), jenkins.index_job_names([
+			"refs/remotes/origin/dev/ACME-123-branch",
+			"refs/remotes/origin/dev/ACME-555-branch",
+			"refs/remotes/origin/dev/ACME-a.b",
+			"refs/remotes/origin/dev/ACME-a+b"
+		]))
+
+		self.assertEquals([
+			"refs/remotes/origin/dev/ACME-123-branch",
+			"refs/remotes/origin/dev/ACME-a.b",
+			"refs/remotes/origin/dev/ACME-a.b"
+		], jenkins.get_currently_configured_branches(by_name=True))
+
+		self.assertEquals(["Build X dev-ACME-987-branch", "Build X dev-ACME-a-b"], sorted(read))
+
+	@fudge.patch("jenkinscli.JenkinsCli")
+	def test_get_currently_configured_branches_parallel(self, JenkinsCli_mock):
+		jenkinscli_inst = (JenkinsCli_mock.expects_call()
+							.returns_fake())
+
+		jobs = ["Build X dev-ACME-%03d-branch" % i for i in range(20)]
+
+		jenkinscli_inst.expects("get_joblist").returns(["Other Job"] + jobs)
+
+		def get_job_fake(job_name):
+			if job_name == "Build X dev-ACME-007-branch":
+				raise Exception("Connection reset")
+
+			return self._build_br_cfg_fragment("origin/dev/ACME-%s-branch" % job_name[17:20])
+
+		jenkinscli_inst.provides("get_job").calls(get_job_fake)
+
+		jenkins = syncgit.Jenkins("hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s", discovery_workers=4)
+
+		branches = jenkins.get_currently_configured_branches()
+
+		# the failed job is left out, the order is the order of the job list
+		self.assertEquals(
+			["refs/remotes/origin/dev/ACME-%03d-branch" % i for i in range(20) if i != 7],
+			branches,
+			"The branches should be in job list order"
+		)
+
+		# the job that could not be read must not be created again, it is reported as skipped
+		self.assertRaises(syncgit.SkippedJobException, jenkins.create_job, "origin/dev/ACME-007-branch")
+
+		def run_groovy_fake(script):
+			self.fail("No script should be run")
+
+		jenkins._run_groovy = run_groovy_fake
+
+		results = jenkins.run_batch([], ["origin/dev/ACME-007-branch"])
+
+		self.assertEquals(1, len(results))
+		self.assertEquals(("create", "origin/dev/ACME-007-branch"), results[0][:2])
+		self.assertTrue(isinstance(results[0][2], syncgit.SkippedJobException))
+
+	@fudge.patch("jenkinscli.JenkinsCli")
+	def test_get_currently_configured_branches_cached(self, JenkinsCli_mock):
+		cache_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, cache_dir)
+		cache_file = os.path.join(cache_dir, "jobs.json")
+
+		configs = {
+			"TEMPLATE Build X": self._build_br_cfg_fragment("*/master"),
+			"Build X dev-ACME-123-branch": self._build_br_cfg_fragment("origin/dev/ACME-123-branch"),
+			"Build X dev-ACME-987-branch": self._build_br_cfg_fragment("origin/dev/ACME-987-branch"),
+			"Build X dev-ACME-555-branch": self._build_br_cfg_fragment("origin/dev/ACME-555-branch")
+		}
+
+		read_configs = []
+
+		def get_job_fake(job_name):
+			read_configs.append(job_name)
+			return configs[job_name]
+
+		jenkinscli_inst = JenkinsCli_mock.is_callable().returns_fake()
+		jenkinscli_inst.provides("get_job").calls(get_job_fake)
+		jenkinscli_inst.provides("create_job")
+		jenkinscli_inst.provides("enable_job")
+		jenkinscli_inst.provides("delete_job")
+
+		joblist = ["Build X dev-ACME-123-branch", "Build X dev-ACME-987-branch"]
+		jenkinscli_inst.provides("get_joblist").calls(lambda: list(joblist))
+
+		# first run reads all configs, creates and removes a job
+
+		jenkins = syncgit.Jenkins("hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s", cache_file=cache_file)
+		jenkins.get_currently_configured_branches()
+		jenkins.create_job("origin/dev/ACME-555-branch")
+		jenkins.remove_job("origin/dev/ACME-987-branch")
+		jenkins.save_cache()
+
+		self.assertEquals(["Build X dev-ACME-123-branch", "Build X dev-ACME-987-branch", "TEMPLATE Build X"], sorted(read_configs))
+
+		# second run reads only the configs of jobs not in the cache
+		del read_configs[:]
+		joblist[:] = ["Build X dev-ACME-123-branch", "Build X dev-ACME-555-branch", "Build X dev-ACME-777-branch"]
+		configs["Build X dev-ACME-777-branch"] = self._build_br_cfg_fragment("origin/dev/ACME-777-branch")
+
+		jenkins = syncgit.Jenkins("hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s", cache_file=cache_file)
+		branches = jenkins.get_currently_configured_branches()
+
+		self.assertEquals(["Build X dev-ACME-777-branch"], read_configs)
+		self.assertEquals([
+			"refs/remotes/origin/dev/ACME-123-branch",
+			"refs/remotes/origin/dev/ACME-555-branch",
+			"refs/remotes/origin/dev/ACME-777-branch"
+		], branches)
+
+		# a full refresh is due, all configs are read again
+		del read_configs[:]
+
+		jenkins = syncgit.Jenkins("hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s", cache_file=cache_file, full_refresh_interval=-1)
+		jenkins.get_currently_configured_branches()
+
+		self.assertEquals(3, len(read_configs))
+
+
+# Stand-in for the Jenkins remote API endpoints used by JenkinsHttpApi
+class JenkinsStandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	protocol_version = "HTTP/1.1"
+
+	def setup(self):
+		BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+		self.server.connections += 1
+
+	def log_message(self, format, *args):
+		pass
+
+	def _respond(self, status, body="", content_type="text/plain"):
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	# job name from /job/<name>/..., folders are not supported here
+	def _job_name(self, path):
+		return urllib.unquote(path.split("/")[2])
+
+	def do_GET(self):
+		path = urlparse.urlparse(self.path).path
+
+		if path == "/crumbIssuer/api/json":
+			self._respond(200, json.dumps({"crumbRequestField": "Jenkins-Crumb", "crumb": "c0ffee"}), "application/json")
+		elif path == "/api/json":
+			self.server.job_list_requests += 1
+
+			jobs = []
+			for name in sorted(self.server.jobs):
+				job = {"name": name}
+
+				# pipeline jobs do not expose their SCM
+				if "scm[" in urllib.unquote(self.path) and not self.server.jobs[name].get("pipeline", False):
+					job["scm"] = {"branches": [{"name": x} for x in re.findall("<name>([^<]*)</name>", self.server.jobs[name]["config"])]}
+
+				# multiple SCMs have no branches of their own
+				if "scm[" in urllib.unquote(self.path) and self.server.jobs[name].get("multiscm", False):
+					job["scm"] = {}
+
+				jobs.append(job)
+
+			self._respond(200, json.dumps({"jobs": jobs}), "application/json")
+		elif path == "/queue/api/json":
+			self._respond(200, json.dumps({"items": [{"id": x} for x in range(3)]}), "application/json")
+		elif path.endswith("/config.xml") and self._job_name(path) in self.server.jobs:
+			self.server.config_requests.append(self._job_name(path))
+			self._respond(200, self.server.jobs[self._job_name(path)]["config"], "application/xml")
+		else:
+			self._respond(404)
+
+	def do_POST(self):
+		url = urlparse.urlparse(self.path)
+		body = self.rfile.read(int(self.headers.getheader("content-length", "0")))
+
+		if self.headers.getheader("jenkins-crumb") != "c0ffee":
+			self._respond(403, "No valid crumb was included in the request")
+		elif url.path == "/createItem":
+			name = urlparse.parse_qs(url.query)["name"][0]
+
+			if name in self.server.jobs:
+				self._respond(400, "A job already exists with the name " + name)
+			else:
+				self.server.jobs[name] = {"config": body, "disabled": True}
+				self._respond(200)
+		elif url.path.startswith("/job/") and self._job_name(url.path) in self.server.jobs:
+			name = self._job_name(url.path)
+
+			if url.path.endswith("/config.xml"):
+				self.server.jobs[name]["config"] = body
+				self._respond(200)
+			elif url.path.endswith("/enable"):
+				self.server.jobs[name]["disabled"] = False
+				self._respond(302)
+			elif url.path.endswith("/disable"):
+				self.server.jobs[name]["disabled"] = True
+				self._respond(302)
+			elif url.path.endswith("/doDelete"):
+				del self.server.jobs[name]
+				self._respond(302)
+			else:
+				self._respond(404)
+		else:
+			self._respond(404)
+
+
+class JenkinsStandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+	# kept-alive connections must not block the shutdown
+	daemon_threads = True
+
+
+class ConfigTemplateTest(unittest.TestCase):
+
+	TEMPLATE = "\n".join([
+		"<?xml version='1.1' encoding='UTF-8'?>",
+		"<!-- managed by syncgit -->",
+		"<project xmlns:x=\"urn:x\" z=\"1\" a=\"a > b\">",
+		"  <description>Build of <![CDATA[*/master]]></description>",
+		"  <displayName/>",
+		"  <properties>",
+		"    <hudson.model.ParametersDefinitionProperty>",
+		"      <parameterDefinitions>",
+		"        <hudson.model.StringParameterDefinition>",
+		"          <name>BRANCH</name>",
+		"          <defaultValue>master</defaultValue>",
+		"        </hudson.model.StringParameterDefinition>",
+		"        <hudson.model.BooleanParameterDefinition>",
+		"          <name>DEPLOY</name>",
+		"          <defaultValue>false</defaultValue>",
+		"        </hudson.model.BooleanParameterDefinition>",
+		"      </parameterDefinitions>",
+		"    </hudson.model.ParametersDefinitionProperty>",
+		"  </properties>",
+		"  <scm class=\"hudson.plugins.git.GitSCM\">",
+		"    <branches>",
+		"      <hudson.plugins.git.BranchSpec>",
+		"        <name>*/master</name>",
+		"      </hudson.plugins.git.BranchSpec>",
+		"    </branches>",
+		"  </scm>",
+		"  <x:name>unchanged</x:name>",
+		"</project>"
+	])
+
+	def test_fields(self):
+		template = syncgit.ConfigTemplate(self.TEMPLATE)
+
+		self.assertEquals(["branch", "description", "displayName", "parameter:BRANCH", "parameter:DEPLOY"], template.get_fields())
+
+		# without values the template is rendered byte by byte
+		self.assertEquals(self.TEMPLATE, template.render({}))
+
+	def test_render(self):
+		template = syncgit.ConfigTemplate(self.TEMPLATE)
+
+		config = template.render({
+			"branch": "origin/dev/ACME-123-branch",
+			"description": u"Build of R&D <\u00fcber>",
+			"displayName": "ACME-123",
+			"parameter:BRANCH": "dev/ACME-123-branch"
+		})
+
+		self.assertEquals(self.TEMPLATE
+			.replace("<name>*/master</name>", "<name>origin/dev/ACME-123-branch</name>")
+			.replace("Build of <![CDATA[*/master]]>", "Build of R&amp;D &lt;&#252;ber&gt;")
+			.replace("<displayName/>", "<displayName>ACME-123</displayName>")
+			.replace("<defaultValue>master</defaultValue>", "<defaultValue>dev/ACME-123-branch</defaultValue>"), config)
+
+	def test_render_hash(self):
+		hash_template = syncgit.ConfigTemplate(syncgit._normalize_config(self.TEMPLATE))
+		template = syncgit.ConfigTemplate(self.TEMPLATE)
+
+		for branch in ["origin/dev/ACME-123-branch", "origin/dev/R&D-<1>", u"origin/dev/\u00fcber"]:
+			self.assertEquals(
+				syncgit._config_hash(template.render({"branch": branch})),
+				hashlib.sha1(hash_template.render({"branch": branch})).hexdigest()
+			)
+
+	def test_missing_branch_spec(self):
+		self.assertRaises(Exception, syncgit.ConfigTemplate, "<project><scm/></project>")
+
+
+class MetricsTest(unittest.TestCase):
+
+	def test_metrics(self):
+		metrics = syncgit.Metrics()
+
+		with metrics.span("discovery"):
+			pass
+
+		metrics.add_call("get_job", 0.2, False, 10, 1000)
+		metrics.add_call("get_job", 0.7, True, 10, 0)
+		metrics.observe("operation", "create", 3)
+
+		report = metrics.get_report()
+
+		self.assertEquals(1, report["phases"]["discovery"]["runs"])
+		self.assertEquals({"calls": 2, "errors": 1}, report["backend_calls"]["get_job"])
+		self.assertEquals({"sent": 20, "received": 1000}, report["backend_bytes"])
+		self.assertEquals(2, report["latencies"]["backend.get_job"]["count"])
+
+		# cumulative buckets
+		buckets = dict(report["latencies"]["backend.get_job"]["buckets"])
+		self.assertEquals((0, 1, 2), (buckets[0.1], buckets[0.25], buckets[1]))
+
+		text = metrics.get_prometheus_text()
+
+		self.assertTrue('syncgit_phase_runs_total{phase="discovery"} 1\n' in text)
+		self.assertTrue('syncgit_backend_errors_total{method="get_job"} 1\n' in text)
+		self.assertTrue('syncgit_backend_bytes_total{direction="received"} 1000\n' in text)
+		self.assertTrue('syncgit_operation_duration_seconds_bucket{operation="create",le="2.5"} 0\n' in text)
+		self.assertTrue('syncgit_operation_duration_seconds_bucket{operation="create",le="5"} 1\n' in text)
+		self.assertTrue('syncgit_operation_duration_seconds_count{operation="create"} 1\n' in text)
+
+	def test_instrumented_backend(self):
+		metrics = syncgit.Metrics()
+
+		backend = fudge.Fake("JenkinsCli").provides("get_job").returns("<project/>")
+		backend.provides("delete_job").raises(Exception("No such job"))
+
+		instrumented = syncgit.InstrumentedJenkinsBackend(backend, metrics)
+
+		self.assertEquals("<project/>", instrumented.get_job("Build X"))
+		self.assertRaises(Exception, instrumented.delete_job, "Build X")
+		self.assertFalse(hasattr(instrumented, "get_job_branches"))
+
+		report = metrics.get_report()
+
+		self.assertEquals({"calls": 1, "errors": 0}, report["backend_calls"]["get_job"])
+		self.assertEquals({"calls": 1, "errors": 1}, report["backend_calls"]["delete_job"])
+		self.assertEquals({"sent": 14, "received": 10}, report["backend_bytes"])
+
+
+class JobNameIndexTest(unittest.TestCase):
+
+	def test_job_names(self):
+		index = syncgit.JobNameIndex("Build (ACME) %s [100%%]")
+
+		self.assertEquals("Build (ACME) dev-ACME-123-branch [100%]", index.get_job_name("origin/dev/ACME-123-branch"))
+
+		# the template text is matched literally
+		self.assertTrue(index.matches("Build (ACME) dev-ACME-123-branch [100%]"))
+		self.assertFalse(index.matches("Build ACME dev-ACME-123-branch [100%]"))
+		self.assertFalse(index.matches("Build (ACME) dev-ACME-123-branch [100%] (copy)"))
+		self.assertFalse(index.matches("Build (ACME)  [100%]"))
+
+	def test_index(self):
+		index = syncgit.JobNameIndex("Build X %s")
+
+		self.assertEquals({
+			"Build X dev-ACME-1": ["refs/remotes/origin/dev/ACME+1", "refs/remotes/origin/dev/ACME.1"]
+		}, index.index([
+			"refs/remotes/origin/dev/ACME.1",
+			"refs/remotes/origin/dev/ACME-2",
+			"refs/remotes/origin/dev/ACME+1"
+		]))
+
+		self.assertEquals("refs/remotes/origin/dev/ACME-2", index.get_ref("Build X dev-ACME-2"))
+		self.assertEquals(None, index.get_ref("Build X dev-ACME-1"))
+		self.assertEquals(None, index.get_ref("Build X dev-ACME-3"))
+
+		# replaces the last index
+		self.assertEquals({}, index.index(["refs/remotes/origin/dev/ACME.1"]))
+		self.assertEquals("refs/remotes/origin/dev/ACME.1", index.get_ref("Build X dev-ACME-1"))
+		self.assertEquals(None, index.get_ref("Build X dev-ACME-2"))
+
+
+class JenkinsHttpApiTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server = JenkinsStandInServer(("127.0.0.1", 0), JenkinsStandInHandler)
+		self.server.connections = 0
+		self.server.job_list_requests = 0
+		self.server.config_requests = []
+		self.server.jobs = {
+			"TEMPLATE Build X": {"config": '<project><scm><branches><hudson.plugins.git.BranchSpec><name>*/master</name></hudson.plugins.git.BranchSpec></branches></scm></project>', "disabled": True},
+			"Build X dev-ACME-987-branch": {"config": '<project><scm><branches><hudson.plugins.git.BranchSpec><name>origin/dev/ACME-987-branch</name></hudson.plugins.git.BranchSpec></branches></scm></project>', "disabled": False},
+			"Other Job": {"config": "<project/>", "disabled": False}
+		}
+
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.start()
+
+		self.host = "http://127.0.0.1:%d/" % self.server.server_address[1]
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.thread.join()
+		self.server.server_close()
+
+	def test_jenkins_over_http(self):
+		jenkins = syncgit.Jenkins(self.host, None, None, "TEMPLATE Build X", "Build X %s", backend="http")
+
+		self.assertEquals(["refs/remotes/origin/dev/ACME-987-branch"], jenkins.get_currently_configured_branches())
+
+		jenkins.create_job("origin/dev/ACME-123-branch")
+		jenkins.remove_job("origin/dev/ACME-987-branch")
+
+		self.assertEquals(["Build X dev-ACME-123-branch", "Other Job", "TEMPLATE Build X"], sorted(self.server.jobs.keys()))
+		self.assertFalse(self.server.jobs["Build X dev-ACME-123-branch"]["disabled"])
+		self.assertTrue("<name>origin/dev/ACME-123-branch</name>" in self.server.jobs["Build X dev-ACME-123-branch"]["config"])
+
+		# all requests went over one kept-alive connection
+		self.assertEquals(1, self.server.connections)
+
+	def test_bulk_discovery(self):
+		self.server.jobs["Build X dev-ACME-555-branch"] = {
+			"config": '<flow-definition><definition><scm><branches><hudson.plugins.git.BranchSpec><name>origin/dev/ACME-555-branch</name></hudson.plugins.git.BranchSpec></branches></scm></definition></flow-definition>',
+			"disabled": False,
+			"pipeline": True
+		}
+		self.server.jobs["Build X dev-ACME-444-branch"] = {
+			"config": '<project><scm class="org.jenkinsci.plugins.multiplescms.MultiSCM"><scms><hudson.plugins.git.GitSCM><branches><hudson.plugins.git.BranchSpec><name>origin/dev/ACME-444-branch</name></hudson.plugins.git.BranchSpec></branches></hudson.plugins.git.GitSCM></scms></scm></project>',
+			"disabled": False,
+			"multiscm": True
+		}
+
+		jenkins = syncgit.Jenkins(self.host, None, None, "TEMPLATE Build X", "Build X %s", backend="http")
+
+		self.assertEquals([
+			"refs/remotes/origin/dev/ACME-444-branch",
+			"refs/remotes/origin/dev/ACME-555-branch",
+			"refs/remotes/origin/dev/ACME-987-branch"
+		], jenkins.get_currently_configured_branches())
+
+		# one listing, only the pipeline and multiple SCMs job configs have been read
+		self.assertEquals(1, self.server.job_list_requests)
+		self.assertEquals(["Build X dev-ACME-444-branch", "Build X dev-ACME-555-branch"], sorted(self.server.config_requests))
+
+	def test_disable_and_reuse_job(self):
+		jenkins = syncgit.Jenkins(self.host, None, None, "TEMPLATE Build X", "Build X %s", backend="http")
+
+		jenkins.disable_job("origin/dev/ACME-987-branch")
+		self.assertTrue(self.server.jobs["Build X dev-ACME-987-branch"]["disabled"])
+
+		jenkins.reuse_job("origin/dev/ACME-987-branch")
+		self.assertFalse(self.server.jobs["Build X dev-ACME-987-branch"]["disabled"])
+
+	def test_get_queue_length(self):
+		jenkins = syncgit.Jenkins(self.host, None, None, "TEMPLATE Build X", "Build X %s", backend="http")
+
+		self.assertEquals(3, jenkins.get_queue_length())
+
+	def test_failing_request(self):
+		api = syncgit.JenkinsHttpApi(self.host)
+
+		self.assertRaises(syncgit.JenkinsHttpException, api.get_job, "Missing Job")
+		self.assertRaises(syncgit.JenkinsHttpException, api.create_job, "Other Job", "<project/>")
+
+	def test_closed_idle_connection(self):
+		api = syncgit.JenkinsHttpApi(self.host)
+
+		# closed by Jenkins while idle, no status line is received
+		closed = ClosedConnection(httplib.BadStatusLine("No status line received - the server has closed the connection"))
+		api._release_connection(closed)
+
+		self.assertEquals("<project/>", api.get_job("Other Job"))
+		self.assertEquals(1, closed.requests)
+
+	def test_failed_post_not_repeated(self):
+		api = syncgit.JenkinsHttpApi(self.host, timeout=5)
+		api._get_crumb()
+
+		# Jenkins may still create the job
+		closed = ClosedConnection(socket.timeout("timed out"))
+		api._release_connection(closed)
+
+		self.assertRaises(socket.timeout, api.create_job, "New Job", "<project/>")
+		self.assertEquals(1, closed.requests)
+		self.assertFalse("New Job" in self.server.jobs)
+
+		# a fresh connection is not replaced either
+		api._idle_connections = []
+		api._connect = lambda: ClosedConnection(httplib.BadStatusLine(""))
+
+		self.assertRaises(httplib.BadStatusLine, api.get_job, "Other Job")
+
+	def test_connection_timeout(self):
+		self.assertEquals(syncgit.DEFAULT_HTTP_TIMEOUT, syncgit.JenkinsHttpApi(self.host)._connect().timeout)
+		self.assertEquals(5, syncgit.JenkinsHttpApi(self.host, timeout=5)._connect().timeout)
+
+
+"""
+	Connection failing to get a response with the given error
+"""
+class ClosedConnection(object):
+
+	def __init__(self, error):
+		self.error = error
+		self.requests = 0
+
+	def request(self, method, url, body=None, headers=None):
+		self.requests += 1
+
+	def getresponse(self):
+		raise self.error
+
+	def close(self):
+		pass
+
+"""
+	Fake Jenkins that keeps "disabled" in the job configs, like Jenkins does
+"""
+class ConfigStateBackend(syncgit_fakes.FakeJenkinsBackend):
+
+	def __init__(self, jobs):
+		super(ConfigStateBackend, self).__init__(jobs)
+
+		self.updated = []
+
+	def update_job(self, job_name, config):
+		super(ConfigStateBackend, self).update_job(job_name, config)
+
+		self.updated.append(job_name)
+
+	def enable_job(self, job_name):
+		self._jobs[job_name] = self._jobs[job_name].replace("<disabled>true</disabled>", "<disabled>false</disabled>")
+
+	def disable_job(self, job_name):
+		self._jobs[job_name] = self._jobs[job_name].replace("<disabled>false</disabled>", "<disabled>true</disabled>")
+
+
+# Create a repository with one commit per ref, refs is a dict of ref -> commit time
+def create_repo(path, refs):
+	repo = dulwich.repo.Repo.init(path)
+
+	tree = dulwich.objects.Tree()
+	repo.object_store.add_object(tree)
+
+	for ref, commit_time in refs.iteritems():
+		commit = dulwich.objects.Commit()
+		commit.tree = tree.id
+		commit.author = commit.committer = "Sync Test <sync@example.com>"
+		commit.author_time = commit.commit_time = commit_time
+		commit.author_timezone = commit.commit_timezone = 0
+		commit.message = ref
+
+		repo.object_store.add_object(commit)
+		repo.refs[ref] = commit.id
+
+	return repo
+
+
+# Write a sorted packed-refs file, refs is a dict of ref -> SHA1
+def write_packed_refs(git_dir, refs):
+	with open(os.path.join(git_dir, "packed-refs"), "w") as f:
+		f.write("# pack-refs with: peeled fully-peeled sorted \n")
+
+		for ref in sorted(refs.keys()):
+			f.write("%s %s\n" % (refs[ref], ref))
+
+
+"""
+	Base of the tests syncing a repository in "repo" of a temporary
+	directory against a FakeJenkinsBackend with the template job
+	"TEMPLATE Build X". The directory itself is free for state files.
+"""
+class SyncTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.path)
+
+		self.repo_path = os.path.join(self.path, "repo")
+		os.mkdir(self.repo_path)
+
+	# Create the repository with "refs" (dict of ref -> commit time) and the
+	# fake Jenkins with a job for each of "branches" (like "dev/ACME-1") plus
+	# "jobs" (dict of job name -> config). Returns the repository.
+	def create_fixture(self, refs, branches=(), jobs=None, latency=0):
+		configs = dict([("Build X " + x.replace("/", "-"), syncgit_fakes.get_job_config("origin/" + x)) for x in branches])
+		configs["TEMPLATE Build X"] = syncgit_fakes.JOB_TEMPLATE
+		configs.update(jobs or {})
+
+		self.backend = syncgit_fakes.FakeJenkinsBackend(configs, latency=latency)
+
+		return create_repo(self.repo_path, refs)
+
+	# Create a sync of the fixture, "options" override the default SyncOptions
+	def create_sync(self, connection=None, throttle=None, **options):
+		return syncgit.GitJenkinsSync(
+			None, None, None, "TEMPLATE Build X", "Build X %s", self.repo_path, "^refs/remotes/origin/dev/", 42,
+			options=syncgit.SyncOptions(**options), connection=(connection or self.backend), throttle=throttle
+		)
+
+	# Sync with a new sync of the fixture, returns the (operation, ref) tupels
+	def sync(self, **options):
+		return [(x[0], x[1]) for x in self.create_sync(**options).sync()]
+
+
+class SyncTargetsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server = JenkinsStandInServer(("127.0.0.1", 0), JenkinsStandInHandler)
+		self.server.connections = 0
+		self.server.job_list_requests = 0
+		self.server.config_requests = []
+		self.server.jobs = {}
+
+		for product in ["ACME", "FOO"]:
+			self.server.jobs["TEMPLATE Build %s" % product] = {
+				"config": '<project><scm><branches><hudson.plugins.git.BranchSpec><name>*/master</name></hudson.plugins.git.BranchSpec></branches></scm></project>',
+				"disabled": True
+			}
+
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.start()
+
+		self.tmp_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.thread.join()
+		self.server.server_close()
+
+		shutil.rmtree(self.tmp_dir)
+
+	def test_sync_targets(self):
+		targets = []
+
+		for product in ["ACME", "FOO"]:
+			repo_path = os.path.join(self.tmp_dir, product)
+			os.mkdir(repo_path)
+
+			create_repo(repo_path, {
+				"refs/remotes/origin/dev/%s-1-branch" % product: int(time.time()),
+				"refs/remotes/origin/dev/%s-2-branch" % product: int(time.time())
+			})
+
+			targets.append({
+				"tpl_job": "TEMPLATE Build %s" % product,
+				"job_name_tpl": "Build %s %%s" % product,
+				"git_repo": repo_path,
+				"ref_regex": "^refs/remotes/origin/dev/"
+			})
+
+		config_path = os.path.join(self.tmp_dir, "sync.json")
+
+		with open(config_path, "w") as f:
+			json.dump({"targets": targets}, f)
+
+		metrics_path = os.path.join(self.tmp_dir, "metrics.json")
+
+		syncgit.main([
+			"--backend", "http", "-J", "http://127.0.0.1:%d/" % self.server.server_address[1],
+			"--config", config_path, "--metrics-out", metrics_path
+		])
+
+		# one discovery for both targets
+		self.assertEquals(1, self.server.job_list_requests)
+
+		with open(metrics_path) as f:
+			metrics = json.load(f)
+
+		self.assertEquals(2, metrics["phases"]["sync"]["runs"])
+		self.assertEquals(4, metrics["backend_calls"]["create_job"]["calls"])
+		self.assertEquals(4, metrics["latencies"]["operation.create"]["count"])
+		self.assertEquals([
+			"Build ACME dev-ACME-1-branch",
+			"Build ACME dev-ACME-2-branch",
+			"Build FOO dev-FOO-1-branch",
+			"Build FOO dev-FOO-2-branch",
+			"TEMPLATE Build ACME",
+			"TEMPLATE Build FOO"
+		], sorted(self.server.jobs.keys()))
+
 
 class GitBranchesTest(unittest.TestCase):
 
@@ -104,8 +1176,12 @@ class GitBranchesTest(unittest.TestCase):
 
 		datetime_datetime_mock.provides("now").returns(1424478767)
 
+		git_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, git_dir)
+		repo_inst.provides("commondir").returns(git_dir)
+
 		# all branches in repo, the first does not match the pattern
-		repo_inst.expects("get_refs").returns({
+		write_packed_refs(git_dir, {
 			"refs/remotes/origin/other/branch": "00000000000",
 			"refs/remotes/origin/int/sprint-1": "deadbee0000",
 			"refs/remotes/origin/int/sprint-2": "deadbee0001",
@@ -124,18 +1200,360 @@ class GitBranchesTest(unittest.TestCase):
 				# in time
 				return create_commit(1424478767 - (2 * 24 * 60 * 60))
 
-		repo_inst.provides("get_object").calls(get_object_fake)
+		repo_inst.provides("get_object").calls(get_object_fake)
+
+		gitbranches = syncgit.GitBranches("/path/to/repo", "^refs/remotes/origin/(int/.*|dev/ACME-[0-9]{1,}-.*)$", 42)
+
+		# get set of refs
+		branches = gitbranches.get_branches()
+
+		self.assertEquals(len(branches), 4, "There should be the correct number of branches")
+		self.assertTrue("refs/remotes/origin/int/sprint-1" in branches, "The branch name should be correct")
+		self.assertTrue("refs/remotes/origin/int/sprint-2" in branches, "The branch name should be correct")
+		self.assertTrue("refs/remotes/origin/dev/ACME-987-branch" in branches, "The branch name should be correct")
+		self.assertTrue("refs/remotes/origin/dev/ACME-123-branch" in branches, "The branch name should be correct")
+
+	@fudge.patch("dulwich.repo.Repo", "datetime.datetime", "datetime.timedelta")
+	def test_get_branches_cached(self, Repo_mock, datetime_datetime_mock, datetime_timedelta_mock):
+		cache_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, cache_dir)
+		cache_file = os.path.join(cache_dir, "refs.json")
+
+		repo_inst = Repo_mock.is_callable().returns_fake()
+
+		datetime_timedelta_mock.is_callable().calls(lambda **kwargs: kwargs["days"] * 24 * 60 * 60)
+		datetime_datetime_mock.provides("fromtimestamp").calls(lambda x: x)
+		datetime_datetime_mock.provides("now").returns(1424478767)
+
+		refs = {
+			"refs/remotes/origin/dev/ACME-123-branch": "deadbee1234",
+			"refs/remotes/origin/dev/ACME-987-branch": "deadbee9876"
+		}
+		git_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, git_dir)
+		repo_inst.provides("commondir").returns(git_dir)
+
+		write_packed_refs(git_dir, refs)
+
+		commit_times = {
+			"deadbee1234": 1424478767 - (2 * 24 * 60 * 60),
+			"deadbee9876": 1424478767 - (2 * 24 * 60 * 60),
+			"deadbee9877": 1424478767 - (45 * 24 * 60 * 60)
+		}
+		read_objects = []
+
+		def get_object_fake(sha1):
+			read_objects.append(sha1)
+			return fudge.Fake('Commit').has_attr(commit_time=commit_times[sha1])
+
+		repo_inst.provides("get_object").calls(get_object_fake)
+
+		gitbranches = syncgit.GitBranches("/path/to/repo", "^refs/remotes/origin/dev/", 42, cache_file=cache_file)
+
+		self.assertEquals(2, len(gitbranches.get_branches()))
+		self.assertEquals(["deadbee1234", "deadbee9876"], sorted(read_objects))
+
+		# only the moved ref is read again
+		del read_objects[:]
+		refs["refs/remotes/origin/dev/ACME-987-branch"] = "deadbee9877"
+		write_packed_refs(git_dir, refs)
+
+		gitbranches = syncgit.GitBranches("/path/to/repo", "^refs/remotes/origin/dev/", 42, cache_file=cache_file)
+
+		self.assertEquals(set(["refs/remotes/origin/dev/ACME-123-branch"]), gitbranches.get_branches())
+		self.assertEquals(["deadbee9877"], read_objects)
+
+		# the age is checked again with the cached commit times
+		del read_objects[:]
+		datetime_datetime_mock.provides("now").returns(1424478767 + (41 * 24 * 60 * 60))
+
+		gitbranches = syncgit.GitBranches("/path/to/repo", "^refs/remotes/origin/dev/", 42, cache_file=cache_file)
+
+		self.assertEquals(set(), gitbranches.get_branches())
+		self.assertEquals([], read_objects)
+
+	@fudge.patch("dulwich.repo.Repo")
+	def test_get_branches_only(self, Repo_mock):
+		repo_inst = Repo_mock.expects_call().returns_fake()
+
+		repo_inst.provides("commondir").returns("/path/to/repo/.git")
+
+		# deleted refs are missing
+		repo_inst.has_attr(refs={
+			"refs/remotes/origin/dev/ACME-123-branch": "deadbee1234",
+			"refs/remotes/origin/other/branch": "00000000000"
+		})
+
+		(repo_inst.expects("get_object")
+			.with_args("deadbee1234")
+			.returns(fudge.Fake('Commit').has_attr(commit_time=time.time())))
+
+		gitbranches = syncgit.GitBranches("/path/to/repo", "^refs/remotes/origin/dev/", 42)
+
+		branches = gitbranches.get_branches(only=set([
+			"refs/remotes/origin/dev/ACME-123-branch",
+			"refs/remotes/origin/dev/ACME-987-branch",
+			"refs/remotes/origin/other/branch"
+		]))
+
+		self.assertEquals(set(["refs/remotes/origin/dev/ACME-123-branch"]), branches)
+
+	@fudge.patch("dulwich.repo.Repo")
+	def test_get_branches_only_with_sha1s(self, Repo_mock):
+		repo_inst = Repo_mock.expects_call().returns_fake()
+
+		def get_object_fake(sha1):
+			if sha1 == "deadbee0000":
+				raise KeyError(sha1)
+
+			return fudge.Fake('Commit').has_attr(commit_time=time.time())
+
+		repo_inst.provides("commondir").returns("/path/to/repo/.git")
+		repo_inst.provides("get_object").calls(get_object_fake)
+
+		gitbranches = syncgit.GitBranches("/path/to/repo", "^refs/remotes/origin/dev/", 42)
+
+		# the refs of the repository are not used
+		branches = gitbranches.get_branches(only={
+			"refs/remotes/origin/dev/ACME-123-branch": "deadbee1234",
+			"refs/remotes/origin/dev/ACME-987-branch": None
+		})
+
+		self.assertEquals(set(["refs/remotes/origin/dev/ACME-123-branch"]), branches)
+
+		# a commit that has not been fetched yet
+		self.assertRaises(Exception, gitbranches.get_branches, only={"refs/remotes/origin/dev/ACME-555-branch": "deadbee0000"})
+
+	def test_get_refs_below_prefix(self):
+		path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, path)
+
+		now = int(time.time())
+
+		repo = create_repo(path, {
+			"refs/remotes/origin/dev/ACME-123-branch": now,
+			"refs/remotes/origin/dev/ACME-987-branch": now,
+			"refs/remotes/origin/int/sprint-1": now,
+			"refs/remotes/upstream/dev/ACME-555-branch": now
+		})
+		repo.refs.set_symbolic_ref("refs/remotes/origin/HEAD", "refs/remotes/origin/dev/ACME-123-branch")
+
+		# packed refs: a moved branch (loose ref wins), a packed only branch and tags
+		refs = dict([("refs/tags/v%d" % i, "0" * 40) for i in range(1000)])
+		refs["refs/remotes/origin/dev/ACME-123-branch"] = "1" * 40
+		refs["refs/remotes/origin/dev/ACME-444-branch"] = repo.refs["refs/remotes/origin/int/sprint-1"]
+		write_packed_refs(os.path.join(path, ".git"), refs)
+
+		gitbranches = syncgit.GitBranches(path, "^refs/remotes/origin/(dev/|HEAD)", 42)
+
+		self.assertEquals({
+			"refs/remotes/origin/HEAD": repo.refs["refs/remotes/origin/dev/ACME-123-branch"],
+			"refs/remotes/origin/dev/ACME-123-branch": repo.refs["refs/remotes/origin/dev/ACME-123-branch"],
+			"refs/remotes/origin/dev/ACME-444-branch": repo.refs["refs/remotes/origin/int/sprint-1"],
+			"refs/remotes/origin/dev/ACME-987-branch": repo.refs["refs/remotes/origin/dev/ACME-987-branch"]
+		}, gitbranches.get_refs())
+
+		# without a literal prefix all refs are read
+		gitbranches = syncgit.GitBranches(path, "(?i)^refs/remotes/origin/dev/", 42)
+
+		self.assertEquals(3, len(gitbranches.get_refs()))
+
+		# a prefix without a directory walks the refs only
+		walked = []
+		walk = os.walk
+
+		def walk_logged(top, *args):
+			walked.append(top)
+			return walk(top, *args)
+
+		os.walk = walk_logged
+		self.addCleanup(setattr, os, "walk", walk)
+
+		gitbranches = syncgit.GitBranches(path, "^ref.*/origin/dev/", 42)
+
+		self.assertEquals(3, len(gitbranches.get_refs()))
+		self.assertEquals(os.path.join(path, ".git", "refs", ""), walked[0])
+
+	def test_get_branches_from_commit_graph(self):
+		path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, path)
+
+		now = int(time.time())
+
+		repo = create_repo(path, {
+			"refs/remotes/origin/dev/ACME-123-branch": now,
+			"refs/remotes/origin/dev/ACME-987-branch": now - (50 * 24 * 60 * 60)
+		})
+
+		graph_commits = [repo[repo.refs["refs/remotes/origin/dev/ACME-%d-branch" % i]] for i in [123, 987]]
+		syncgit_fakes.write_commit_graph(os.path.join(path, ".git", "objects", "info", "commit-graph"), graph_commits)
+
+		# commits in the graph are not read, remove them
+		for commit in graph_commits:
+			os.remove(repo.object_store._get_shafile_path(commit.id))
+
+		# written after the graph, read from the object
+		commit = dulwich.objects.Commit()
+		commit.tree = graph_commits[0].tree
+		commit.author = commit.committer = "Sync Test <sync@example.com>"
+		commit.author_time = commit.commit_time = now
+		commit.author_timezone = commit.commit_timezone = 0
+		commit.message = "new"
+		repo.object_store.add_object(commit)
+		repo.refs["refs/remotes/origin/dev/ACME-555-branch"] = commit.id
+
+		gitbranches = syncgit.GitBranches(path, "^refs/remotes/origin/dev/", 42)
+
+		self.assertEquals(set([
+			"refs/remotes/origin/dev/ACME-123-branch",
+			"refs/remotes/origin/dev/ACME-555-branch"
+		]), gitbranches.get_branches())
+
+	def test_commit_graph(self):
+		path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, path)
+
+		commits = syncgit_fakes.create_synthetic_repo(path, 300)
+		graph_path = os.path.join(path, ".git", "objects", "info", "commit-graph")
+		syncgit_fakes.write_commit_graph(graph_path, commits)
+
+		graph = syncgit.CommitGraph(graph_path)
+		self.addCleanup(graph.close)
+
+		for commit in commits:
+			self.assertEquals(commit.commit_time, graph.get_commit_time(commit.id))
+
+		self.assertEquals(None, graph.get_commit_time("0" * 40))
+		self.assertEquals(None, graph.get_commit_time("f" * 40))
+
+		with open(graph_path, "wb") as f:
+			f.write("CGPH\x02\x01\x03\x00")
+
+		self.assertRaises(ValueError, syncgit.CommitGraph, graph_path)
+
+	def test_get_literal_prefix(self):
+		self.assertEquals("refs/remotes/origin/", syncgit._get_literal_prefix("^refs/remotes/origin/((dev|bugfix)/ACME-[0-9]+|int/[0-9]+)"))
+		self.assertEquals("refs/remotes/origin/d", syncgit._get_literal_prefix("refs/remotes/origin/de*v"))
+		self.assertEquals("refs/remotes/origin.x/", syncgit._get_literal_prefix("^refs/remotes/origin\\.x/"))
+		self.assertEquals("refs/remotes/", syncgit._get_literal_prefix("^refs/remotes/a|^refs/remotes/b"))
+		self.assertEquals("", syncgit._get_literal_prefix("^refs/remotes/a|^tags/b"))
+		self.assertEquals("", syncgit._get_literal_prefix("(?i)^refs/remotes/"))
+
+
+class RefWatcherTest(unittest.TestCase):
+
+	def setUp(self):
+		self.git_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.git_dir)
+
+		os.makedirs(os.path.join(self.git_dir, "refs", "remotes", "origin", "dev"))
+
+	def _write_ref(self, name, sha1):
+		path = os.path.join(self.git_dir, "refs", "remotes", "origin", name)
+
+		# written like Git does, by renaming a lock file
+		with open(path + ".lock", "w") as f:
+			f.write(sha1 + "\n")
+
+		os.rename(path + ".lock", path)
+
+	def test_wait_for_change(self):
+		watcher = syncgit.RefWatcher(self.git_dir, 0.01, 0.1)
+
+		self.assertFalse(watcher.wait_for_change(0.05), "There should be no change")
+
+		def push():
+			for i in range(3):
+				time.sleep(0.03)
+				self._write_ref("dev/ACME-%d-branch" % i, "%040d" % i)
+
+		pusher = threading.Thread(target=push)
+		pusher.start()
+
+		start = time.time()
+		self.assertTrue(watcher.wait_for_change(5), "The change should be reported")
+		pusher.join()
+
+		# the burst is reported once, after the last change
+		self.assertTrue(time.time() - start >= 0.19)
+		self.assertFalse(watcher.wait_for_change(0.05), "There should be no further change")
+
+		with open(os.path.join(self.git_dir, "packed-refs"), "w") as f:
+			f.write("# pack-refs with: peeled fully-peeled sorted\n")
+
+		self.assertTrue(watcher.wait_for_change(5), "A new packed-refs file should be reported")
+
+	def test_get_state_vanished_directory(self):
+		vanished = os.path.join(self.git_dir, "refs", "remotes", "origin", "dev")
+		stat = os.stat
+
+		# the directory is removed between listing and stat
+		def stat_fake(path):
+			if path == vanished:
+				raise OSError(2, "No such file or directory", path)
+
+			return stat(path)
+
+		syncgit.os.stat = stat_fake
+
+		try:
+			state = syncgit.RefWatcher(self.git_dir, 0.01, 0.1)._get_state()
+		finally:
+			syncgit.os.stat = stat
+
+		self.assertTrue(os.path.join(self.git_dir, "refs", "remotes", "origin") in state)
+		self.assertFalse(vanished in state)
+
+	def test_watch_keeps_going(self):
+		retry_interval = syncgit.WATCH_RETRY_INTERVAL
+		syncgit.WATCH_RETRY_INTERVAL = 0.01
+		self.addCleanup(setattr, syncgit, "WATCH_RETRY_INTERVAL", retry_interval)
+
+		refs = {"refs/remotes/origin/dev/ACME-1-branch": "%040d" % 1}
+		calls = []
+
+		class FakeGit(object):
+			def get_control_dir(_):
+				return self.git_dir
+
+			def reload(_):
+				pass
+
+			def get_refs(_):
+				return dict(refs)
+
+		def sync_fake():
+			calls.append(("sync",))
+
+			if len(calls) == 1:
+				raise Exception("Jenkins is down")
 
-		gitbranches = syncgit.GitBranches("/path/to/repo", "^refs/remotes/origin/(int/.*|dev/ACME-[0-9]{1,}-.*)$", 42)
+			# pushed after the sync
+			refs["refs/remotes/origin/dev/ACME-2-branch"] = "%040d" % 2
+			self._write_ref("dev/ACME-2-branch", "%040d" % 2)
 
-		# get set of refs
-		branches = gitbranches.get_branches()
+		def sync_refs_fake(changed):
+			calls.append(("sync_refs", set(changed)))
 
-		self.assertEquals(len(branches), 4, "There should be the correct number of branches")
-		self.assertTrue("refs/remotes/origin/int/sprint-1" in branches, "The branch name should be correct")
-		self.assertTrue("refs/remotes/origin/int/sprint-2" in branches, "The branch name should be correct")
-		self.assertTrue("refs/remotes/origin/dev/ACME-987-branch" in branches, "The branch name should be correct")
-		self.assertTrue("refs/remotes/origin/dev/ACME-123-branch" in branches, "The branch name should be correct")
+			if len(calls) == 3:
+				raise Exception("Jenkins is down")
+
+			raise KeyboardInterrupt()
+
+		sync = syncgit.GitJenkinsSync.__new__(syncgit.GitJenkinsSync)
+		sync._git = FakeGit()
+		sync.sync = sync_fake
+		sync.sync_refs = sync_refs_fake
+
+		self.assertRaises(KeyboardInterrupt, sync.watch, 0.01, 0.05, 60)
+
+		# the failed sync is done again, the refs of a failed sync are synced again without a further change
+		self.assertEquals([
+			("sync",),
+			("sync",),
+			("sync_refs", set(["refs/remotes/origin/dev/ACME-2-branch"])),
+			("sync_refs", set(["refs/remotes/origin/dev/ACME-2-branch"]))
+		], calls)
 
 
 class GitJenkinsSyncTest(unittest.TestCase):
@@ -157,23 +1575,32 @@ class GitJenkinsSyncTest(unittest.TestCase):
 		# mock constructor, return instance mock
 		self.mox.StubOutWithMock(syncgit, 'GitBranches')
 		(syncgit
-			.GitBranches("/path/to/repo", "^refs/remotes/origin/(int/.*|dev/ACME-[0-9]{1,}-.*)$", 42)
+			.GitBranches("/path/to/repo", "^refs/remotes/origin/(int/.*|dev/ACME-[0-9]{1,}-.*)$", 42, cache_file=None, ref_filter=None)
 			.AndReturn(mocked_gitbranches))
 
 
 		# prepare mock for Jenkins and mock out all methods
 		mocked_jenkins = self.mox.CreateMock(syncgit.Jenkins)
-		mocked_jenkins.get_currently_configured_branches().AndReturn([
+		mocked_jenkins.reset_template()
+		mocked_jenkins.index_job_names(set(["dev/ACME-987-branch", "dev/ACME-123-branch"])).AndReturn(set())
+		mocked_jenkins.get_currently_configured_branches(by_name=False).AndReturn([
 			"dev/ACME-987-branch",
 			"dev/ACME-000-branch"
 		])
 		mocked_jenkins.remove_job(mox.Regex("^dev/ACME-000-branch$")).AndReturn(None)
 		mocked_jenkins.create_job(mox.Regex("^dev/ACME-123-branch$")).AndReturn(None)
+		mocked_jenkins.save_cache()
 
 		# mock constructor, return instance mock
 		self.mox.StubOutWithMock(syncgit, 'Jenkins')
 		(syncgit
-			.Jenkins("hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s")
+			.Jenkins(
+				"hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s", discovery_workers=1,
+				cache_file=None, full_refresh_interval=24,
+				backend="cli", http_user=None, http_token=None,
+				connection=None, metrics=mox.IgnoreArg(), job_folder=None, shard=None,
+			hash_configs=False
+			)
 			.AndReturn(mocked_jenkins))
 
 
@@ -188,6 +1615,693 @@ class GitJenkinsSyncTest(unittest.TestCase):
 
 		self.mox.VerifyAll()
 
+	def test_sync_refs(self):
+		mocked_gitbranches = self.mox.CreateMock(syncgit.GitBranches)
+
+		# not managed refs are not looked up
+		mocked_gitbranches.matches("refs/tags/v1.0").InAnyOrder().AndReturn(False)
+
+		for ref in ["refs/remotes/origin/dev/ACME-123-branch", "refs/remotes/origin/dev/ACME-000-branch", "refs/remotes/origin/dev/ACME-555-branch"]:
+			mocked_gitbranches.matches(ref).InAnyOrder().AndReturn(True)
+
+		mocked_gitbranches.get_branches(only=set([
+			"refs/remotes/origin/dev/ACME-123-branch",
+			"refs/remotes/origin/dev/ACME-000-branch",
+			"refs/remotes/origin/dev/ACME-555-branch"
+		])).AndReturn(set(["refs/remotes/origin/dev/ACME-123-branch", "refs/remotes/origin/dev/ACME-555-branch"]))
+
+		self.mox.StubOutWithMock(syncgit, 'GitBranches')
+		syncgit.GitBranches(mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg(), cache_file=None, ref_filter=None).AndReturn(mocked_gitbranches)
+
+		# Jenkins is not asked for its jobs, only for unchanged refs jobs are left alone
+		mocked_jenkins = self.mox.CreateMock(syncgit.Jenkins)
+		mocked_jenkins.reset_template()
+		mocked_jenkins.index_job_names(set(["refs/remotes/origin/dev/ACME-123-branch", "refs/remotes/origin/dev/ACME-555-branch"])).AndReturn(set())
+		mocked_jenkins.get_configured_branches_for(set([
+			"refs/remotes/origin/dev/ACME-123-branch",
+			"refs/remotes/origin/dev/ACME-000-branch",
+			"refs/remotes/origin/dev/ACME-555-branch"
+		])).AndReturn(set([
+			"refs/remotes/origin/dev/ACME-000-branch",
+			"refs/remotes/origin/dev/ACME-555-branch"
+		]))
+		mocked_jenkins.remove_job("origin/dev/ACME-000-branch")
+		mocked_jenkins.create_job("origin/dev/ACME-123-branch")
+		mocked_jenkins.save_cache()
+
+		self.mox.StubOutWithMock(syncgit, 'Jenkins')
+		syncgit.Jenkins(
+			mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg(), discovery_workers=1,
+			cache_file=None, full_refresh_interval=24,
+			backend="cli", http_user=None, http_token=None,
+			connection=None, metrics=mox.IgnoreArg(), job_folder=None, shard=None,
+			hash_configs=False
+		).AndReturn(mocked_jenkins)
+
+		self.mox.ReplayAll()
+
+		sync = syncgit.GitJenkinsSync(
+			"hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s",
+			"/path/to/repo", "^refs/remotes/origin/dev/", 42
+		)
+
+		sync.sync_refs([
+			"refs/remotes/origin/dev/ACME-123-branch",
+			"refs/remotes/origin/dev/ACME-000-branch",
+			"refs/tags/v1.0",
+			"refs/remotes/origin/dev/ACME-555-branch"
+		])
+
+		self.mox.VerifyAll()
+
+	def test_sync_parallel(self):
+		mocked_gitbranches = self.mox.CreateMock(syncgit.GitBranches)
+		mocked_gitbranches.get_branches().AndReturn(set(["refs/remotes/origin/dev/ACME-%03d-branch" % i for i in range(10)]))
+
+		self.mox.StubOutWithMock(syncgit, 'GitBranches')
+		syncgit.GitBranches(mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg(), cache_file=None, ref_filter=None).AndReturn(mocked_gitbranches)
+
+		mocked_jenkins = self.mox.CreateMock(syncgit.Jenkins)
+		mocked_jenkins.reset_template()
+		mocked_jenkins.index_job_names(mox.IgnoreArg()).AndReturn(set())
+		mocked_jenkins.get_currently_configured_branches(by_name=False).AndReturn(["refs/remotes/origin/dev/ACME-999-branch"])
+		mocked_jenkins.remove_job("origin/dev/ACME-999-branch")
+
+		def create_job_fake(ref_name):
+			if ref_name == "origin/dev/ACME-003-branch":
+				raise Exception("Job exists")
+
+		mocked_jenkins.create_job = create_job_fake
+		mocked_jenkins.save_cache()
+
+		self.mox.StubOutWithMock(syncgit, 'Jenkins')
+		syncgit.Jenkins(
+			mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg(), discovery_workers=1,
+			cache_file=None, full_refresh_interval=24,
+			backend="cli", http_user=None, http_token=None,
+			connection=None, metrics=mox.IgnoreArg(), job_folder=None, shard=None,
+			hash_configs=False
+		).AndReturn(mocked_jenkins)
+
+		self.mox.ReplayAll()
+
+		sync = syncgit.GitJenkinsSync(
+			"hostname", "/tmp/cli.jar", "/tmp/ssh-key", "TEMPLATE Build X", "Build X %s",
+			"/path/to/repo", "^refs/remotes/origin/dev/", 42, options=syncgit.SyncOptions(mutation_workers=4)
+		)
+
+		results = sync.sync()
+
+		self.mox.VerifyAll()
+
+		# the removal comes first, all creations are tried
+		self.assertEquals(("remove", "refs/remotes/origin/dev/ACME-999-branch", None), results[0][:3])
+		self.assertEquals(["refs/remotes/origin/dev/ACME-%03d-branch" % i for i in range(10)], [x[1] for x in results[1:]])
+		self.assertEquals(["refs/remotes/origin/dev/ACME-003-branch"], [x[1] for x in results if x[2] is not None])
+
+
+class RemoteRefreshTest(unittest.TestCase):
+
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.path)
+
+		# branches with two commits each
+		self.source = dulwich.repo.Repo.init(os.path.join(self.path, "source"), mkdir=True)
+		self.tips = {}
+
+		for branch in ["dev/ACME-123-branch", "dev/ACME-987-branch", "other/branch"]:
+			self.tips[branch] = self._commit(self._commit(None))
+			self.source.refs["refs/heads/" + branch] = self.tips[branch]
+
+	def _commit(self, parent):
+		tree = dulwich.objects.Tree()
+		blob = dulwich.objects.Blob.from_string(os.urandom(16))
+		tree.add("file", 0100644, blob.id)
+
+		commit = dulwich.objects.Commit()
+		commit.tree = tree.id
+		commit.parents = [parent] if parent is not None else []
+		commit.author = commit.committer = "Sync Test <sync@example.com>"
+		commit.author_time = commit.commit_time = int(time.time())
+		commit.author_timezone = commit.commit_timezone = 0
+		commit.message = "commit"
+
+		self.source.object_store.add_objects([(blob, None), (tree, None), (commit, None)])
+
+		return commit.id
+
+	def _serve(self):
+		server = dulwich.server.TCPGitServer(dulwich.server.DictBackend({"/": self.source}), "127.0.0.1", 0)
+
+		thread = threading.Thread(target=server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+		self.addCleanup(server.server_close)
+		self.addCleanup(server.shutdown)
+
+		return "git://127.0.0.1:%d/" % server.server_address[1]
+
+	def test_refresh(self):
+		url = self._serve()
+
+		target = dulwich.repo.Repo.init_bare(os.path.join(self.path, "target"), mkdir=True)
+		gitbranches = syncgit.GitBranches(target.path, "^refs/remotes/origin/dev/", 42)
+
+		self.assertEquals({
+			"refs/remotes/origin/dev/ACME-123-branch": self.tips["dev/ACME-123-branch"],
+			"refs/remotes/origin/dev/ACME-987-branch": self.tips["dev/ACME-987-branch"]
+		}, gitbranches.refresh(url))
+
+		# only the tip commits of matching branches have been fetched
+		self.assertEquals(set([self.tips["dev/ACME-123-branch"], self.tips["dev/ACME-987-branch"]]), target.get_shallow())
+		self.assertFalse(target[self.tips["dev/ACME-123-branch"]].parents[0] in target.object_store)
+		self.assertFalse(self.tips["other/branch"] in target.object_store)
+
+		self.assertEquals(set([
+			"refs/remotes/origin/dev/ACME-123-branch",
+			"refs/remotes/origin/dev/ACME-987-branch"
+		]), gitbranches.get_branches())
+
+		# moved and deleted branches
+		self.tips["dev/ACME-123-branch"] = self._commit(self.tips["dev/ACME-123-branch"])
+		self.source.refs["refs/heads/dev/ACME-123-branch"] = self.tips["dev/ACME-123-branch"]
+		del self.source.refs["refs/heads/dev/ACME-987-branch"]
+
+		self.assertEquals({
+			"refs/remotes/origin/dev/ACME-123-branch": self.tips["dev/ACME-123-branch"],
+			"refs/remotes/origin/dev/ACME-987-branch": None
+		}, gitbranches.refresh(url))
+
+		self.assertEquals({}, gitbranches.refresh(url))
+
+	def test_sync_from_local_remote(self):
+		backend = syncgit_fakes.FakeJenkinsBackend({"TEMPLATE Build X": syncgit_fakes.JOB_TEMPLATE})
+
+		# the repository is created, local repositories are fetched from completely
+		sync = syncgit.GitJenkinsSync(
+			None, None, None, "TEMPLATE Build X", "Build X %s", os.path.join(self.path, "target"), "^refs/remotes/origin/dev/", 42,
+			options=syncgit.SyncOptions(remote_url=self.source.path), connection=backend
+		)
+
+		self.assertEquals([
+			("create", "refs/remotes/origin/dev/ACME-123-branch"),
+			("create", "refs/remotes/origin/dev/ACME-987-branch")
+		], [(x[0], x[1]) for x in sync.sync()])
+
+
+class JobFolderTest(SyncTestCase):
+
+	def test_sync_in_folder(self):
+		self.create_fixture({
+			"refs/remotes/origin/dev/ACME-123-branch": int(time.time()),
+			"refs/remotes/origin/dev/ACME-987-branch": int(time.time())
+		}, branches=[
+			# not in the folder, left alone
+			"dev/ACME-555-branch"
+		], jobs={
+			"acme/Build X dev-ACME-123-branch": syncgit_fakes.get_job_config("origin/dev/ACME-123-branch"),
+			"acme/Build X dev-ACME-000-branch": syncgit_fakes.get_job_config("origin/dev/ACME-000-branch")
+		})
+
+		self.assertEquals([
+			("remove", "refs/remotes/origin/dev/ACME-000-branch"),
+			("create", "refs/remotes/origin/dev/ACME-987-branch")
+		], self.sync(job_folder="acme"))
+
+		self.assertEquals([
+			"Build X dev-ACME-555-branch",
+			"TEMPLATE Build X",
+			"acme/Build X dev-ACME-123-branch",
+			"acme/Build X dev-ACME-987-branch"
+		], sorted(self.backend._jobs.keys()))
+
+
+class PlanTest(SyncTestCase):
+
+	def test_plan_and_apply(self):
+		now = int(time.time())
+
+		repo = self.create_fixture({
+			"refs/remotes/origin/dev/ACME-1": now,
+			"refs/remotes/origin/dev/ACME-2": now,
+			"refs/remotes/origin/dev/ACME-3": now,
+			"refs/remotes/origin/dev/ACME-4": now - 100 * 24 * 60 * 60
+		}, branches=["dev/ACME-3", "dev/ACME-4", "dev/ACME-5"])
+
+		backend = self.backend
+
+		plan_file = os.path.join(self.path, "plan.json")
+		plan = self.create_sync().plan(plan_file)
+
+		self.assertEquals(["refs/remotes/origin/dev/ACME-1", "refs/remotes/origin/dev/ACME-2"], plan["create"])
+		self.assertEquals(["refs/remotes/origin/dev/ACME-4", "refs/remotes/origin/dev/ACME-5"], plan["remove"])
+		self.assertEquals([repo.refs["refs/remotes/origin/dev/ACME-4"], now - 100 * 24 * 60 * 60], plan["refs"]["refs/remotes/origin/dev/ACME-4"])
+		self.assertEquals("origin/dev/ACME-3", plan["jobs"]["Build X dev-ACME-3"])
+
+		with open(plan_file) as f:
+			self.assertEquals(plan, json.load(f))
+
+		# nothing is changed by the plan
+		self.assertEquals(4, len(backend._jobs))
+
+		# changed since the plan
+		repo.refs["refs/remotes/origin/dev/ACME-2"] = repo.refs["refs/remotes/origin/dev/ACME-1"]
+		del backend._jobs["Build X dev-ACME-5"]
+
+		# only the jobs of the plan are looked at
+		backend.get_joblist = lambda *args: self.fail("Listed all jobs")
+
+		self.assertEquals([
+			("remove", "refs/remotes/origin/dev/ACME-4"),
+			("create", "refs/remotes/origin/dev/ACME-1")
+		], [(x[0], x[1]) for x in self.create_sync().apply(plan_file)])
+
+		self.assertEquals(["Build X dev-ACME-1", "Build X dev-ACME-3", "TEMPLATE Build X"], sorted(backend._jobs.keys()))
+
+		# applied again, everything is done already
+		self.assertEquals([], self.create_sync().apply(plan_file))
+
+	def test_apply_plan_of_other_jobs(self):
+		self.create_fixture({})
+
+		plan_file = os.path.join(self.path, "plan.json")
+		syncgit._save_state(plan_file, {"version": syncgit.PLAN_VERSION, "created": 0, "job_name_tpl": "Build Y %s", "job_folder": None})
+
+		self.assertRaises(Exception, self.create_sync().apply, plan_file)
+
+
+class AdaptiveThrottleTest(SyncTestCase):
+
+	def _run(self, throttle, seconds, error=False):
+		throttle.release(throttle.acquire(), seconds, error)
+
+	def test_additive_increase(self):
+		throttle = syncgit.AdaptiveThrottle(1, 3, 1.0)
+
+		self.assertEquals(1, throttle.get_limit())
+
+		# raised after as many fast operations as the limit
+		self._run(throttle, 0.1)
+		self.assertEquals(2, throttle.get_limit())
+
+		self._run(throttle, 0.1)
+		self.assertEquals(2, throttle.get_limit())
+		self._run(throttle, 0.1)
+		self.assertEquals(3, throttle.get_limit())
+
+		for i in range(10):
+			self._run(throttle, 0.1)
+
+		self.assertEquals(3, throttle.get_limit())
+		self.assertTrue(throttle.get_report().startswith("13 job operation(s) in "))
+
+	def test_multiplicative_decrease(self):
+		throttle = syncgit.AdaptiveThrottle(1, 8, 1.0)
+
+		for i in range(1 + 2 + 3 + 4 + 5 + 6 + 7):
+			self._run(throttle, 0.1)
+
+		self.assertEquals(8, throttle.get_limit())
+
+		tokens = [throttle.acquire() for i in range(3)]
+
+		throttle.release(tokens[0], 1.5, False)
+		self.assertEquals(4, throttle.get_limit())
+
+		# started before the limit has been lowered
+		throttle.release(tokens[1], 1.5, False)
+		self.assertEquals(4, throttle.get_limit())
+
+		throttle.release(tokens[2], 0.1, False)
+		self._run(throttle, 0.1, error=True)
+		self.assertEquals(2, throttle.get_limit())
+
+		self._run(throttle, 0.1, error=True)
+		self._run(throttle, 0.1, error=True)
+		self.assertEquals(1, throttle.get_limit())
+
+	def test_queue_length(self):
+		queue = [10]
+
+		throttle = syncgit.AdaptiveThrottle(1, 4, 1.0, max_queue_length=5, queue_length=lambda: queue[0])
+
+		self._run(throttle, 0.1)
+		self.assertEquals(1, throttle.get_limit())
+
+		# the queue length is not asked again right away
+		queue[0] = 0
+		self._run(throttle, 0.1)
+		self.assertEquals(1, throttle.get_limit())
+
+	def test_sync_throttled(self):
+		self.create_fixture(dict([("refs/remotes/origin/dev/ACME-%d" % i, int(time.time())) for i in range(6)]))
+
+		sync = self.create_sync(mutation_workers=4, throttle_latency=5, throttle_queue_length=10)
+
+		self.assertEquals(6, len([x for x in sync.sync() if x[2] is None]))
+		self.assertEquals(7, len(self.backend._jobs))
+
+	def test_sync_shared_throttle(self):
+		self.create_fixture(dict([("refs/remotes/origin/dev/ACME-%d" % i, int(time.time())) for i in range(3)]))
+
+		throttle = syncgit.AdaptiveThrottle(1, 4, 5.0)
+
+		self.assertEquals(3, len(self.sync(mutation_workers=4, throttle=throttle)))
+		self.assertEquals(3, throttle.get_limit())
+
+		# another target against the same Jenkins goes on with the raised limit
+		backend = syncgit_fakes.FakeJenkinsBackend({"TEMPLATE Build X": syncgit_fakes.JOB_TEMPLATE})
+
+		self.assertEquals(3, len(self.sync(mutation_workers=4, throttle=throttle, connection=backend)))
+		self.assertEquals(4, throttle.get_limit())
+		self.assertTrue(throttle.get_report().startswith("6 job operation(s) in "))
+
+
+class DisableStaleTest(SyncTestCase):
+
+	def test_disable_and_reuse(self):
+		path = self.path
+		now = int(time.time())
+
+		repo = self.create_fixture({
+			"refs/remotes/origin/dev/ACME-1": now,
+			"refs/remotes/origin/dev/ACME-2": now - 100 * 24 * 60 * 60,
+			"refs/remotes/origin/dev/ACME-5": now
+		}, branches=["dev/ACME-%d" % i for i in range(1, 5)])
+
+		backend = self.backend
+
+		def sync():
+			return sorted(self.sync(state_dir=path, disable_stale=True))
+
+		self.assertEquals([
+			("create", "refs/remotes/origin/dev/ACME-5"),
+			("disable", "refs/remotes/origin/dev/ACME-2"),
+			("disable", "refs/remotes/origin/dev/ACME-3"),
+			("disable", "refs/remotes/origin/dev/ACME-4")
+		], sync())
+
+		self.assertEquals(6, len(backend._jobs))
+		self.assertEquals(set(["Build X dev-ACME-2", "Build X dev-ACME-3", "Build X dev-ACME-4"]), backend.disabled)
+
+		with open(os.path.join(path, syncgit.TOMBSTONE_FILE)) as f:
+			self.assertEquals("Build X dev-ACME-2", json.load(f)["tombstones"]["refs/remotes/origin/dev/ACME-2"]["job"])
+
+		# disabled once only
+		self.assertEquals([], sync())
+
+		# the branch is back, its job is reused
+		repo.refs["refs/remotes/origin/dev/ACME-2"] = repo.refs["refs/remotes/origin/dev/ACME-1"]
+
+		self.assertEquals([("enable", "refs/remotes/origin/dev/ACME-2")], sync())
+		self.assertEquals(set(["Build X dev-ACME-3", "Build X dev-ACME-4"]), backend.disabled)
+
+		# removed by hand
+		del backend._jobs["Build X dev-ACME-4"]
+
+		gc = self.create_sync(state_dir=path)
+
+		self.assertEquals([], gc.gc(1))
+		self.assertEquals([("remove", "refs/remotes/origin/dev/ACME-3")], [(x[0], x[1]) for x in gc.gc(0)])
+
+		self.assertEquals(["Build X dev-ACME-1", "Build X dev-ACME-2", "Build X dev-ACME-5", "TEMPLATE Build X"], sorted(backend._jobs.keys()))
+
+		# the job removed by hand might just not have been readable
+		with open(os.path.join(path, syncgit.TOMBSTONE_FILE)) as f:
+			self.assertEquals(["refs/remotes/origin/dev/ACME-4"], json.load(f)["tombstones"].keys())
+
+		# not listed by a sync
+		self.assertEquals([], sync())
+
+		with open(os.path.join(path, syncgit.TOMBSTONE_FILE)) as f:
+			self.assertEquals({}, json.load(f)["tombstones"])
+
+	def test_name_claimed_again(self):
+		now = int(time.time())
+
+		repo = self.create_fixture({
+			"refs/remotes/origin/dev/ACME-1": now
+		}, branches=["dev/ACME-1"], jobs={
+			"Build X dev-ACME-2": syncgit_fakes.get_job_config("origin/dev/ACME+2")
+		})
+
+		self.assertEquals([("disable", "refs/remotes/origin/dev/ACME+2")], self.sync(state_dir=self.path, disable_stale=True))
+
+		# a new branch with the same job name
+		repo.refs["refs/remotes/origin/dev/ACME-2"] = repo.refs["refs/remotes/origin/dev/ACME-1"]
+
+		self.assertEquals([("reclaim", "refs/remotes/origin/dev/ACME-2")], self.sync(state_dir=self.path, disable_stale=True))
+		self.assertEquals(syncgit_fakes.get_job_config("origin/dev/ACME-2"), self.backend._jobs["Build X dev-ACME-2"])
+		self.assertEquals(set(), self.backend.disabled)
+
+		with open(os.path.join(self.path, syncgit.TOMBSTONE_FILE)) as f:
+			self.assertEquals({}, json.load(f)["tombstones"])
+
+		# converged, gc leaves the job alone
+		self.assertEquals([], self.sync(state_dir=self.path, disable_stale=True))
+		self.assertEquals([], self.create_sync(state_dir=self.path).gc(0))
+
+	def test_tombstone_kept_on_discovery_failure(self):
+		self.create_fixture({}, branches=["dev/ACME-1"])
+
+		self.assertEquals([("disable", "refs/remotes/origin/dev/ACME-1")], self.sync(state_dir=self.path, disable_stale=True))
+
+		with open(os.path.join(self.path, syncgit.TOMBSTONE_FILE)) as f:
+			disabled = json.load(f)["tombstones"]["refs/remotes/origin/dev/ACME-1"]["disabled"]
+
+		get_job = self.backend.get_job
+
+		def get_job_fake(job_name):
+			if job_name == "Build X dev-ACME-1":
+				raise Exception("Connection reset")
+
+			return get_job(job_name)
+
+		self.backend.get_job = get_job_fake
+		self.assertEquals([], self.sync(state_dir=self.path, disable_stale=True))
+
+		# readable again, the job is not disabled again
+		self.backend.get_job = get_job
+		self.assertEquals([], self.sync(state_dir=self.path, disable_stale=True))
+
+		with open(os.path.join(self.path, syncgit.TOMBSTONE_FILE)) as f:
+			self.assertEquals(disabled, json.load(f)["tombstones"]["refs/remotes/origin/dev/ACME-1"]["disabled"])
+
+
+class ShardTest(SyncTestCase):
+
+	def test_get_shard(self):
+		# stable across processes and hosts
+		self.assertEquals([0, 1, 0, 2, 1, 2], [syncgit._get_shard("Build X dev-ACME-%d" % i, 3) for i in range(6)])
+		self.assertEquals(1, syncgit._get_shard(u"Build X dev-ACME-1", 3))
+
+	def test_parse_shard(self):
+		self.assertEquals((0, 4), syncgit._parse_shard("1/4"))
+		self.assertEquals((3, 4), syncgit._parse_shard("4/4"))
+
+		for value in ["0/4", "5/4", "1", "a/b"]:
+			self.assertRaises(argparse.ArgumentTypeError, syncgit._parse_shard, value)
+
+	def test_sync_shards(self):
+		now = int(time.time())
+
+		repo = self.create_fixture(
+			dict([("refs/remotes/origin/dev/ACME-%d" % i, now) for i in range(12)]),
+			branches=["dev/ACME-%d" % i for i in range(6, 18)]
+		)
+
+		def create_sync(index):
+			return self.create_sync(shard=(index, 3))
+
+		operations = []
+
+		for index in range(3):
+			results = create_sync(index).sync()
+
+			for name, ref, error, seconds in results:
+				self.assertEquals(index, syncgit._get_shard("Build X " + ref.replace("refs/remotes/origin/", "").replace("/", "-"), 3))
+
+			operations += [(x[0], x[1]) for x in results]
+
+		# each job has been created or removed by one shard
+		self.assertEquals(
+			[("create", "refs/remotes/origin/dev/ACME-%d" % i) for i in range(6)] + [("remove", "refs/remotes/origin/dev/ACME-%d" % i) for i in range(12, 18)],
+			sorted(operations, key=lambda x: (x[0], int(x[1].split("-")[-1])))
+		)
+
+		self.assertEquals(13, len(self.backend._jobs))
+
+		# a changed ref of another shard is not synced
+		del repo.refs["refs/remotes/origin/dev/ACME-0"]
+
+		self.assertEquals([], create_sync(1).sync_refs(["refs/remotes/origin/dev/ACME-0"]))
+		self.assertEquals([("remove", "refs/remotes/origin/dev/ACME-0")], [(x[0], x[1]) for x in create_sync(0).sync_refs(["refs/remotes/origin/dev/ACME-0"])])
+
+
+class FileLockTest(unittest.TestCase):
+
+	def test_lock(self):
+		path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, path)
+
+		lock = syncgit.FileLock(os.path.join(path, "sync.lock"))
+		other = syncgit.FileLock(os.path.join(path, "sync.lock"))
+
+		lock.acquire()
+
+		try:
+			other.acquire()
+			self.fail("Lock taken twice")
+		except syncgit.LockException as e:
+			self.assertTrue(" pid %d since " % os.getpid() in str(e))
+
+		lock.release()
+
+		other.acquire()
+		other.release()
+
+	def test_main_locks_shard(self):
+		path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, path)
+
+		os.mkdir(os.path.join(path, "repo"))
+		create_repo(os.path.join(path, "repo"), {})
+
+		lock = syncgit.FileLock(os.path.join(path, "shard-2-of-4", syncgit.LOCK_FILE))
+
+		args = [
+			"--backend", "http", "-J", "http://localhost:1/", "-G", os.path.join(path, "repo"),
+			"-T", "TEMPLATE Build X", "-n", "Build X %s", "-R", "^refs/remotes/origin/dev/",
+			"--state-dir", path, "--shard", "2/4"
+		]
+
+		os.mkdir(os.path.join(path, "shard-2-of-4"))
+		lock.acquire()
+
+		try:
+			self.assertRaises(syncgit.LockException, syncgit.main, args)
+		finally:
+			lock.release()
+
+	def test_main_lock_factory(self):
+		path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, path)
+
+		paths = []
+
+		class HeldLock(object):
+
+			def __init__(self, path):
+				paths.append(path)
+
+			def acquire(self):
+				raise syncgit.LockException("Lease is held")
+
+			def release(self):
+				pass
+
+		args = [
+			"--backend", "http", "-J", "http://localhost:1/", "-G", path,
+			"-T", "TEMPLATE Build X", "-n", "Build X %s", "-R", "^refs/remotes/origin/dev/",
+			"--lock-file", "/path/to/lease"
+		]
+
+		self.assertRaises(syncgit.LockException, syncgit.main, args, HeldLock)
+		self.assertEquals(["/path/to/lease"], paths)
+
+
+class SyncOptionsTest(unittest.TestCase):
+
+	def test_options(self):
+		options = syncgit.SyncOptions(mutation_workers=4)
+
+		self.assertEquals(4, options.mutation_workers)
+		self.assertEquals(syncgit.DEFAULT_DISCOVERY_WORKERS, options.discovery_workers)
+		self.assertEquals(syncgit.SyncOptions(mutation_workers=4), options)
+		self.assertNotEquals(syncgit.SyncOptions(), options)
+
+		self.assertRaises(TypeError, syncgit.SyncOptions, mutation_worker=4)
+
+
+class TimeBudgetTest(SyncTestCase):
+
+	def test_sync_within_time_budget(self):
+		path = self.path
+		now = int(time.time())
+
+		self.create_fixture(
+			dict([("refs/remotes/origin/dev/ACME-%d" % i, now - i * 60) for i in range(4)]),
+			branches=["dev/ACME-9"], latency=0.3
+		)
+
+		def sync():
+			return self.sync(state_dir=path, time_budget=0.8)
+
+		# listing and config read take 0.6s, the removal is started in the time left
+		self.assertEquals([("remove", "refs/remotes/origin/dev/ACME-9")], sync())
+
+		with open(os.path.join(path, syncgit.PENDING_FILE)) as f:
+			self.assertEquals(["refs/remotes/origin/dev/ACME-%d" % i for i in range(4)], json.load(f)["create"])
+
+		# the branch with the newest commit first
+		self.assertEquals([("create", "refs/remotes/origin/dev/ACME-0")], sync())
+		self.assertEquals([("create", "refs/remotes/origin/dev/ACME-1")], sync())
+
+		with open(os.path.join(path, syncgit.PENDING_FILE)) as f:
+			self.assertEquals(["refs/remotes/origin/dev/ACME-2", "refs/remotes/origin/dev/ACME-3"], json.load(f)["create"])
+
+
+class BenchTest(unittest.TestCase):
+
+	def test_bench_sync(self):
+		stdout = sys.stdout
+		sys.stdout = open(os.devnull, "w")
+
+		try:
+			results = syncgit_bench.bench_sync(40, False, 0, 0.5, 2)
+		finally:
+			sys.stdout.close()
+			sys.stdout = stdout
+
+		# 20 recent refs, 10 of them with a job; 10 jobs of expired and 4 of gone refs
+		self.assertEquals([("full", 24), ("unchanged", 0), ("incremental", 10)], [(x["run"], x["operations"]) for x in results])
+		self.assertEquals(1, results[1]["backend_calls"])
+		self.assertTrue("discovery" in results[0]["phases"])
+
+	def test_bench_sync_ages(self):
+		stdout = sys.stdout
+		sys.stdout = open(os.devnull, "w")
+
+		try:
+			results = syncgit_bench.bench_sync(40, True, 0, 0, 2, age_days=60, max_age=45)
+		finally:
+			sys.stdout.close()
+			sys.stdout = stdout
+
+		# 30 recent refs without a job, 4 jobs of gone refs
+		self.assertEquals(34, results[0]["operations"])
+
+
+class RefUpdatesTest(unittest.TestCase):
+
+	def test_read_ref_updates(self):
+		updates = syncgit._read_ref_updates([
+			"%s %s refs/heads/dev/ACME-123-branch\n" % ("0" * 40, "1" * 40),
+			"%s %s refs/heads/dev/ACME-987-branch\n" % ("2" * 40, "0" * 40),
+			"%s %s refs/tags/v1.0\n" % ("0" * 40, "3" * 40),
+			"\n",
+			# the last update of a ref wins
+			"%s %s refs/heads/dev/ACME-123-branch\n" % ("1" * 40, "4" * 40)
+		], "upstream")
+
+		self.assertEquals({
+			"refs/remotes/upstream/dev/ACME-123-branch": "4" * 40,
+			"refs/remotes/upstream/dev/ACME-987-branch": None,
+			"refs/tags/v1.0": "3" * 40
+		}, updates)
+
 
 class MainTest(unittest.TestCase):
 
@@ -238,7 +2352,8 @@ class MainTest(unittest.TestCase):
 			.GitJenkinsSync(
 				"http://localhost:8080/", "/path/to/jar", "/path/to/key",
 				"Template Job", "Job %s",
-				"/path/to/git", "^dev/.*$", 30
+				"/path/to/git", "^dev/.*$", 30,
+				options=syncgit.SyncOptions()
 			)
 			.AndReturn(mocked_sync))
 
@@ -340,6 +2455,26 @@ class MainTest(unittest.TestCase):
 		self.mox.VerifyAll()
 
 
+	"""When throttling with a single mutation worker it should not run the constructor and exit()"""
+	def test_aguments_throttle_single_worker(self):
+		self.mox.StubOutWithMock(syncgit, 'GitJenkinsSync')
+
+		self._mock_exists(1, lambda path: True)
+
+		self.mox.ReplayAll()
+
+		def _should_raise():
+			syncgit.main([
+				"-J", "http://localhost:8080/", "-S", "/path/to/key", "-j", "/path/to/jar",
+				"-G", "/path/to/git", "-T", "Template Job", "-n", "Job %s",
+				"-R", "^dev/.*$", "-a", "30", "--throttle-latency", "5"
+			])
+
+		self.assertRaises(syncgit.ArgumentValidationException, _should_raise)
+
+		self.mox.VerifyAll()
+
+
 	"""When argument "regex" is bad it should not run the constructor and exit()"""
 	def test_aguments_malformed_regex(self):
 		self.mox.StubOutWithMock(syncgit, 'GitJenkinsSync')